@@ -0,0 +1,300 @@
+#!/usr/bin/python
+"""
+Benchmarks of the fragment finder and generator hot paths.
+
+Molecules, repositories and .off files of the requested sizes are generated
+from a fixed seed, so that runs with the same options are comparable. The
+generator runs fake_fragments.py in place of the mop matcher, and everything
+is written to a temporary directory. Results are printed as JSON; with -c the
+medians are compared with a stored baseline, and cases that got slower by
+more than the threshold are reported as regressions (exit status 1).
+"""
+from getopt import getopt, GetoptError
+import json
+import os
+import random
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+from time import time
+
+
+BINDIR = os.path.dirname(os.path.abspath(__file__))
+SRCDIR = os.path.dirname(BINDIR)
+if SRCDIR not in sys.path:
+  sys.path.append(SRCDIR)
+
+import dummy_generator
+import environment_index
+import fragment_finder
+import fragment_generator
+from fragment_store import STORE
+import manifest
+import molecule_graph
+from repository_catalog import RepositoryCatalog
+
+
+DEFAULTS = {
+  'atoms': 40,
+  'fragments': 5,
+  'molecules': 200,
+  'repository': 20,
+  'repeat': 20,
+  'latency': 0.0,
+  'seed': 1,
+  'threshold': 0.2,
+  'views': True
+}
+HEAVY_TYPES = (12, 12, 12, 3, 6, 8)
+HYDROGEN = 20
+
+
+class BenchmarkError(Exception):
+  pass
+
+
+def random_molecule(atoms, rng):
+  """A chain of heavy atoms carrying hydrogens, with ids 1 to `atoms`."""
+  heavy = max(1, atoms / 3)
+  molecule = {'atoms': [], 'bonds': []}
+  for i in range(1, atoms + 1):
+    if i <= heavy:
+      molecule['atoms'].append({'id': i, 'type': rng.choice(HEAVY_TYPES)})
+      if i > 1:
+        molecule['bonds'].append({'a1': i - 1, 'a2': i})
+    else:
+      molecule['atoms'].append({'id': i, 'type': HYDROGEN})
+      molecule['bonds'].append({'a1': (i - 1) % heavy + 1, 'a2': i})
+  return molecule
+
+def synthetic_off(molecule, molecules, fragments):
+  graph = molecule_graph.from_molecule(molecule)
+  off = json.loads(json.dumps({
+    'molecules': map(
+      lambda i: dummy_generator.Molecule(str(i), graph, fragments),
+      range(molecules)
+    ),
+    'missing_atoms': []
+  }, default=(lambda o: o.__dict__)))
+  # dummy_generator leaves fragments unscored
+  for mf in off['molecules']:
+    for fragment in mf['fragments']:
+      fragment['score'] = len(fragment['pairs'])
+  return off
+
+def measure(fn, repeat):
+  """Runs `fn` `repeat` times and returns its timings in milliseconds."""
+  timings = []
+  for _ in range(repeat):
+    start = time()
+    fn()
+    timings.append((time() - start) * 1000)
+  timings.sort()
+  return {
+    'repeat': repeat,
+    'min': timings[0],
+    'median': timings[len(timings) / 2],
+    'mean': sum(timings) / len(timings),
+    'max': timings[-1]
+  }
+
+
+def setup(workdir, options, rng):
+  """Points the stores, indexes and matcher at `workdir` and fills it."""
+  STORE.root = "%s/fragments" % workdir
+  os.makedirs(STORE.root)
+  manifest.MANIFEST = "%s/manifest.sqlite" % STORE.root
+  environment_index.INDEXDIR = "%s/indexes" % STORE.root
+  fragment_generator.CATALOG = RepositoryCatalog("%s/repos" % workdir)
+  fragment_generator.GENERATOR = "%s %s/fake_fragments.py" % \
+      (sys.executable, BINDIR)
+  os.environ["FAKE_FRAGMENTS_LATENCY"] = str(options['latency'])
+
+  repodir = "%s/repos/bench" % workdir
+  os.makedirs(repodir)
+  for i in range(options['repository']):
+    with open("%s/%s.lgf" % (repodir, i), 'w') as fp:
+      fp.write(fragment_generator.molecule_to_lgf(
+        random_molecule(options['atoms'], rng)
+      ))
+
+  query = random_molecule(options['atoms'], rng)
+  off = synthetic_off(query, options['molecules'], options['fragments'])
+  for off_format in fragment_generator.FORMATS:
+    with STORE.write("bench.%s.off" % off_format) as path:
+      fragment_generator.write_off(off, path, off_format)
+  return query
+
+def run_benchmarks(options):
+  rng = random.Random(options['seed'])
+  random.seed(options['seed'])
+  workdir = mkdtemp()
+  try:
+    query = setup(workdir, options, rng)
+    ids = map(lambda a: a['id'], query['atoms'])
+    needles = map(lambda _: [rng.choice(ids)], range(options['repeat']))
+    repeat = options['repeat']
+    results = {}
+
+    results['molecule_to_lgf'] = measure(
+      lambda: fragment_generator.molecule_to_lgf(query), repeat
+    )
+    for off_format in fragment_generator.FORMATS:
+      name = "bench.%s.off" % off_format
+      results['load_off.%s' % off_format] = measure(
+        lambda: fragment_finder.load_off(name), repeat
+      )
+      results['get_fragments.cold.%s' % off_format] = measure(
+        lambda: fragment_finder.get_fragments(name, rng.choice(needles)),
+        repeat
+      )
+      cache = fragment_finder.OffCache()
+      fragment_finder.load_index(name, cache)
+      results['get_fragments.cached.%s' % off_format] = measure(
+        lambda: fragment_finder.get_fragments(name, rng.choice(needles), cache),
+        repeat
+      )
+
+    lgf = fragment_generator.molecule_to_lgf(query)
+    for jobs in (1, 4):
+      results['generate_fragments.jobs%s' % jobs] = measure(
+        lambda: fragment_generator.generate_fragments(
+          lgf, "bench", 1, "generated.off", ids, jobs, "json", None, False
+        ),
+        max(1, repeat / 4)
+      )
+
+    if options['views']:
+      results.update(run_view_benchmarks(workdir, query, needles, repeat))
+    return results
+  finally:
+    rmtree(workdir)
+
+class InlinePool:
+  """
+  Runs generator jobs in this process. Pool workers are fresh interpreters,
+  which would see neither the stores nor the matcher that setup() patched.
+  """
+
+  def submit(self, target, **kwargs):
+    return target(**kwargs)
+
+def checked(response):
+  """Returns `response`, or raises if it holds an error."""
+  result = json.loads(response.content)
+  if response.status_code != 200 or 'error' in result:
+    raise BenchmarkError("View returned an error: %s" %
+        result.get('error', response.status_code))
+  return response
+
+def run_view_benchmarks(workdir, query, needles, repeat):
+  os.environ.setdefault("DJANGO_SETTINGS_MODULE", "omfraf.settings")
+  from django.test.client import Client
+  from omfraf.main import util
+  util.LOCKSDIR = "%s/locks" % STORE.root
+  util.JOBS.dir = "%s/jobs" % STORE.root
+  util.GENERATOR_POOL = InlinePool()
+
+  client = Client()
+  post = lambda url, data: checked(client.post(url, data))
+  data = json.dumps({'molecule': query})
+  post('/generate/', {'data': data, 'repo': "bench"})
+  results = {}
+  results['view.generate.stored'] = measure(
+    lambda: post('/generate/', {'data': data, 'repo': "bench"}), repeat
+  )
+  results['view.load'] = measure(
+    lambda: post('/load/', {'data': json.dumps({
+      'off': "bench.json.off",
+      'needle': random.choice(needles)
+    })}),
+    repeat
+  )
+  return results
+
+
+def compare(results, baseline, threshold):
+  comparison = {}
+  for case, current in sorted(results.items()):
+    if not case in baseline:
+      continue
+    ratio = current['median'] / max(baseline[case]['median'], 1e-6)
+    comparison[case] = {
+      'baseline': baseline[case]['median'],
+      'current': current['median'],
+      'ratio': ratio,
+      'regression': ratio > 1 + threshold
+    }
+  return comparison
+
+def parse_args(argv):
+  options = dict(DEFAULTS)
+  try:
+    opts, args = getopt(
+      argv[1:],
+      "a:f:m:R:n:l:s:o:c:t:",
+      ["atoms=", "fragments=", "molecules=", "repository=", "repeat=",
+       "latency=", "seed=", "output=", "compare=", "threshold=", "no-views"]
+    )
+  except GetoptError as e:
+    raise BenchmarkError("Invalid script invocation: %s" % e)
+
+  sizes = {"-a": "atoms", "-f": "fragments", "-m": "molecules",
+           "-R": "repository", "-n": "repeat", "-s": "seed"}
+  try:
+    for o, v in opts:
+      if o in sizes:
+        options[sizes[o]] = int(v)
+      elif o.lstrip("-") in sizes.values():
+        options[o.lstrip("-")] = int(v)
+      elif o in ("-l", "--latency"):
+        options["latency"] = float(v)
+      elif o in ("-t", "--threshold"):
+        options["threshold"] = float(v)
+      elif o in ("-o", "--output"):
+        options["output"] = v
+      elif o in ("-c", "--compare"):
+        options["compare"] = v
+      elif o == "--no-views":
+        options["views"] = False
+  except ValueError as e:
+    raise BenchmarkError("Invalid option value: %s" % e)
+  return options
+
+def main(argv):
+  try:
+    options = parse_args(argv)
+  except BenchmarkError as e:
+    print json.dumps({'error': e.message})
+    return 2
+
+  try:
+    results = run_benchmarks(options)
+  except BenchmarkError as e:
+    print json.dumps({'error': e.message})
+    return 2
+
+  report = {
+    'parameters': dict((k, options[k]) for k in DEFAULTS),
+    'results': results
+  }
+  status = 0
+  if "compare" in options:
+    with open(options["compare"], 'r') as fp:
+      baseline = json.loads(fp.read())["results"]
+    report['comparison'] = compare(
+      report['results'], baseline, options['threshold']
+    )
+    if any(c['regression'] for c in report['comparison'].values()):
+      status = 1
+
+  out = json.dumps(report, indent=2, sort_keys=True)
+  if "output" in options:
+    with open(options["output"], 'w') as fp:
+      fp.write(out)
+  print out
+  return status
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,303 @@
+"""
+Binary .off container.
+
+A binary .off file holds the same data as a JSON .off file in flat,
+little-endian typed arrays, so that it can be memory-mapped and queried
+without parsing it as a whole:
+
+  header          magic, version, flags and the section sizes
+  strings         uint32 offsets (n_molecules + 1) and the utf-8 atb_ids
+  molecules       uint32 first fragment of each molecule (n_molecules + 1)
+  fragments       uint32 first pair of each fragment (n_fragments + 1)
+  scores          float64 score of each fragment
+  id1, id2        int32 atom ids of each pair
+  charges         float64 charge of each pair
+  missing_atoms   int32
+  atoms           int32 sorted ids of all atoms that occur as id1
+  postings        uint32 offsets (n_atoms + 1) and the ascending ordinals of
+                  the fragments containing each atom
+
+Every section starts on an 8 byte boundary.
+"""
+from array import array
+import json
+import mmap
+import struct
+import sys
+
+
+MAGIC = "OFFB"
+VERSION = 1
+HEADER = struct.Struct("<4sHH7I")
+HEADER_SIZE = 40
+
+FLAG_INT_SCORES = 1
+
+
+class FormatError(Exception):
+  pass
+
+
+def is_binary(path):
+  with open(path, 'rb') as fp:
+    return fp.read(len(MAGIC)) == MAGIC
+
+
+def align(n):
+  return (n + 7) & ~7
+
+def pack_array(typecode, values):
+  a = array(typecode, values)
+  if sys.byteorder == "big":
+    a.byteswap()
+  data = a.tostring()
+  return data + "\0" * (align(len(data)) - len(data))
+
+
+def write_binary(off, path):
+  atb_ids = []
+  molecule_offsets = [0]
+  fragment_offsets = [0]
+  scores = []
+  id1 = []
+  id2 = []
+  charges = []
+  postings = {}
+
+  for molecule in off["molecules"]:
+    atb_ids.append(unicode(molecule["atb_id"]).encode("utf-8"))
+    for fragment in molecule["fragments"]:
+      if not "pairs" in fragment:
+        continue
+
+      ordinal = len(scores)
+      scores.append(fragment["score"])
+      for pair in fragment["pairs"]:
+        id1.append(pair["id1"])
+        id2.append(pair["id2"])
+        charges.append(pair["charge"])
+        posting = postings.setdefault(pair["id1"], [])
+        if len(posting) == 0 or posting[-1] != ordinal:
+          posting.append(ordinal)
+      fragment_offsets.append(len(id1))
+    molecule_offsets.append(len(scores))
+
+  string_offsets = [0]
+  for atb_id in atb_ids:
+    string_offsets.append(string_offsets[-1] + len(atb_id))
+  strings = "".join(atb_ids)
+
+  atoms = sorted(postings)
+  posting_offsets = [0]
+  ordinals = []
+  for aid in atoms:
+    ordinals.extend(postings[aid])
+    posting_offsets.append(len(ordinals))
+
+  flags = 0
+  if all(isinstance(s, (int, long)) for s in scores):
+    flags |= FLAG_INT_SCORES
+
+  missing_atoms = off.get("missing_atoms", [])
+  try:
+    sections = [
+      pack_array("I", string_offsets),
+      strings + "\0" * (align(len(strings)) - len(strings)),
+      pack_array("I", molecule_offsets),
+      pack_array("I", fragment_offsets),
+      pack_array("d", scores),
+      pack_array("i", id1),
+      pack_array("i", id2),
+      pack_array("d", charges),
+      pack_array("i", missing_atoms),
+      pack_array("i", atoms),
+      pack_array("I", posting_offsets),
+      pack_array("I", ordinals),
+    ]
+  except (TypeError, OverflowError) as e:
+    raise FormatError("Cannot store fragments in binary format: %s" % e)
+
+  header = HEADER.pack(
+    MAGIC, VERSION, flags, len(atb_ids), len(scores), len(id1),
+    len(missing_atoms), len(atoms), len(ordinals), len(strings)
+  )
+  with open(path, 'wb') as fp:
+    fp.write(header + "\0" * (HEADER_SIZE - len(header)))
+    for section in sections:
+      fp.write(section)
+
+
+class BinaryOff:
+  """Read-only, memory-mapped view of a binary .off file."""
+
+  def __init__(self, path):
+    with open(path, 'rb') as fp:
+      try:
+        self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+      except ValueError as e:
+        raise FormatError("Invalid binary fragment file: %s" % e)
+
+    if len(self._map) < HEADER_SIZE:
+      raise FormatError("Invalid binary fragment file: truncated header")
+    magic, version, self.flags, self.n_molecules, self.n_fragments, \
+        self.n_pairs, self.n_missing, self.n_atoms, self.n_postings, \
+        n_strings = HEADER.unpack_from(self._map, 0)
+    if magic != MAGIC:
+      raise FormatError("Invalid binary fragment file: bad magic")
+    if version != VERSION:
+      raise FormatError("Unsupported binary fragment file version %s" % version)
+
+    sizes = [
+      ("string_offsets", 4 * (self.n_molecules + 1)),
+      ("strings", n_strings),
+      ("molecule_offsets", 4 * (self.n_molecules + 1)),
+      ("fragment_offsets", 4 * (self.n_fragments + 1)),
+      ("scores", 8 * self.n_fragments),
+      ("id1", 4 * self.n_pairs),
+      ("id2", 4 * self.n_pairs),
+      ("charges", 8 * self.n_pairs),
+      ("missing_atoms", 4 * self.n_missing),
+      ("atoms", 4 * self.n_atoms),
+      ("posting_offsets", 4 * (self.n_atoms + 1)),
+      ("postings", 4 * self.n_postings),
+    ]
+    self._sections = {}
+    offset = HEADER_SIZE
+    for name, size in sizes:
+      self._sections[name] = offset
+      offset += align(size)
+    if offset > len(self._map):
+      raise FormatError("Invalid binary fragment file: truncated data")
+
+  @property
+  def buffer(self):
+    """The mapped file, e.g. for numpy.frombuffer."""
+    return self._map
+
+  def section(self, name):
+    """Returns the offset of a section in the mapped file."""
+    return self._sections[name]
+
+  def _read(self, section, fmt, start, count):
+    offset = self._sections[section] + start * struct.calcsize(fmt)
+    return struct.unpack_from("<%d%s" % (count, fmt), self._map, offset)
+
+  def _get(self, section, fmt, i):
+    return self._read(section, fmt, i, 1)[0]
+
+  @property
+  def missing_atoms(self):
+    return list(self._read("missing_atoms", "i", 0, self.n_missing))
+
+  def atb_id(self, molecule):
+    start, end = self._read("string_offsets", "I", molecule, 2)
+    offset = self._sections["strings"]
+    return self._map[offset + start:offset + end].decode("utf-8")
+
+  def molecule_of(self, fragment):
+    lo, hi = 0, self.n_molecules
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._get("molecule_offsets", "I", mid + 1) <= fragment:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def score(self, ordinal):
+    score = self._get("scores", "d", ordinal)
+    if self.flags & FLAG_INT_SCORES:
+      score = int(score)
+    return score
+
+  def fragment(self, ordinal):
+    start, end = self._read("fragment_offsets", "I", ordinal, 2)
+    score = self.score(ordinal)
+
+    count = end - start
+    pairs = map(
+      lambda (id1, id2, charge): {'id1': id1, 'id2': id2, 'charge': charge},
+      zip(
+        self._read("id1", "i", start, count),
+        self._read("id2", "i", start, count),
+        self._read("charges", "d", start, count)
+      )
+    )
+    return {'score': score, 'pairs': pairs}
+
+  def posting(self, aid):
+    lo, hi = 0, self.n_atoms
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._get("atoms", "i", mid) < aid:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo == self.n_atoms or self._get("atoms", "i", lo) != aid:
+      return ()
+    start, end = self._read("posting_offsets", "I", lo, 2)
+    return self._read("postings", "I", start, end - start)
+
+  def hit(self, ordinal):
+    return self.atb_id(self.molecule_of(ordinal)), self.fragment(ordinal)
+
+  def search(self, needle):
+    return map(self.hit, self.search_ordinals(needle))
+
+  def search_ordinals(self, needle):
+    """Returns the ordinals of the fragments containing `needle`, in order."""
+    postings = []
+    for aid in set(needle):
+      if not isinstance(aid, (int, long)):
+        return []
+      posting = self.posting(aid)
+      if len(posting) == 0:
+        return []
+      postings.append(posting)
+
+    postings.sort(key=len)
+    matches = set(postings[0])
+    for posting in postings[1:]:
+      matches.intersection_update(posting)
+      if len(matches) == 0:
+        return []
+    return sorted(matches)
+
+  def columns(self):
+    """Returns the fragment offsets, scores, ids and charges of all pairs."""
+    return (
+      self._read("fragment_offsets", "I", 0, self.n_fragments + 1),
+      self._read("scores", "d", 0, self.n_fragments),
+      self._read("id1", "i", 0, self.n_pairs),
+      self._read("charges", "d", 0, self.n_pairs)
+    )
+
+  @property
+  def off(self):
+    molecules = []
+    for m in range(self.n_molecules):
+      start, end = self._read("molecule_offsets", "I", m, 2)
+      molecules.append({
+        'atb_id': self.atb_id(m),
+        'fragments': map(self.fragment, range(start, end))
+      })
+    return {'molecules': molecules, 'missing_atoms': self.missing_atoms}
+
+  def close(self):
+    self._map.close()
+
+
+def convert(src, dst):
+  with open(src, 'r') as fp:
+    try:
+      off = json.loads(fp.read())
+    except ValueError as e:
+      raise FormatError("Invalid fragment file: %s" % e)
+  write_binary(off, dst)
+
+
+if __name__ == "__main__":
+  if len(sys.argv) != 3:
+    print "Usage: %s <json .off> <binary .off>" % sys.argv[0]
+    sys.exit(1)
+  convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,312 @@
+"""
+Canonical labelling of molecule graphs.
+
+Atoms are put in an ordered partition of cells by atom type, and the cells
+are refined until every atom of a cell has the same number of neighbours in
+every other cell. Atoms that still share a cell are told apart by giving one
+of them a cell of its own and refining again; every atom of that cell is
+tried in turn, which makes a search tree whose leaves give every atom a cell,
+and so a rank, of its own. The leaf with the smallest bond list is the
+canonical order, so two molecules that only differ in the order or numbering
+of their atoms get the same canonical form, and their canonical orders map
+the atoms of one onto the atoms of the other. Leaves with the same bond list
+reveal symmetries of the molecule, and choices that a symmetry maps onto one
+already tried are skipped.
+
+Refinement works from a queue of splitter cells: only the cells with a
+neighbour in a splitter are split, and only the cells that changed are
+queued again, so telling one atom apart costs time in proportion to the
+part of the molecule it affects rather than a pass over the whole molecule.
+"""
+from copy import copy
+from hashlib import sha1
+from heapq import heappop, heappush
+from itertools import izip
+import json
+
+import molecule_graph
+
+
+class Partition:
+  """
+  Ordered partition of the atoms of a graph. The cells are ranges of
+  `order`; a cell is known by the position it starts at, which is also the
+  rank of its atoms.
+  """
+
+  def __init__(self, graph, colors):
+    self.graph = graph
+    self.order = sorted(range(len(graph)), key=lambda v: colors[v])
+    self.pos = [0] * len(graph)
+    self.start = [0] * len(graph)
+    self.end = {}
+    self._queue = []
+    self._queued = set()
+    self._first = 0
+
+    for i, v in enumerate(self.order):
+      self.pos[v] = i
+      if i == 0 or colors[v] != colors[self.order[i - 1]]:
+        cell = i
+        self._enqueue(cell)
+      self.start[v] = cell
+      self.end[cell] = i + 1
+
+  def _enqueue(self, cell):
+    if not cell in self._queued:
+      self._queued.add(cell)
+      heappush(self._queue, cell)
+
+  def refine(self):
+    """Splits cells until no splitter splits any cell any further."""
+    neighbours = self.graph.neighbours
+    while len(self._queue) > 0:
+      splitter = heappop(self._queue)
+      self._queued.discard(splitter)
+
+      counts = {}
+      for i in xrange(splitter, self.end[splitter]):
+        for w in neighbours(self.order[i]):
+          counts[w] = counts.get(w, 0) + 1
+
+      touched = {}
+      for w in counts:
+        touched.setdefault(self.start[w], []).append(w)
+      for cell in sorted(touched):
+        self._split(cell, touched[cell], counts)
+
+  def _split(self, cell, members, counts):
+    """
+    Splits `cell` by the number of neighbours its atoms have in the
+    splitter: atoms without any first, then ascending counts.
+    """
+    end = self.end[cell]
+    if len(members) == end - cell and \
+        len(set(counts[v] for v in members)) == 1:
+      return
+
+    # Move the counted atoms to the end of the cell, in ascending counts
+    members.sort(key=lambda v: counts[v])
+    tail = end - len(members)
+    for i, v in enumerate(reversed(members)):
+      self._swap(self.pos[v], end - 1 - i)
+    for i, v in enumerate(members):
+      self.order[tail + i] = v
+      self.pos[v] = tail + i
+
+    starts = [cell] if tail > cell else []
+    for i in range(tail, end):
+      if i == tail or counts[self.order[i]] != counts[self.order[i - 1]]:
+        starts.append(i)
+    self._divide(cell, starts)
+
+  def _swap(self, i, j):
+    v, w = self.order[i], self.order[j]
+    self.order[i], self.order[j] = w, v
+    self.pos[v], self.pos[w] = j, i
+
+  def _divide(self, cell, starts):
+    """Makes cells of `starts` out of `cell` and queues the new ones."""
+    end = self.end[cell]
+    bounds = zip(starts, starts[1:] + [end])
+    # The atoms of the first part keep the start of the cell
+    for first, last in bounds:
+      self.end[first] = last
+      if first != cell:
+        for i in xrange(first, last):
+          self.start[self.order[i]] = first
+
+    # A cell that is not queued yet can leave out its largest part
+    if cell in self._queued:
+      skip = None
+    else:
+      skip = max(bounds, key=lambda b: b[1] - b[0])[0]
+    for first, _ in bounds:
+      if first != skip:
+        self._enqueue(first)
+
+  def copy(self):
+    other = copy(self)
+    other.order = self.order[:]
+    other.pos = self.pos[:]
+    other.start = self.start[:]
+    other.end = dict(self.end)
+    other._queue = self._queue[:]
+    other._queued = set(self._queued)
+    return other
+
+  def target(self):
+    """
+    Returns the first cell with several atoms, or None when every atom
+    already has a cell of its own.
+    """
+    # Cells are only ever split, so the atoms before this one stay apart
+    cell = self._first
+    while cell < len(self.order) and self.end[cell] - cell == 1:
+      cell += 1
+    self._first = cell
+    return cell if cell < len(self.order) else None
+
+  def members(self, cell):
+    return self.order[cell:self.end[cell]]
+
+  def individualize(self, v):
+    """Gives atom `v` a cell of its own, ahead of the rest of its cell."""
+    cell = self.start[v]
+    self._swap(self.pos[v], cell)
+    self._divide(cell, [cell, cell + 1])
+
+
+class Search:
+  """
+  Search tree of the individualizations of a molecule graph. Every leaf is a
+  discrete partition; the canonical order is the leaf with the smallest bond
+  list. Two leaves with the same bond list give an automorphism of the
+  graph, and atoms that automorphisms already found map onto an explored
+  choice are not tried again.
+  """
+
+  def __init__(self, graph):
+    self.graph = graph
+    self.twins = twin_classes(graph)
+    # Automorphisms found so far, as {atom: image} of the atoms they move
+    self.automorphisms = []
+    self.first = None
+    self.best = None
+
+  def run(self, partition):
+    self._search(partition, [])
+    return self.best[1]
+
+  def _search(self, partition, path):
+    """
+    Explores the leaves below `partition`; returns the depth to go back to
+    when the rest of this subtree mirrors the first one explored.
+    """
+    # Cells with a single orbit need a single choice, made in place
+    while True:
+      partition.refine()
+      cell = partition.target()
+      if cell is None:
+        return self._leaf(partition, path)
+      members = partition.members(cell)
+      orbits = self._orbits(members, path)
+      if len(set(orbits.itervalues())) > 1:
+        break
+      partition.individualize(members[0])
+      path.append(members[0])
+
+    explored = set()
+    for v in members:
+      if len(explored) > 0:
+        orbits = self._orbits(members, path)
+        if orbits[v] in set(orbits[w] for w in explored):
+          continue
+      child = partition.copy()
+      child.individualize(v)
+      back = self._search(child, path + [v])
+      explored.add(v)
+      if back is not None and back < len(path):
+        return back
+    return None
+
+  def _leaf(self, partition, path):
+    pos = partition.pos
+    key = sorted(
+      (pos[v], pos[w]) if pos[v] < pos[w] else (pos[w], pos[v])
+      for v, w in self.graph.bonds
+    )
+    order = partition.order
+    if self.first is None:
+      self.first = (key, order, path)
+      self.best = (key, order)
+      return None
+
+    if key == self.first[0]:
+      # This subtree mirrors the first one from where their paths part
+      self._automorphism(self.first[1], order)
+      depth = 0
+      while self.first[2][depth] == path[depth]:
+        depth += 1
+      return depth
+    if key == self.best[0]:
+      self._automorphism(self.best[1], order)
+    elif key < self.best[0]:
+      self.best = (key, order)
+    return None
+
+  def _automorphism(self, order, other):
+    moved = dict((v, w) for v, w in izip(order, other) if v != w)
+    if len(moved) > 0:
+      self.automorphisms.append(moved)
+
+  def _orbits(self, members, path):
+    """
+    Returns the orbit of every atom of `members` under the automorphisms
+    found so far that keep every atom of `path` in place.
+    """
+    parent = dict((v, v) for v in members)
+    def find(v):
+      while parent[v] != v:
+        parent[v] = parent[parent[v]]
+        v = parent[v]
+      return v
+    def union(v, w):
+      parent[find(v)] = find(w)
+
+    # Swapping two atoms with the same type and neighbours is an automorphism
+    twin = {}
+    for v in members:
+      union(v, twin.setdefault(self.twins[v], v))
+
+    fixed = None
+    for moved in self.automorphisms:
+      if not any(v in moved for v in members):
+        continue
+      if fixed is None:
+        fixed = set(path)
+      if any(v in fixed for v in moved):
+        continue
+      for v in members:
+        w = moved.get(v)
+        if w is not None and w in parent:
+          union(v, w)
+    return dict((v, find(v)) for v in members)
+
+
+def twin_classes(graph):
+  """Numbers the atoms by their type and set of neighbours."""
+  classes = {}
+  return [
+    classes.setdefault(
+      (graph.types[v], tuple(sorted(graph.neighbours(v)))), len(classes))
+    for v in range(len(graph))
+  ]
+
+
+def rank(values):
+  ranks = dict((s, r) for r, s in enumerate(sorted(set(values))))
+  return map(lambda s: ranks[s], values)
+
+
+def canonical_order(molecule):
+  graph = molecule_graph.from_molecule(molecule)
+  partition = Partition(graph, rank(graph.types))
+  order = Search(graph).run(partition)
+  return map(lambda v: graph.ids[v], order)
+
+
+def canonical_form(molecule, order):
+  position = dict((aid, i) for i, aid in enumerate(order))
+  types = dict((a["id"], a["type"]) for a in molecule["atoms"])
+  bonds = sorted(
+    tuple(sorted((position[b["a1"]], position[b["a2"]])))
+    for b in molecule["bonds"]
+  )
+  return json.dumps([map(lambda aid: types[aid], order), bonds])
+
+
+def molecule_hash(molecule):
+  """Returns the canonical hash of a molecule and its canonical atom order."""
+  order = canonical_order(molecule)
+  return sha1(canonical_form(molecule, order)).hexdigest(), order
@@ -0,0 +1,212 @@
+"""
+Per-atom charge statistics of a .off file.
+
+For every atom of the query, the charges that the fragments of the .off file
+assign to it are summarised in a table with one row per atom: the number of
+charges, their mean, (population) standard deviation, minimum, maximum,
+median and the mean weighted by fragment score. The table of all atoms is
+computed in one pass over the fragment pairs with NumPy, reading the columns
+of binary files straight from the mapped file, and stored next to the .off
+file as <off>.stats, so that later queries only select rows. Without NumPy
+the same table is computed in plain Python.
+"""
+import json
+from math import sqrt
+import os
+import sys
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+import binary_off
+from fragment_finder import load_index, LoadError, OFF_ERRORS, ValidationError
+from fragment_store import InvalidName, STORE
+from query import as_query, QueryError, read_argument
+
+
+COLUMNS = ("id", "count", "mean", "std", "min", "max", "median",
+           "weighted_mean")
+EXTENSION = ".stats"
+
+
+def pair_lists(index):
+  """Returns the atom ids, charges and fragment scores of all pairs."""
+  if isinstance(index, binary_off.BinaryOff):
+    offsets, fragment_scores, ids, charges = index.columns()
+    scores = []
+    for i, score in enumerate(fragment_scores):
+      scores.extend([score] * (offsets[i + 1] - offsets[i]))
+    return list(ids), list(charges), scores
+
+  ids = []
+  charges = []
+  scores = []
+  for molecule in index.off["molecules"]:
+    for fragment in molecule["fragments"]:
+      pairs = fragment.get("pairs", ())
+      ids.extend(map(lambda p: p["id1"], pairs))
+      charges.extend(map(lambda p: p["charge"], pairs))
+      scores.extend([fragment["score"]] * len(pairs))
+  return ids, charges, scores
+
+def pair_arrays(index):
+  """Returns the atom ids, charges and fragment scores of all pairs."""
+  if isinstance(index, binary_off.BinaryOff):
+    column = lambda section, dtype, count: numpy.frombuffer(
+      index.buffer, dtype, count, index.section(section)
+    )
+    offsets = column("fragment_offsets", '<u4', index.n_fragments + 1)
+    return (
+      column("id1", '<i4', index.n_pairs),
+      column("charges", '<f8', index.n_pairs),
+      numpy.repeat(column("scores", '<f8', index.n_fragments),
+                   numpy.diff(offsets))
+    )
+
+  ids, charges, scores = pair_lists(index)
+  return (
+    numpy.array(ids, dtype=numpy.int64),
+    numpy.array(charges, dtype=numpy.float64),
+    numpy.array(scores, dtype=numpy.float64)
+  )
+
+def charge_table(ids, charges, scores):
+  """Returns the rows of COLUMNS of every atom id, in ascending order."""
+  if len(ids) == 0:
+    return []
+
+  # Group by atom, charges ascending within a group for min, max and median
+  order = numpy.lexsort((charges, ids))
+  ids = ids[order]
+  charges = charges[order]
+  scores = scores[order]
+  starts = numpy.flatnonzero(numpy.r_[True, ids[1:] != ids[:-1]])
+  counts = numpy.diff(numpy.r_[starts, len(ids)])
+  ends = starts + counts - 1
+
+  means = numpy.add.reduceat(charges, starts) / counts
+  deviations = charges - numpy.repeat(means, counts)
+  stds = numpy.sqrt(numpy.add.reduceat(deviations * deviations, starts) /
+                    counts)
+  medians = (charges[starts + (counts - 1) // 2] +
+             charges[starts + counts // 2]) / 2
+  weights = numpy.add.reduceat(scores, starts)
+  weighted = numpy.add.reduceat(charges * scores, starts) / \
+      numpy.where(weights != 0, weights, 1)
+
+  return map(list, zip(
+    ids[starts].tolist(),
+    counts.tolist(),
+    means.tolist(),
+    stds.tolist(),
+    charges[starts].tolist(),
+    charges[ends].tolist(),
+    medians.tolist(),
+    # Unweighted when all fragments of the atom score zero
+    map(lambda (w, m): None if w == 0 else m,
+        zip(weights.tolist(), weighted.tolist()))
+  ))
+
+def python_charge_table(ids, charges, scores):
+  """charge_table without NumPy, over plain lists."""
+  groups = {}
+  for aid, charge, score in zip(ids, charges, scores):
+    if not isinstance(aid, (int, long)):
+      raise ValueError("Atom id %r is not an integer" % (aid,))
+    groups.setdefault(aid, []).append((float(charge), float(score)))
+
+  rows = []
+  for aid in sorted(groups):
+    values = sorted(map(lambda g: g[0], groups[aid]))
+    count = len(values)
+    mean = sum(values) / count
+    weight = sum(map(lambda g: g[1], groups[aid]))
+    rows.append([
+      aid,
+      count,
+      mean,
+      sqrt(sum((v - mean) * (v - mean) for v in values) / count),
+      values[0],
+      values[-1],
+      (values[(count - 1) // 2] + values[count // 2]) / 2,
+      # Unweighted when all fragments of the atom score zero
+      None if weight == 0 else
+          sum(c * w for c, w in groups[aid]) / weight
+    ])
+  return rows
+
+def compute_table(index):
+  if numpy is None:
+    return python_charge_table(*pair_lists(index))
+  return charge_table(*pair_arrays(index))
+
+def load_table(off_name, cache=None):
+  """Returns the table of all atoms of `off_name`, computed at most once."""
+  try:
+    off = STORE.path(off_name)
+    name = off_name + EXTENSION
+    path = STORE.path(name)
+  except InvalidName as e:
+    raise LoadError(e)
+
+  try:
+    if os.path.getmtime(path) >= os.path.getmtime(off):
+      with open(path, 'r') as fp:
+        rows = json.loads(fp.read())
+      STORE.touch(off_name)
+      STORE.touch(name)
+      return rows
+  except (OSError, IOError, ValueError):
+    pass
+
+  try:
+    rows = compute_table(load_index(off_name, cache))
+  except (ValueError, TypeError) as e:
+    raise LoadError("Invalid fragment file: %s" % e)
+  with STORE.write(name) as tmp:
+    with open(tmp, 'w') as fp:
+      fp.write(json.dumps(rows, separators=(',', ':')))
+  return rows
+
+def find_charge_stats(args, cache=None):
+  try:
+    data = as_query(args).data
+  except QueryError as e:
+    return {'error': "Invalid query: %s" % e}
+
+  try:
+    validate_query(data)
+  except ValidationError as e:
+    return {'error': "Invalid query: %s" % e}
+
+  # This is safe now, as all has been validated
+  off_name = data["off"]
+  atoms = data.get("atoms")
+
+  try:
+    rows = load_table(off_name, cache)
+  except OFF_ERRORS + (IOError, OSError) as e:
+    return {'error': "Could not load fragments: %s" % e}
+
+  result = {'columns': COLUMNS, 'rows': rows}
+  if atoms is not None:
+    wanted = set(atoms)
+    result['rows'] = filter(lambda r: r[0] in wanted, rows)
+    found = set(map(lambda r: r[0], result['rows']))
+    result['unmatched'] = sorted(wanted - found)
+  return result
+
+def validate_query(data):
+  if not 'off' in data or len(data['off']) == 0:
+    raise ValidationError("OFF not set")
+  if 'atoms' in data:
+    atoms = data['atoms']
+    if not isinstance(atoms, list) or \
+        not all(isinstance(a, (int, long)) for a in atoms):
+      raise ValidationError("Atoms need to be a list of atom ids")
+
+
+if __name__ == "__main__":
+  print json.dumps(find_charge_stats(read_argument(sys.argv[1:])))
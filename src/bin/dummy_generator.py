@@ -1,22 +1,28 @@
-from copy import copy
 from datetime import datetime
 import json
 from os.path import exists
 from random import choice, randint, random
 import sys
 
+import molecule_graph
+from molecule_graph import HYDROGEN, MoleculeGraph
+
 
 class Molecule:
-  def __init__(self, atb_id, data):
+  def __init__(self, atb_id, data, fragments=None):
+    """`data` is a molecule, or its MoleculeGraph to share between calls."""
     self.atb_id = atb_id
-    candidates = filter((lambda a: a['type'] != 20), data['atoms'])
-    candidate_ids = map((lambda a: a['id']), candidates)
+    if isinstance(data, MoleculeGraph):
+      graph = data
+    else:
+      graph = molecule_graph.from_molecule(data)
+    candidate_ids = map(lambda v: graph.ids[v], graph.heavy_atoms())
     self.fragments = []
-    for i in range(randint(1, 10)):
+    for i in range(fragments or randint(1, 10)):
       chc = choice(candidate_ids)
       sel = [chc]
-      sel.extend(get_bonded_hydrogen(chc, data))
-      self.fragments.append(Fragment(sel, data))
+      sel.extend(get_bonded_hydrogen(chc, graph))
+      self.fragments.append(Fragment(sel, graph))
 
   @property
   def __dict__(self):
@@ -30,35 +36,26 @@ class Molecule:
     return json.dumps(self, default=lambda o: o.__dict__)
 
 class Fragment:
-  def __init__(self, main_ids, molecule):
+  def __init__(self, main_ids, graph):
     self.pairs = []
-    atom_ids = copy(main_ids)
-    candidates = filter((lambda a: a['type'] != 20), molecule['atoms'])
-    candidate_ids = map((lambda a: a['id']), candidates)
+    atom_ids = set(main_ids)
 
     for main_id in main_ids:
       self.pairs.append(Pair(main_id))
-      cis = list(set(candidate_ids) - set(atom_ids))
       max = randint(1, 5)
-      for bond in molecule['bonds']:
-        if bond['a1'] == main_id and bond['a2'] in cis:
-          pair = Pair(bond['a2'])
-          self.pairs.append(pair)
-          atom_ids.append(bond['a2'])
-
-          bhs = pair.get_bonded_hydrogen(molecule)
-          self.pairs.extend(bhs)
-          atom_ids.extend(map(lambda a: a.id1, bhs))
-        elif bond['a2'] == main_id and bond['a1'] in cis:
-          pair = Pair(bond['a1'])
-          self.pairs.append(pair)
-          atom_ids.append(bond['a1'])
-
-          bhs = pair.get_bonded_hydrogen(molecule)
-          self.pairs.extend(bhs)
-          atom_ids.extend(map(lambda a: a.id1, bhs))
-
-        if len(self.pairs) == max:
+      for v in graph.neighbours(graph.index(main_id)):
+        aid = graph.ids[v]
+        if graph.types[v] == HYDROGEN or aid in atom_ids:
+          continue
+        pair = Pair(aid)
+        self.pairs.append(pair)
+        atom_ids.add(aid)
+
+        bhs = pair.get_bonded_hydrogen(graph)
+        self.pairs.extend(bhs)
+        atom_ids.update(map(lambda a: a.id1, bhs))
+
+        if len(self.pairs) >= max:
           break
 
   @property
@@ -77,14 +74,9 @@ class Pair:
     self.id2 = id2 if id2 != None else id1
     self.charge = charge if charge != None else random()
 
-  def get_bonded_hydrogen(self, molecule):
-    hs = filter((lambda a: a['type'] == 20), molecule['atoms'])
-    hids = map((lambda a: a['id']), hs)
-    bhs = []
-    for bond in molecule['bonds']:
-      if bond['a1'] == self.id1 and bond['a2'] in hids:
-        bhs.append(Pair(bond['a2'], charge=0))
-    return bhs
+  def get_bonded_hydrogen(self, graph):
+    return map(lambda aid: Pair(aid, charge=0),
+               get_bonded_hydrogen(self.id1, graph))
 
   @property
   def __dict__(self):
@@ -99,22 +91,17 @@ class Pair:
     return json.dumps(self, default=lambda o: o.__dict__)
 
 
-def get_bonded_hydrogen(atom_id, molecule):
-  hs = filter((lambda a: a['type'] == 20), molecule['atoms'])
-  hids = map((lambda a: a['id']), hs)
-  bhs = []
-  for bond in molecule['bonds']:
-    if bond['a1'] == atom_id and bond['a2'] in hids:
-      bhs.append(bond['a2'])
-  return bhs
+def get_bonded_hydrogen(atom_id, graph):
+  return map(lambda v: graph.ids[v], graph.hydrogens(graph.index(atom_id)))
 
 
 if __name__ == "__main__":
   try:
     data = json.loads(sys.argv[1])
+    graph = molecule_graph.from_molecule(data['molecule'])
     molecules = []
     for i in range(randint(0, 10)):
-      molecules.append(Molecule("5276", data['molecule']))
+      molecules.append(Molecule("5276", graph))
 
     ffid = datetime.now().strftime("%Y%m%d%H%M%S%f")
     while exists("fragments/%s.off" % ffid):
@@ -0,0 +1,128 @@
+"""
+Atom environment index of fragment repositories.
+
+An atom's environment hash covers its atom type and the types of all atoms
+within `shell` bonds (colour refinement of the atom types, `shell` rounds).
+The matcher can only report a fragment for a repository molecule if some
+query atom has the same environment as an atom of that molecule, so
+repository molecules that share no environment hash with the query are
+skipped without running the matcher. Hashes are computed per shell size on
+first use and kept in fragments/indexes/<repo>.json, together with the mtime
+and size of every .lgf file so that changed molecules are re-hashed.
+"""
+from hashlib import md5
+import json
+import os
+from tempfile import mkstemp
+from threading import Lock
+
+import lgf
+import molecule_graph
+
+
+INDEXDIR = "%s/fragments/indexes" % os.path.dirname(os.path.abspath(__file__))
+VERSION = 1
+
+_indexes = {}
+_lock = Lock()
+
+
+def environment_hashes(atoms, bonds, shell):
+  return set(atom_hashes(atoms, bonds, shell))
+
+def atom_hashes(atoms, bonds, shell):
+  """Returns the environment hash of every atom, in order."""
+  return graph_hashes(molecule_graph.from_lgf(atoms, bonds), shell)
+
+def graph_hashes(graph, shell):
+  colors = map(str, graph.types)
+  for _ in range(shell):
+    colors = map(
+      lambda v: md5("%s(%s)" % (
+        colors[v], ",".join(sorted(colors[n] for n in graph.neighbours(v)))
+      )).hexdigest()[:16],
+      range(len(graph))
+    )
+  return colors
+
+def lgf_hashes(text, shell):
+  atoms, bonds = lgf.parse_lgf(text)
+  return environment_hashes(atoms, bonds, shell)
+
+
+def load_index(repo):
+  path = "%s/%s.json" % (INDEXDIR, repo)
+  try:
+    with open(path, 'r') as fp:
+      index = json.loads(fp.read())
+  except (IOError, ValueError):
+    return {'version': VERSION, 'molecules': {}}
+  if index.get('version') != VERSION:
+    return {'version': VERSION, 'molecules': {}}
+  return index
+
+def save_index(repo, index):
+  if not os.path.isdir(INDEXDIR):
+    try:
+      os.makedirs(INDEXDIR)
+    except OSError:
+      pass
+  fd, tmp = mkstemp(dir=INDEXDIR, suffix=".tmp")
+  with os.fdopen(fd, 'w') as fp:
+    fp.write(json.dumps(index))
+  os.rename(tmp, "%s/%s.json" % (INDEXDIR, repo))
+
+def repository_hashes(repo, molfiles, shell):
+  """
+  Returns {molecule name: environment hashes} for the (name, path) molfiles
+  of a repository, refreshing the stored index where files changed.
+  """
+  shell = str(shell)
+  with _lock:
+    index = _indexes.get(repo) or load_index(repo)
+    molecules = index['molecules']
+    changed = False
+    hashes = {}
+    for name, path in molfiles:
+      st = os.stat(path)
+      entry = molecules.get(name)
+      if entry is None or entry['mtime'] != st.st_mtime or \
+          entry['size'] != st.st_size:
+        entry = {'mtime': st.st_mtime, 'size': st.st_size, 'shells': {}}
+        molecules[name] = entry
+        changed = True
+      if not shell in entry['shells']:
+        try:
+          atoms, bonds = lgf.read_lgf(path)
+          entry['shells'][shell] = sorted(
+            environment_hashes(atoms, bonds, int(shell))
+          )
+        except (IOError, lgf.FormatError):
+          # Unreadable molecules are never skipped
+          entry['shells'][shell] = None
+        changed = True
+      hashes[name] = entry['shells'][shell]
+
+    names = set(map(lambda m: m[0], molfiles))
+    for name in molecules.keys():
+      if not name in names:
+        del molecules[name]
+        changed = True
+
+    _indexes[repo] = index
+    if changed:
+      save_index(repo, index)
+  return hashes
+
+def candidate_molecules(repo, molfiles, shell, query_lgf):
+  """Filters out the molfiles that cannot match any atom of the query."""
+  try:
+    query = lgf_hashes(query_lgf, shell)
+  except lgf.FormatError:
+    return molfiles
+
+  hashes = repository_hashes(repo, molfiles, shell)
+  return filter(
+    lambda m: hashes[m[0]] is None or not query.isdisjoint(hashes[m[0]]),
+    molfiles
+  )
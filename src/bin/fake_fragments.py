@@ -0,0 +1,76 @@
+#!/usr/bin/python
+"""
+Stand-in for the mop fragments matcher, for benchmarks and load tests.
+
+Takes the arguments of the real matcher (-s <shell> -atb_id <id> <query.lgf>
+<molecule.lgf>) and prints the same kind of JSON. Every query atom whose
+environment within the shell also occurs in the molecule gives a fragment,
+pairing it and those of its neighbours whose types agree with atoms of the
+molecule. FAKE_FRAGMENTS_LATENCY (in seconds) delays every call to mimic the
+cost of the real matcher.
+"""
+import json
+import os
+import sys
+import time
+
+import environment_index
+import lgf
+import molecule_graph
+
+
+def charge(atom):
+  try:
+    return float(atom.get("partial_charge", 0))
+  except ValueError:
+    return 0.0
+
+def match(query, molecule, shell):
+  qatoms, qbonds = query
+  matoms, mbonds = molecule
+  qgraph = molecule_graph.from_lgf(qatoms, qbonds)
+  mgraph = molecule_graph.from_lgf(matoms, mbonds)
+  qhashes = environment_index.graph_hashes(qgraph, shell)
+  mhashes = environment_index.graph_hashes(mgraph, shell)
+  first = {}
+  for i, h in enumerate(mhashes):
+    first.setdefault(h, i)
+
+  fragments = []
+  for q, h in enumerate(qhashes):
+    if not h in first:
+      continue
+    m = first[h]
+    pairs = [(q, m)]
+    used = set([m])
+    for qn in qgraph.neighbours(q):
+      for mn in mgraph.neighbours(m):
+        if not mn in used and qgraph.types[qn] == mgraph.types[mn]:
+          pairs.append((qn, mn))
+          used.add(mn)
+          break
+    fragments.append({
+      'score': len(pairs) * (shell + 1),
+      'pairs': map(lambda p: {
+        'id1': int(qatoms[p[0]]["label"]),
+        'id2': int(matoms[p[1]]["label"]),
+        'charge': charge(matoms[p[1]])
+      }, pairs)
+    })
+  return fragments
+
+
+if __name__ == "__main__":
+  args = sys.argv[1:]
+  try:
+    shell = int(args[args.index("-s") + 1])
+    molid = args[args.index("-atb_id") + 1]
+    infile, molfile = args[-2:]
+    query = lgf.read_lgf(infile)
+    molecule = lgf.read_lgf(molfile)
+  except (ValueError, IndexError, IOError, lgf.FormatError) as e:
+    sys.stderr.write("Invalid matcher invocation: %s\n" % e)
+    sys.exit(1)
+
+  time.sleep(float(os.environ.get("FAKE_FRAGMENTS_LATENCY", 0)))
+  print json.dumps({'atb_id': molid, 'fragments': match(query, molecule, shell)})
@@ -1,9 +1,18 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+import heapq
 import json
 import os
 import sys
+from threading import Lock
 
+import binary_off
+from fragment_store import InvalidName, STORE
+from query import as_query, QueryError, read_argument
+import stream_off
 
-FRAGMENTDIR = "fragments/"
+
+DEFAULT_CACHE_SIZE = 32
 
 
 class ValidationError(Exception):
@@ -12,46 +21,126 @@ class ValidationError(Exception):
 class LoadError(Exception):
   pass
 
+OFF_ERRORS = (LoadError, binary_off.FormatError, stream_off.FormatError)
+
 
-class Fragment:
-  def __init__(self, atb_id, score):
-    self.atb_id = atb_id
-    self.score = score
-    self.atoms = []
+class FragmentIndex:
+  """
+  Inverted index of a parsed .off file: every atom id maps to the ascending
+  ordinals of the fragments that contain it. Built on the first search.
+  """
 
-  def add_atom(self, id, charge, other_id):
-    self.atoms.append(Atom(id, charge, other_id))
+  def __init__(self, off):
+    self.off = off
+    self._fragments = None
+    self._postings = None
+    self._lock = Lock()
 
   @property
-  def __dict__(self):
-    return {
-      'atb_id': self.atb_id,
-      'score': self.score,
-      'atoms': map(lambda a: a.__dict__, self.atoms)
-    }
+  def missing_atoms(self):
+    return self.off["missing_atoms"]
 
+  def _build(self):
+    fragments = []
+    postings = {}
+    for molecule in self.off["molecules"]:
+      for fragment in molecule["fragments"]:
+        if not "pairs" in fragment:
+          continue
 
-class Atom:
-  def __init__(self, id, charge, other_id):
-    self.id = id
-    self.charge = charge
-    self.other_id = other_id
+        ordinal = len(fragments)
+        fragments.append((molecule["atb_id"], fragment))
+        for pair in fragment["pairs"]:
+          posting = postings.setdefault(pair["id1"], [])
+          if len(posting) == 0 or posting[-1] != ordinal:
+            posting.append(ordinal)
+    self._postings = postings
+    self._fragments = fragments
 
-  @property
-  def __dict__(self):
-    return {
-      'id': self.id,
-      'charge': self.charge,
-      'other_id': self.other_id
-    }
+  def score(self, ordinal):
+    return self._fragments[ordinal][1]["score"]
+
+  def hit(self, ordinal):
+    return self._fragments[ordinal]
+
+  def search(self, needle):
+    return map(self.hit, self.search_ordinals(needle))
+
+  def search_ordinals(self, needle):
+    """Returns the ordinals of the fragments containing `needle`, in order."""
+    if self._fragments is None:
+      with self._lock:
+        if self._fragments is None:
+          self._build()
+
+    postings = []
+    for aid in set(needle):
+      if not aid in self._postings:
+        return []
+      postings.append(self._postings[aid])
+
+    # Intersect starting from the rarest atom, in file order
+    postings.sort(key=len)
+    matches = set(postings[0])
+    for posting in postings[1:]:
+      matches.intersection_update(posting)
+      if len(matches) == 0:
+        return []
+    return sorted(matches)
+
+
+class OffCache:
+  """Bounded LRU of indexed .off files, keyed by path, mtime and size."""
+
+  def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = Lock()
+
+  def get(self, path):
+    try:
+      st = os.stat(path)
+    except OSError:
+      self.invalidate(path)
+      raise LoadError("Could not find fragment file %s" % path)
+    key = (st.st_mtime, st.st_size)
+
+    with self._lock:
+      entry = self._entries.pop(path, None)
+      if entry is not None and entry[0] == key:
+        self._entries[path] = entry
+        self.hits += 1
+        return entry[1]
+      self.misses += 1
 
+    data = open_off(path)
+    with self._lock:
+      self._entries[path] = (key, data)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+    return data
 
-def load_off(off_name):
-  off = os.path.normpath("%s/%s" % (FRAGMENTDIR, off_name))
-  if not os.path.exists(off):
-    raise LoadError("Could not find fragment file %s" % off)
+  def invalidate(self, path=None):
+    with self._lock:
+      if path is None:
+        self._entries.clear()
+      else:
+        self._entries.pop(path, None)
 
-  with open(off, 'r') as fp:
+  def stats(self):
+    with self._lock:
+      return {
+        'size': len(self._entries),
+        'max_size': self.max_size,
+        'hits': self.hits,
+        'misses': self.misses
+      }
+
+
+def parse_off(path):
+  with open(path, 'r') as fp:
     data = fp.read()
 
   try:
@@ -59,32 +148,95 @@ def load_off(off_name):
   except ValueError as e:
     raise LoadError("Invalid fragment file: %s" % e)
 
-def get_fragments(off_name, needle):
-  off = load_off(off_name)
-  fragments = []
-  for molecule in off["molecules"]:
-    for fragment in molecule["fragments"]:
-      if not "pairs" in fragment:
-        continue
-
-      aids = map(lambda p: p["id1"], fragment["pairs"])
-      match = True
-      for aid in needle:
-        if not aid in aids:
-          match = False
-          break
-      if match:
-        frag = Fragment(molecule["atb_id"], fragment["score"])
-        for pair in fragment["pairs"]:
-          frag.add_atom(pair["id1"], pair["charge"], pair["id2"])
-        fragments.append(frag)
-  return sorted(fragments, key=(lambda f: f.score), reverse=True)
+def open_off(path):
+  try:
+    if binary_off.is_binary(path):
+      return binary_off.BinaryOff(path)
+    if stream_off.is_stream(path):
+      return stream_off.StreamOff(path)
+  except (IOError, binary_off.FormatError) as e:
+    raise LoadError("Invalid fragment file: %s" % e)
+  return FragmentIndex(parse_off(path))
 
-def find_fragments(args):
+def load_index(off_name, cache=None):
   try:
-    data = json.loads(args)
-  except ValueError as e:
-    return {'error': "Query not in JSON format: %s" % e}
+    off = STORE.path(off_name)
+  except InvalidName as e:
+    raise LoadError(e)
+
+  if cache is not None:
+    index = cache.get(off)
+  elif not os.path.exists(off):
+    raise LoadError("Could not find fragment file %s" % off_name)
+  else:
+    index = open_off(off)
+  STORE.touch(off_name)
+  return index
+
+def load_off(off_name, cache=None):
+  return load_index(off_name, cache).off
+
+def get_fragments(off_name, needle, cache=None):
+  return search_fragments(load_index(off_name, cache), needle)
+
+def search_fragments(index, needle):
+  return select_fragments(index, needle)[0]
+
+def select_fragments(index, needle, limit=None, offset=0, min_score=None):
+  """
+  Returns the fragments containing `needle` ranked offset to offset + limit
+  by score, and the number of fragments scoring at least min_score.
+  """
+  # Matches are filtered and ranked by ordinal and score, and only the
+  # fragments of the selected page are built
+  if hasattr(index, "search_ordinals"):
+    matches = index.search_ordinals(needle)
+    score = index.score
+    hit = index.hit
+  else:
+    hits = index.search(needle)
+    matches = range(len(hits))
+    score = lambda o: hits[o][1]["score"]
+    hit = hits.__getitem__
+  if min_score is not None:
+    matches = filter(lambda o: score(o) >= min_score, matches)
+
+  # Both keep file order among equal scores, so pages do not overlap
+  if limit is None:
+    ranked = sorted(matches, key=score, reverse=True)[offset:]
+  else:
+    ranked = heapq.nlargest(offset + limit, matches, key=score)[offset:]
+  ranked = map(hit, ranked)
+
+  # Plain dicts, so that responses encode without a default callback
+  fragments = map(lambda m: {
+    'atb_id': m[0],
+    'score': m[1]["score"],
+    'atoms': map(lambda p: {
+      'id': p["id1"],
+      'charge': p["charge"],
+      'other_id': p["id2"]
+    }, m[1]["pairs"])
+  }, ranked)
+  return fragments, len(matches)
+
+def encode_cursor(offset, limit, min_score):
+  return urlsafe_b64encode(json.dumps(
+    {'offset': offset, 'limit': limit, 'min_score': min_score}
+  ))
+
+def decode_cursor(cursor):
+  try:
+    page = json.loads(urlsafe_b64decode(str(cursor)))
+    return page['offset'], page['limit'], page['min_score']
+  except (TypeError, ValueError, KeyError) as e:
+    raise ValidationError("Invalid cursor")
+
+def find_fragments(args, cache=None):
+  try:
+    data = as_query(args).data
+  except QueryError as e:
+    return {'error': "Invalid query: %s" % e}
 
   try:
     validate_query(data)
@@ -94,13 +246,54 @@ def find_fragments(args):
   # This is safe now, as all has been validated
   off_name = data["off"]
   needle = data["needle"]
+  if "cursor" in data:
+    offset, limit, min_score = decode_cursor(data["cursor"])
+  else:
+    offset = data.get("offset", 0)
+    limit = data.get("limit")
+    min_score = data.get("min_score")
+
+  try:
+    fragments, total = select_fragments(
+      load_index(off_name, cache), needle, limit, offset, min_score
+    )
+  except Exception as e:
+    return {'error': "Could not load fragments: %s" % e}
+
+  result = {'fragments': fragments, 'total': total}
+  if limit is not None and offset + limit < total:
+    result['cursor'] = encode_cursor(offset + limit, limit, min_score)
+  return result
+
+def find_fragments_batch(args, cache=None):
+  try:
+    data = as_query(args).data
+  except QueryError as e:
+    return {'error': "Invalid query: %s" % e}
 
   try:
-    fragments = get_fragments(off_name, needle)
+    validate_batch_query(data)
+  except ValidationError as e:
+    return {'error': "Invalid query: %s" % e}
+
+  # This is safe now, as all has been validated
+  off_name = data["off"]
+  needles = data["needles"]
+
+  try:
+    index = load_index(off_name, cache)
+    results = {}
+    for needle in needles:
+      results[needle_key(needle)] = {
+        'fragments': search_fragments(index, needle)
+      }
   except Exception as e:
     return {'error': "Could not load fragments: %s" % e}
 
-  return {'fragments': fragments}
+  return {'results': results}
+
+def needle_key(needle):
+  return ",".join(map(unicode, needle))
 
 def validate_query(data):
   if not 'off' in data or len(data['off']) == 0:
@@ -108,7 +301,29 @@ def validate_query(data):
   elif not 'needle' in data or len(data['needle']) == 0:
     raise ValidationError("Needle not set")
 
+  if 'cursor' in data:
+    offset, limit, min_score = decode_cursor(data['cursor'])
+  else:
+    offset = data.get('offset', 0)
+    limit = data.get('limit')
+    min_score = data.get('min_score')
+  if not isinstance(offset, int) or offset < 0:
+    raise ValidationError("Offset needs to be a non-negative integer")
+  if limit is not None and (not isinstance(limit, int) or limit < 1):
+    raise ValidationError("Limit needs to be a positive integer")
+  if min_score is not None and not isinstance(min_score, (int, float)):
+    raise ValidationError("Minimum score needs to be a number")
+
+def validate_batch_query(data):
+  if not 'off' in data or len(data['off']) == 0:
+    raise ValidationError("OFF not set")
+  elif not 'needles' in data or len(data['needles']) == 0:
+    raise ValidationError("Needles not set")
+  for needle in data['needles']:
+    if not isinstance(needle, list) or len(needle) == 0:
+      raise ValidationError("Needles need to be non-empty lists of atom ids")
+
 
 if __name__ == "__main__":
-  result = find_fragments(sys.argv[1])
+  result = find_fragments(read_argument(sys.argv[1:]))
   print json.dumps(result, default=lambda o: o.__dict__)
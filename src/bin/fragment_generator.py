@@ -1,89 +1,421 @@
 #!/usr/bin/python
-from datetime import datetime
 from getopt import getopt, GetoptError
+from collections import OrderedDict
+from hashlib import sha1
+from itertools import islice
 import json
+from multiprocessing.pool import ThreadPool
 import os
 from subprocess import Popen, PIPE
 import sys
-from tempfile import NamedTemporaryFile
+from tempfile import mkstemp, NamedTemporaryFile
+from threading import Event, Timer
+from time import time
 
+import binary_off
+import environment_index
+import fragment_finder
+from fragment_store import InvalidName, STORE, new_name
+import manifest
+import molecule_diff
+import molecule_graph
+from query import as_query, QueryError, read_argument
+from repository_catalog import RepositoryCatalog
+import stream_off
+from timings import Timings
 
-SAVEDIR = "fragments/"
-GENERATOR = "mop/build/fragments"
-REPODIR = "mop/data/fragments/"
+
+BINDIR = os.path.dirname(os.path.abspath(__file__))
+# The matcher and repositories can be swapped, e.g. for fake_fragments.py
+GENERATOR = os.environ.get(
+  "OMFRAF_GENERATOR", "%s/mop/build/fragments" % BINDIR
+)
+REPODIR = os.environ.get(
+  "OMFRAF_REPODIR", "%s/mop/data/fragments/" % BINDIR
+)
 DEFAULT_REPO = "lipids"
 DEFAULT_SHELL_SIZE = 1
+DEFAULT_JOBS = 1
+DEFAULT_FORMAT = "json"
+FORMATS = ("json", "binary", "stream")
+MAX_SHELL_SIZES = 10
+
+CATALOG = RepositoryCatalog(REPODIR)
 
 
 class ValidationError(Exception):
   pass
 
+class MatcherTimeout(Exception):
+  pass
+
+
+class Limits:
+  """
+  Time limits of a generator run: a deadline for the whole run (a time()
+  value) and a budget in seconds for every repository molecule, either None
+  for no limit.
+  """
+
+  def __init__(self, deadline=None, budget=None):
+    self.deadline = deadline
+    self.budget = budget
+
+  def timeout(self):
+    """Returns the seconds the next matcher run may take, or None."""
+    if self.deadline is None:
+      return self.budget
+    left = self.deadline - time()
+    return left if self.budget is None else min(self.budget, left)
+
 
 def molecule_to_lgf(molecule):
-  lgf = ""
-  lgf += atoms_to_lgf(molecule["atoms"])
-  lgf += bonds_to_lgf(molecule["bonds"])
-  return lgf
-
-def atoms_to_lgf(atoms):
-  lgf = "@nodes\n"
-  lgf += "partial_charge\tlabel\tlabel2\tatomType\tcoordX\tcoordY\t" + \
-      "coordZ\tinitColor\t\n"
-  for atom in atoms:
-    lgf += "0\t%s\tX\t%s\t0\t0\t0\t0\t\n" % (atom["id"], atom["type"])
-  return lgf
-
-def bonds_to_lgf(bonds):
-  lgf = "@edges\n"
-  lgf += "\t\tlabel\n"
-  for i, bond in enumerate(bonds):
-    lgf += "%s\t%s\t%s\t\n" % (bond["a1"], bond["a2"], i)
-  return lgf
-
-
-def generate_fragments(lgf, repo, shell, outfile, atom_ids):
-  repo_path = os.path.normpath("%s/%s" % (REPODIR, repo))
-  molecules = []
+  return molecule_graph.from_molecule(molecule).to_lgf()
+
+
+def list_molecules(repo):
+  return CATALOG.molecules(repo)
+
+def warm_catalog():
+  """Scans the repositories ahead of the first job of a worker process."""
+  CATALOG.refresh()
+
+def generate_fragments(lgf, repo, shell, outfile, atom_ids, jobs=DEFAULT_JOBS,
+    off_format=DEFAULT_FORMAT, progress=None, prefilter=False, timings=None,
+    limits=None):
+  timings = timings or Timings()
+  results = match_query(
+    lgf, repo, shell, jobs, progress, prefilter, timings, limits
+  )
+  return store_molecules(results, outfile, atom_ids, off_format, timings)
+
+def match_query(lgf, repo, shell, jobs=DEFAULT_JOBS, progress=None,
+    prefilter=False, timings=None, limits=None):
+  """Yields the matcher results of the query against the repository."""
+  timings = timings or Timings()
+  with timings.span("list"):
+    molfiles = list_molecules(repo)
+  if prefilter:
+    with timings.span("prefilter"):
+      molfiles = environment_index.candidate_molecules(
+        repo, molfiles, shell, lgf
+      )
+
   with NamedTemporaryFile() as fp:
     fp.write(lgf)
     fp.seek(0)
 
-    for file in os.listdir(repo_path):
-      name, ext = os.path.splitext(file)
-      if ext == ".lgf":
-        mf = generate_molecule_fragments(
-          name, "%s/%s" % (repo_path, file), shell, fp.name
-        )
-        if len(mf["fragments"]) > 0:
-          molecules.append(mf)
-
-  found_ids = set()
-  for molecule in molecules:
-    for fragment in molecule["fragments"]:
-      for pair in fragment["pairs"]:
-        found_ids.add(pair["id1"])
-
-  missing_atoms = set(atom_ids) - found_ids
-  res = json.dumps({
-    "molecules": molecules,
-    "missing_atoms": list(missing_atoms)
-  }, default=(lambda o: o.__dict__))
-  outpath = os.path.normpath("%s/%s" % (SAVEDIR, outfile))
-  with open(outpath, "w") as fp:
-    fp.write(res)
-
-  return {'off': outfile, 'missing_atoms': list(missing_atoms)}
-
-
-def generate_molecule_fragments(molid, molfile, shell, infile):
-  p = Popen(
-    "%s -s %s -atb_id %s %s %s" % (GENERATOR, shell, molid, infile, molfile),
-    shell=True,
-    stdout=PIPE,
-    stderr=PIPE
-  )
+    tasks = map(lambda m: (m[0], m[1], fp.name, shell), molfiles)
+    results = match_molecules(tasks, jobs, timings, limits)
+    if progress:
+      results = report_progress(results, len(tasks), progress)
+    for mf in results:
+      yield mf
+
+def generate_shell_fragments(lgf, repo, shells, outfiles, atom_ids,
+    jobs=DEFAULT_JOBS, off_format=DEFAULT_FORMAT, progress=None,
+    prefilter=False, timings=None, limits=None):
+  """
+  Generates fragments for every shell size in `shells` with a single pass
+  over the repository: one listing, one LGF file, and the matcher runs for
+  every shell size on the same pool of jobs.
+  """
+  timings = timings or Timings()
+  with timings.span("list"):
+    molfiles = list_molecules(repo)
+
+  with NamedTemporaryFile() as fp:
+    fp.write(lgf)
+    fp.seek(0)
+
+    tasks = []
+    counts = []
+    for shell in shells:
+      if prefilter:
+        with timings.span("prefilter"):
+          candidates = environment_index.candidate_molecules(
+            repo, molfiles, shell, lgf
+          )
+      else:
+        candidates = molfiles
+      tasks.extend(map(lambda m: (m[0], m[1], fp.name, shell), candidates))
+      counts.append(len(candidates))
+    results = match_molecules(tasks, jobs, timings, limits)
+    if progress:
+      results = report_progress(results, len(tasks), progress)
+
+    acks = []
+    for outfile, count in zip(outfiles, counts):
+      acks.append(store_molecules(
+        islice(results, count), outfile, atom_ids, off_format, timings
+      ))
+    return acks
+
+def regenerate_fragments(molecule, previous, repo, shell, outfile, repo_digest,
+    build, jobs=DEFAULT_JOBS, off_format=DEFAULT_FORMAT, progress=None,
+    prefilter=False, timings=None, limits=None):
+  """
+  Generates the fragments of `molecule` from those of `previous`, an .off
+  file of an earlier version of it: fragments of atoms away from the edits
+  are kept, and only the atoms within shell bonds of an edit are matched
+  again. Returns None if `previous` was generated from another repository,
+  shell or matcher build, if it is partial, or if the edits reach every atom.
+  """
+  timings = timings or Timings()
+  entry = manifest.entry(previous)
+  if entry is None or entry[1] != repo or entry[2] != str(shell) or \
+      entry[3] != repo_digest or entry[4] != build:
+    return None
+  # Molecules a partial file left out have no fragments to keep
+  if manifest.skipped(previous) is not None:
+    return None
+
+  with timings.span("diff"):
+    try:
+      old = json.loads(entry[5])["molecule"]
+      affected = molecule_diff.affected_atoms(old, molecule, shell)
+    except (TypeError, ValueError, KeyError) as e:
+      return None
+    atom_ids = map(lambda a: a["id"], molecule["atoms"])
+    recompute = affected.intersection(atom_ids)
+    if len(recompute) == len(atom_ids):
+      return None
+
+  try:
+    off = fragment_finder.load_off(previous)
+  except fragment_finder.OFF_ERRORS + (IOError,) as e:
+    return None
+
+  # Fragments touching an affected atom are replaced by new matches
+  kept = OrderedDict()
+  for mf in off["molecules"]:
+    kept[mf["atb_id"]] = filter(
+      lambda f: "pairs" in f and not any(p["id1"] in affected
+                                         for p in f["pairs"]),
+      mf["fragments"]
+    )
+
+  results = []
+  if len(recompute) > 0:
+    # Atoms within 2 * shell bonds give the recomputed atoms' fragments their
+    # whole environment; fragments of the context atoms alone are dropped
+    context = molecule_diff.within(
+      molecule_diff.bond_set(molecule), recompute, 2 * shell
+    )
+    with timings.span("lgf"):
+      lgf = molecule_to_lgf(molecule_diff.submolecule(molecule, context))
+    results = match_query(
+      lgf, repo, shell, jobs, progress, prefilter, timings, limits
+    )
+
+  def splice():
+    for mf in results:
+      if mf.get("timed_out"):
+        yield mf
+        continue
+      fragments = filter(
+        lambda f: any(p["id1"] in recompute for p in f["pairs"]),
+        mf["fragments"]
+      )
+      yield dict(mf, fragments=kept.pop(mf["atb_id"], []) + fragments)
+    for atb_id, fragments in kept.items():
+      yield {'atb_id': atb_id, 'fragments': fragments}
+
+  ack = store_molecules(splice(), outfile, atom_ids, off_format, timings)
+  ack['recomputed_atoms'] = sorted(recompute)
+  return ack
+
+def generate_batch_fragments(queries, repo, shell, jobs=DEFAULT_JOBS,
+    off_format=DEFAULT_FORMAT, prefilter=False, timings=None, limits=None):
+  """
+  Generates fragments for several (lgf, outfile, atom_ids) queries with a
+  single pass over the repository: every query is matched against every
+  repository molecule on the same pool of jobs.
+  """
+  timings = timings or Timings()
+  with timings.span("list"):
+    molfiles = list_molecules(repo)
+  infiles = []
+  try:
+    tasks = []
+    counts = []
+    for lgf, _, _ in queries:
+      fp = NamedTemporaryFile()
+      infiles.append(fp)
+      fp.write(lgf)
+      fp.seek(0)
+
+      if prefilter:
+        with timings.span("prefilter"):
+          candidates = environment_index.candidate_molecules(
+            repo, molfiles, shell, lgf
+          )
+      else:
+        candidates = molfiles
+      tasks.extend(map(lambda m: (m[0], m[1], fp.name, shell), candidates))
+      counts.append(len(candidates))
+    results = match_molecules(tasks, jobs, timings, limits)
+
+    acks = []
+    for (_, outfile, atom_ids), count in zip(queries, counts):
+      acks.append(store_molecules(
+        islice(results, count), outfile, atom_ids, off_format, timings
+      ))
+    return acks
+  finally:
+    for fp in infiles:
+      fp.close()
+
+def store_molecules(results, outfile, atom_ids, off_format=DEFAULT_FORMAT,
+    timings=None):
+  """
+  Writes the matcher results to the store and moves them to `outfile`, if
+  set, once they are complete. Results that left out molecules keep a fresh
+  name, where lookups of `outfile` never take them as complete.
+  """
+  timings = timings or Timings()
+  name = new_name()
+  with STORE.write(name) as outpath:
+    if off_format == "stream":
+      writer = stream_off.StreamWriter(outpath)
+    else:
+      writer = None
+    molecules = []
+    found_ids = set()
+    skipped = []
+
+    for mf in results:
+      if mf.get("timed_out"):
+        skipped.append(mf["atb_id"])
+        continue
+      if len(mf["fragments"]) == 0:
+        continue
+
+      for fragment in mf["fragments"]:
+        for pair in fragment["pairs"]:
+          found_ids.add(pair["id1"])
+      if writer:
+        with timings.span("write"):
+          writer.write_molecule(mf)
+      else:
+        molecules.append(mf)
+
+    missing_atoms = list(set(atom_ids) - found_ids)
+    with timings.span("write"):
+      if writer:
+        writer.close(missing_atoms)
+      else:
+        write_off({
+          "molecules": molecules,
+          "missing_atoms": missing_atoms
+        }, outpath, off_format)
+    timings.count("bytes_written", os.path.getsize(outpath))
+
+  ack = {'off': name, 'missing_atoms': missing_atoms}
+  if len(skipped) > 0:
+    ack['partial'] = True
+    ack['skipped'] = skipped
+    timings.count("skipped_molecules", len(skipped))
+  elif outfile:
+    STORE.rename(name, outfile)
+    ack['off'] = outfile
+  return ack
+
+def write_off(off, outpath, off_format=DEFAULT_FORMAT):
+  if off_format == "binary":
+    binary_off.write_binary(off, outpath)
+  elif off_format == "stream":
+    writer = stream_off.StreamWriter(outpath)
+    for molecule in off["molecules"]:
+      writer.write_molecule(molecule)
+    writer.close(off["missing_atoms"])
+  else:
+    with open(outpath, "w") as fp:
+      fp.write(json.dumps(off, default=(lambda o: o.__dict__)))
+
+def progress_writer(path):
+  """Returns a progress callback that keeps `path` up to date."""
+  def report(done, total):
+    fd, tmp = mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, 'w') as fp:
+      fp.write(json.dumps({'done': done, 'total': total}))
+    os.rename(tmp, path)
+  return report
+
+def report_progress(results, total, progress):
+  progress(0, total)
+  for i, mf in enumerate(results):
+    progress(i + 1, total)
+    yield mf
+
+def match_molecules(tasks, jobs=DEFAULT_JOBS, timings=None, limits=None):
+  """
+  Runs the matcher for (molid, molfile, infile, shell) tasks, yielding in
+  order. Molecules that run out of time are yielded with 'timed_out' set.
+  """
+  limits = limits or Limits()
+  def run_task(task):
+    try:
+      return generate_molecule_fragments(
+        task[0], task[1], task[3], task[2], timings, limits.timeout()
+      )
+    except MatcherTimeout as e:
+      return {'atb_id': task[0], 'fragments': [], 'timed_out': True}
+
+  # Results are yielded in task order, whatever order they finish in
+  if jobs > 1 and len(tasks) > 1:
+    pool = ThreadPool(min(jobs, len(tasks)))
+    try:
+      for mf in pool.imap(run_task, tasks):
+        yield mf
+    finally:
+      pool.terminate()
+      pool.join()
+  else:
+    for task in tasks:
+      yield run_task(task)
+
+
+def generate_molecule_fragments(molid, molfile, shell, infile, timings=None,
+    timeout=None):
+  timings = timings or Timings()
+  if timeout is not None and timeout <= 0:
+    raise MatcherTimeout("No time left to match %s" % molid)
+
+  # The shell execs the matcher, so that killing the process kills the
+  # matcher; it stays in the process group of the worker running the job,
+  # which is killed together with its matchers
+  with timings.span("spawn"):
+    p = Popen(
+      "exec %s -s %s -atb_id %s %s %s" %
+        (GENERATOR, shell, molid, infile, molfile),
+      shell=True,
+      stdout=PIPE,
+      stderr=PIPE
+    )
+  timings.count("matcher_calls")
+
+  expired = Event()
+  def expire():
+    expired.set()
+    try:
+      p.kill()
+    except OSError:
+      pass
 
-  out, err = p.communicate()
+  timer = Timer(timeout, expire) if timeout is not None else None
+  if timer:
+    timer.start()
+  try:
+    with timings.span("match"):
+      out, err = p.communicate()
+  finally:
+    if timer:
+      timer.cancel()
+  if expired.is_set():
+    timings.count("matcher_timeouts")
+    raise MatcherTimeout("Matcher timed out after %.1fs on %s" %
+        (timeout, molid))
   if len(err) > 0:
     raise ValidationError(err)
 
@@ -93,64 +425,295 @@ def generate_molecule_fragments(molid, molfile, shell, infile):
     raise ValidationError("Generator returned invalid JSON: %s" % e)
 
 
-def main(argv):
-  repo = DEFAULT_REPO
-  shell = DEFAULT_SHELL_SIZE
+_build_id = (None, None)
+
+def build_id():
+  """Returns a digest of the matcher binary, recomputed when it changes."""
+  global _build_id
+  try:
+    st = os.stat(GENERATOR)
+  except OSError:
+    return None
 
-  ffid = datetime.now().strftime("%Y%m%d%H%M%S%f")
-  while os.path.exists("%s/%s.off" % (SAVEDIR, ffid)):
-    ffid = str(int(ffid) - 1)
-  outfile = "%s.off" % ffid
+  key = (st.st_mtime, st.st_size)
+  if _build_id[0] != key:
+    digest = sha1()
+    with open(GENERATOR, 'rb') as fp:
+      for block in iter(lambda: fp.read(65536), ""):
+        digest.update(block)
+    _build_id = (key, digest.hexdigest())
+  return _build_id[1]
 
+
+def validate_repository(v):
+  rp = os.path.normpath(v)
+  if not CATALOG.exists(rp):
+    raise ValidationError("Provided repository (%s) does not exist" % rp)
+  return rp
+
+def validate_shell_size(v):
+  try:
+    shell = int(v)
+  except ValueError as e:
+    raise ValidationError("Shell size needs to be an integer")
+  if shell < 1:
+    raise ValidationError("Shell size needs to be a positive integer")
+  return shell
+
+def validate_shell_sizes(v):
+  """Returns the ascending shell sizes of a list like 1,2,4 or a range 1-3."""
+  shells = set()
+  for part in str(v).split(","):
+    bounds = part.split("-")
+    if len(bounds) == 2:
+      lo, hi = validate_shell_size(bounds[0]), validate_shell_size(bounds[1])
+      if hi < lo:
+        raise ValidationError("Shell size range needs to be ascending")
+      shells.update(range(lo, hi + 1))
+    else:
+      shells.add(validate_shell_size(part))
+  if len(shells) > MAX_SHELL_SIZES:
+    raise ValidationError("At most %s shell sizes can be generated at once" %
+        MAX_SHELL_SIZES)
+  return sorted(shells)
+
+def validate_jobs(v):
+  try:
+    jobs = int(v)
+  except ValueError as e:
+    raise ValidationError("Number of jobs needs to be an integer")
+  if jobs < 1:
+    raise ValidationError("Number of jobs needs to be a positive integer")
+  return jobs
+
+def validate_seconds(v):
+  try:
+    seconds = float(v)
+  except ValueError as e:
+    raise ValidationError("Time limit needs to be a number of seconds")
+  if seconds <= 0:
+    raise ValidationError("Time limit needs to be positive")
+  return seconds
+
+def validate_format(v):
+  if not v in FORMATS:
+    raise ValidationError("Output format needs to be one of %s" %
+        ", ".join(FORMATS))
+  return v
+
+def validate_outfile(v):
+  try:
+    STORE.path(v)
+  except InvalidName as e:
+    raise ValidationError("Output file needs to be a plain file name")
+  return v
+
+
+def parse_args(argv):
+  options = {}
   try:
     opts, args = getopt(
       argv[1:],
-      "r:s:o:",
-      ["repository=", "shell_size=", "ofile="]
+      "r:s:o:j:f:p:P:t:d:",
+      ["repository=", "shell_size=", "ofile=", "jobs=", "format=", "progress=",
+       "prefilter", "previous=", "timeout=", "deadline="]
     )
   except (GetoptError, IndexError) as e:
     raise ValidationError("Invalid script invocation: %s" % e)
 
   for o, v in opts:
     if o in ("-r", "--repository"):
-      rp = os.path.normpath(v)
-      repo_path = os.path.normpath("%s/%s" % (REPODIR, rp))
-      if os.path.exists(repo_path):
-        repo = rp
-      else:
-        raise ValidationError("Provided repository (%s) does not exist" % rp)
+      options["repo"] = v
     elif o in ("-s", "--shell_size"):
-      try:
-        shell = int(v)
-        if shell < 1:
-          raise ValidationError("Shell size needs to be a positive integer")
-      except ValueError as e:
-        raise ValidationError("Shell size needs to be an integer")
+      options["shell"] = v
     elif o in ("-o", "--ofile"):
-      op = os.path.normpath("%s/%s" % (SAVEDIR, v))
-      dir, _ = os.path.split(op)
-      if os.path.exists(dir):
-        outfile = v
-      else:
-        raise ValidationError("Output folder does not exist")
+      options["outfile"] = v
+    elif o in ("-j", "--jobs"):
+      options["jobs"] = v
+    elif o in ("-f", "--format"):
+      options["off_format"] = v
+    elif o in ("-p", "--progress"):
+      options["progress"] = v
+    elif o == "--prefilter":
+      options["prefilter"] = True
+    elif o in ("-P", "--previous"):
+      options["previous"] = v
+    elif o in ("-t", "--timeout"):
+      options["budget"] = validate_seconds(v)
+    elif o in ("-d", "--deadline"):
+      options["deadline"] = time() + validate_seconds(v)
 
-  try:
-    data = args[0]
-    jd = json.loads(data)
-  except IndexError as e:
+  # Large queries can be piped in, as they may not fit on the command line
+  options["data"] = read_argument(args)
+  if len(options["data"].strip()) == 0:
     raise ValidationError("Invalid script invocation: JSON query not set")
-  except ValueError as e:
+
+  return options
+
+def parse_query(data):
+  """Returns the query of a molecule, given as a Query or as JSON text."""
+  try:
+    query = as_query(data)
+  except QueryError as e:
     raise ValidationError("JSON query is invalid: %s" % e)
+  if query.molecule is None:
+    raise ValidationError("JSON query has no molecule")
+  return query
 
-  lgf = molecule_to_lgf(jd["molecule"])
-  atom_ids = map(lambda a: a["id"], jd["molecule"]["atoms"])
+def generate(data, repo=None, shell=None, outfile=None, jobs=None,
+    off_format=None, progress=None, prefilter=False, previous=None,
+    deadline=None, budget=None):
+  repo = validate_repository(repo) if repo else DEFAULT_REPO
+  shell = validate_shell_size(shell) if shell else DEFAULT_SHELL_SIZE
+  outfile = validate_outfile(outfile) if outfile else None
+  previous = validate_outfile(previous) if previous else None
+  jobs = validate_jobs(jobs) if jobs else DEFAULT_JOBS
+  off_format = validate_format(off_format) if off_format else DEFAULT_FORMAT
 
-  out = generate_fragments(lgf, repo, shell, outfile, atom_ids)
-  print json.dumps(out, default=lambda o: o.__dict__)
+  timings = Timings()
+  with timings.span("parse"):
+    query = parse_query(data)
+    molecule = query.molecule
 
+  with timings.span("lgf"):
+    graph = molecule_graph.from_molecule(molecule)
+    lgf = graph.to_lgf()
+  atom_ids = graph.ids
 
-if __name__ == "__main__":
+  with timings.span("digest"):
+    repo_digest = CATALOG.digest(repo)
+    build = build_id()
+  progress = progress_writer(progress) if progress else None
+  limits = Limits(deadline, budget)
+  ack = None
+  if previous:
+    ack = regenerate_fragments(
+      molecule, previous, repo, shell, outfile, repo_digest, build,
+      jobs, off_format, progress, prefilter, timings, limits
+    )
+  if ack is None:
+    ack = generate_fragments(
+      lgf, repo, shell, outfile, atom_ids, jobs, off_format, progress,
+      prefilter, timings, limits
+    )
+  with timings.span("manifest"):
+    manifest.record(
+      ack['off'], repo, shell, repo_digest, build, query.text,
+      ack.get('skipped')
+    )
+  ack['timings'] = timings.report()
+  return ack
+
+def generate_batch(molecules, repo=None, shell=None, outfiles=None, jobs=None,
+    off_format=None, prefilter=False, deadline=None, budget=None):
+  repo = validate_repository(repo) if repo else DEFAULT_REPO
+  shell = validate_shell_size(shell) if shell else DEFAULT_SHELL_SIZE
+  jobs = validate_jobs(jobs) if jobs else DEFAULT_JOBS
+  off_format = validate_format(off_format) if off_format else DEFAULT_FORMAT
+
+  timings = Timings()
+  queries = []
+  for i, molecule in enumerate(molecules):
+    outfile = None
+    if outfiles and outfiles[i]:
+      outfile = validate_outfile(outfiles[i])
+    with timings.span("lgf"):
+      graph = molecule_graph.from_molecule(molecule)
+      queries.append((graph.to_lgf(), outfile, graph.ids))
+
+  with timings.span("digest"):
+    repo_digest = CATALOG.digest(repo)
+    build = build_id()
+  acks = generate_batch_fragments(
+    queries, repo, shell, jobs, off_format, prefilter, timings,
+    Limits(deadline, budget)
+  )
+  with timings.span("manifest"):
+    for molecule, ack in zip(molecules, acks):
+      manifest.record(
+        ack['off'], repo, shell, repo_digest, build,
+        json.dumps({'molecule': molecule}), ack.get('skipped')
+      )
+  return {'results': acks, 'timings': timings.report()}
+
+def generate_shells(data, repo=None, shells=None, outfiles=None, jobs=None,
+    off_format=None, progress=None, prefilter=False, deadline=None, budget=None):
+  repo = validate_repository(repo) if repo else DEFAULT_REPO
+  shells = validate_shell_sizes(shells) if shells else [DEFAULT_SHELL_SIZE]
+  jobs = validate_jobs(jobs) if jobs else DEFAULT_JOBS
+  off_format = validate_format(off_format) if off_format else DEFAULT_FORMAT
+  outfiles = map(
+    lambda s: validate_outfile(outfiles[s]) if outfiles and outfiles.get(s)
+        else None,
+    shells
+  )
+
+  timings = Timings()
+  with timings.span("parse"):
+    query = parse_query(data)
+    molecule = query.molecule
+
+  with timings.span("lgf"):
+    graph = molecule_graph.from_molecule(molecule)
+    lgf = graph.to_lgf()
+  atom_ids = graph.ids
+
+  with timings.span("digest"):
+    repo_digest = CATALOG.digest(repo)
+    build = build_id()
+  acks = generate_shell_fragments(
+    lgf, repo, shells, outfiles, atom_ids, jobs, off_format,
+    progress_writer(progress) if progress else None, prefilter, timings,
+    Limits(deadline, budget)
+  )
+  with timings.span("manifest"):
+    for shell, ack in zip(shells, acks):
+      manifest.record(
+        ack['off'], repo, shell, repo_digest, build, query.text,
+        ack.get('skipped')
+      )
+  return {
+    'results': dict((str(s), ack) for s, ack in zip(shells, acks)),
+    'timings': timings.report()
+  }
+
+def run(**options):
   try:
-    main(sys.argv)
+    return generate(**options)
   except Exception as e:
-    print json.dumps({"error": "Invalid query: %s" % e})
+    return {"error": "Invalid query: %s" % e}
+
+def run_batch(**options):
+  try:
+    return generate_batch(**options)
+  except Exception as e:
+    return {"error": "Invalid query: %s" % e}
+
+def run_shells(**options):
+  try:
+    return generate_shells(**options)
+  except Exception as e:
+    return {"error": "Invalid query: %s" % e}
+
+
+def main(argv):
+  try:
+    options = parse_args(argv)
+    shells = validate_shell_sizes(options.get("shell", DEFAULT_SHELL_SIZE))
+    if len(shells) == 1:
+      options["shell"] = shells[0]
+      out = run(**options)
+    elif "outfile" in options or "previous" in options:
+      raise ValidationError(
+        "Output and previous files cannot be set for several shell sizes"
+      )
+    else:
+      options["shells"] = options.pop("shell")
+      out = run_shells(**options)
+  except ValidationError as e:
+    out = {"error": "Invalid query: %s" % e}
+  print json.dumps(out, default=lambda o: o.__dict__)
+
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,259 @@
+"""
+Sharded store of fragment files.
+
+Files are spread over two levels of subdirectories named after the hash of
+their name, so that no directory grows large. A file is written to a
+temporary file next to its final path and renamed into place once complete,
+so readers never see a partial file. The size, last access time and access
+count of every file are kept in a small SQLite index next to the store; when
+the store outgrows its byte or entry budget, the least recently (lru) or
+least frequently (lfu) used files are evicted.
+"""
+from contextlib import closing, contextmanager
+import errno
+from hashlib import sha1
+import os
+import sqlite3
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+import manifest
+
+
+STOREDIR = "%s/fragments" % os.path.dirname(os.path.abspath(__file__))
+INDEX = "store.sqlite"
+TIMEOUT = 30
+# Accesses are counted in memory and written to the index at most this often
+TOUCH_INTERVAL = 10
+POLICIES = ("lru", "lfu")
+EXTENSIONS = (".off", ".key", ".stats")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+  name TEXT PRIMARY KEY,
+  size INTEGER NOT NULL,
+  accessed REAL NOT NULL,
+  hits INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+class InvalidName(Exception):
+  pass
+
+
+def new_name(ext=".off"):
+  return "%s%s" % (uuid4().hex, ext)
+
+def make_parent(path):
+  dir = os.path.dirname(path)
+  if not os.path.isdir(dir):
+    try:
+      os.makedirs(dir)
+    except OSError:
+      pass
+  return dir
+
+
+class FragmentStore:
+  def __init__(self, root, max_bytes=None, max_entries=None, policy="lru",
+      on_evict=None):
+    self.root = root
+    self.on_evict = on_evict
+    self.configure(max_bytes, max_entries, policy)
+    self._pending = {}
+    self._flushed = time()
+    self._lock = Lock()
+
+  def configure(self, max_bytes=None, max_entries=None, policy="lru"):
+    """Sets the budget of the store; None means unbounded."""
+    if not policy in POLICIES:
+      raise ValueError("Eviction policy needs to be one of %s" %
+          ", ".join(POLICIES))
+    self.max_bytes = max_bytes
+    self.max_entries = max_entries
+    self.policy = policy
+
+  def _connect(self):
+    conn = sqlite3.connect("%s/%s" % (self.root, INDEX), timeout=TIMEOUT)
+    conn.execute(SCHEMA)
+    return conn
+
+  def path(self, name):
+    if not name or os.path.basename(name) != name or name.startswith("."):
+      raise InvalidName("Invalid fragment file name: %s" % name)
+    digest = sha1(name).hexdigest()
+    return "%s/%s/%s/%s" % (self.root, digest[:2], digest[2:4], name)
+
+  def exists(self, name):
+    try:
+      return os.path.isfile(self.path(name))
+    except InvalidName:
+      return False
+
+  @contextmanager
+  def write(self, name):
+    """
+    Yields a temporary path to write `name` to, and moves the file into place
+    when the block completes.
+    """
+    path = self.path(name)
+    dir = make_parent(path)
+    fd, tmp = mkstemp(dir=dir, suffix=".tmp")
+    os.close(fd)
+    os.chmod(tmp, 0644)
+    try:
+      yield tmp
+      os.rename(tmp, path)
+    except:
+      try:
+        os.remove(tmp)
+      except OSError:
+        pass
+      raise
+    self._add(name, os.path.getsize(path))
+
+  def _add(self, name, size):
+    with closing(self._connect()) as conn:
+      with conn:
+        conn.execute(
+          "INSERT OR REPLACE INTO files (name, size, accessed) VALUES (?, ?, ?)",
+          (name, size, time())
+        )
+    self.evict(keep=(name,))
+
+  def touch(self, name):
+    with self._lock:
+      self._pending[name] = self._pending.get(name, 0) + 1
+      due = time() - self._flushed >= TOUCH_INTERVAL
+    if due:
+      self.flush()
+
+  def flush(self):
+    with self._lock:
+      pending, self._pending = self._pending, {}
+      self._flushed = time()
+    if len(pending) == 0:
+      return
+
+    now = time()
+    with closing(self._connect()) as conn:
+      with conn:
+        conn.executemany(
+          "UPDATE files SET accessed = ?, hits = hits + ? WHERE name = ?",
+          map(lambda p: (now, p[1], p[0]), pending.items())
+        )
+
+  def _over_budget(self, count, size):
+    return (self.max_entries is not None and count > self.max_entries) or \
+        (self.max_bytes is not None and size > self.max_bytes)
+
+  def evict(self, keep=()):
+    """Removes files until the store is within budget; returns their names."""
+    if self.max_bytes is None and self.max_entries is None:
+      return []
+
+    self.flush()
+    order = "accessed" if self.policy == "lru" else "hits, accessed"
+    victims = []
+    with closing(self._connect()) as conn:
+      with conn:
+        count, size = conn.execute(
+          "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files"
+        ).fetchone()
+        if not self._over_budget(count, size):
+          return []
+
+        for name, file_size in conn.execute(
+            "SELECT name, size FROM files ORDER BY %s" % order):
+          if not self._over_budget(count, size):
+            break
+          if name in keep:
+            continue
+          victims.append(name)
+          count -= 1
+          size -= file_size
+        conn.executemany(
+          "DELETE FROM files WHERE name = ?", map(lambda n: (n,), victims)
+        )
+
+    self._unlink(victims)
+    if self.on_evict and len(victims) > 0:
+      self.on_evict(victims)
+    return victims
+
+  def rename(self, src, dst):
+    path = self.path(dst)
+    make_parent(path)
+    os.rename(self.path(src), path)
+    with closing(self._connect()) as conn:
+      with conn:
+        conn.execute(
+          "UPDATE OR REPLACE files SET name = ? WHERE name = ?", (dst, src)
+        )
+
+  def remove(self, names):
+    with closing(self._connect()) as conn:
+      with conn:
+        conn.executemany(
+          "DELETE FROM files WHERE name = ?", map(lambda n: (n,), names)
+        )
+    self._unlink(names)
+
+  def _unlink(self, names):
+    for name in names:
+      try:
+        os.remove(self.path(name))
+      except (OSError, InvalidName):
+        pass
+
+  def names(self):
+    """Yields the name of every file in the store."""
+    for dir, _, files in os.walk(self.root):
+      if dir == self.root:
+        continue
+      for file in files:
+        if os.path.splitext(file)[1] in EXTENSIONS:
+          yield file
+
+  def migrate(self):
+    """
+    Moves files of the old, flat layout into their shards and returns their
+    names. Files another process moves or removes meanwhile are skipped.
+    """
+    moved = []
+    for file in os.listdir(self.root):
+      src = "%s/%s" % (self.root, file)
+      if not os.path.splitext(file)[1] in EXTENSIONS or \
+          not os.path.isfile(src):
+        continue
+      dst = self.path(file)
+      make_parent(dst)
+      try:
+        os.rename(src, dst)
+        size = os.path.getsize(dst)
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+        continue
+      self._add(file, size)
+      moved.append(file)
+    return moved
+
+  def stats(self):
+    with closing(self._connect()) as conn:
+      count, size = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files"
+      ).fetchone()
+    return {
+      'entries': count,
+      'bytes': size,
+      'max_entries': self.max_entries,
+      'max_bytes': self.max_bytes,
+      'policy': self.policy
+    }
+
+
+STORE = FragmentStore(STOREDIR, on_evict=manifest.remove)
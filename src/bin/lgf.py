@@ -0,0 +1,47 @@
+"""
+Minimal reader for LEMON graph format (.lgf) molecule files.
+"""
+
+
+class FormatError(Exception):
+  pass
+
+
+def parse_lgf(text):
+  """
+  Returns the atoms of an LGF document as a list of {column: value} dicts and
+  its bonds as a list of (label, label) tuples.
+  """
+  atoms = []
+  bonds = []
+  section = None
+  header = None
+  for line in text.splitlines():
+    if len(line.strip()) == 0:
+      continue
+    if line.startswith("@"):
+      section = line.strip()
+      header = None
+      continue
+
+    fields = line.rstrip("\n").split("\t")
+    if section == "@nodes":
+      if header is None:
+        header = fields
+      else:
+        atoms.append(dict(zip(header, fields)))
+    elif section == "@edges":
+      if header is None:
+        header = fields
+      elif len(fields) < 2:
+        raise FormatError("Invalid edge: %s" % line)
+      else:
+        bonds.append((fields[0], fields[1]))
+
+  if len(atoms) > 0 and not "label" in atoms[0]:
+    raise FormatError("Nodes have no label column")
+  return atoms, bonds
+
+def read_lgf(path):
+  with open(path, 'r') as fp:
+    return parse_lgf(fp.read())
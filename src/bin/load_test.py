@@ -0,0 +1,252 @@
+#!/usr/bin/python
+"""
+Load test of a running OMFraF instance.
+
+Drives /repos/, /generate/ and /load/ at a given concurrency and request mix
+for a given duration, and reports the throughput, latency percentiles and
+error rate of every endpoint as JSON. A request counts as an error when it
+fails, does not return 200 or returns an 'error' field.
+
+To run everything locally, fill a repository with synthetic molecules and
+start the server with the fake matcher:
+
+  bin/load_test.py --make-repo /tmp/repos/bench -R 50
+  OMFRAF_REPODIR=/tmp/repos OMFRAF_GENERATOR=bin/fake_fragments.py \\
+      FAKE_FRAGMENTS_LATENCY=0.05 python manage.py runserver
+  bin/load_test.py -r bench -c 16 -d 60 -m repos:1,generate:2,load:7
+"""
+from getopt import getopt, GetoptError
+import json
+import os
+import random
+import sys
+from threading import Lock, Thread
+from time import time
+from urllib import urlencode
+import urllib2
+
+from benchmark import random_molecule
+import fragment_generator
+
+
+DEFAULTS = {
+  'url': "http://127.0.0.1:8000",
+  'repo': "lipids",
+  'concurrency': 8,
+  'duration': 30.0,
+  'mix': "repos:1,generate:2,load:7",
+  'new': 0.1,
+  'atoms': 40,
+  'seed': 1,
+  'timeout': 600.0
+}
+ENDPOINTS = ("repos", "generate", "load")
+
+
+class LoadTestError(Exception):
+  pass
+
+
+def parse_mix(v):
+  mix = []
+  try:
+    for part in v.split(","):
+      endpoint, weight = part.split(":")
+      if not endpoint in ENDPOINTS:
+        raise LoadTestError("Unknown endpoint: %s" % endpoint)
+      mix.append((endpoint, float(weight)))
+  except ValueError:
+    raise LoadTestError("Request mix needs to look like repos:1,load:9")
+  return mix
+
+def percentile(values, p):
+  if len(values) == 0:
+    return None
+  return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class LoadTest:
+  def __init__(self, options):
+    self.options = options
+    self.mix = parse_mix(options['mix'])
+    self.rng = random.Random(options['seed'])
+    self.molecules = map(
+      lambda _: random_molecule(options['atoms'], self.rng), range(10)
+    )
+    self.off = None
+    self.samples = dict((e, []) for e in ENDPOINTS)
+    self.errors = dict((e, 0) for e in ENDPOINTS)
+    self._lock = Lock()
+
+  def request(self, path, params=None):
+    """Returns the latency in ms and the response, or None if it failed."""
+    url = "%s/%s/" % (self.options['url'].rstrip("/"), path)
+    data = urlencode(params) if params is not None else None
+    start = time()
+    try:
+      response = json.loads(
+        urllib2.urlopen(url, data, self.options['timeout']).read()
+      )
+    except (urllib2.URLError, IOError, ValueError):
+      response = None
+    return (time() - start) * 1000, response
+
+  def generate_params(self, rng):
+    if rng.random() < self.options['new']:
+      molecule = random_molecule(self.options['atoms'], rng)
+    else:
+      molecule = rng.choice(self.molecules)
+    return {
+      'data': json.dumps({'molecule': molecule}),
+      'repo': self.options['repo']
+    }
+
+  def load_params(self, rng):
+    atom = rng.choice(self.molecules[0]['atoms'])
+    return {'data': json.dumps({'off': self.off, 'needle': [atom['id']]})}
+
+  def prepare(self):
+    _, ack = self.request(
+      "generate", {
+        'data': json.dumps({'molecule': self.molecules[0]}),
+        'repo': self.options['repo']
+      }
+    )
+    if ack is None or not 'off' in ack:
+      raise LoadTestError("Could not generate fragments to load: %s" % ack)
+    self.off = ack['off']
+
+  def work(self, seed, deadline):
+    rng = random.Random(seed)
+    total = sum(w for _, w in self.mix)
+    while time() < deadline:
+      pick = rng.random() * total
+      for endpoint, weight in self.mix:
+        pick -= weight
+        if pick < 0:
+          break
+
+      if endpoint == "repos":
+        latency, response = self.request("repos")
+      elif endpoint == "generate":
+        latency, response = self.request("generate", self.generate_params(rng))
+      else:
+        latency, response = self.request("load", self.load_params(rng))
+
+      with self._lock:
+        self.samples[endpoint].append(latency)
+        if response is None or 'error' in response:
+          self.errors[endpoint] += 1
+
+  def run(self):
+    self.prepare()
+    start = time()
+    deadline = start + self.options['duration']
+    threads = map(
+      lambda i: Thread(target=self.work, args=(self.options['seed'] + i,
+                                                deadline)),
+      range(self.options['concurrency'])
+    )
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return self.report(time() - start)
+
+  def report(self, elapsed):
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+      samples = sorted(self.samples[endpoint])
+      if len(samples) == 0:
+        continue
+      endpoints[endpoint] = {
+        'requests': len(samples),
+        'errors': self.errors[endpoint],
+        'error_rate': float(self.errors[endpoint]) / len(samples),
+        'throughput': len(samples) / elapsed,
+        'mean': sum(samples) / len(samples),
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99),
+        'max': samples[-1]
+      }
+    requests = sum(e['requests'] for e in endpoints.values())
+    return {
+      'parameters': self.options,
+      'elapsed': elapsed,
+      'throughput': requests / elapsed,
+      'endpoints': endpoints
+    }
+
+
+def make_repository(path, count, atoms, seed):
+  rng = random.Random(seed)
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  for i in range(count):
+    with open("%s/%s.lgf" % (path, i + 1), 'w') as fp:
+      fp.write(fragment_generator.molecule_to_lgf(random_molecule(atoms, rng)))
+
+def parse_args(argv):
+  options = dict(DEFAULTS)
+  try:
+    opts, args = getopt(
+      argv[1:],
+      "u:r:c:d:m:N:a:s:R:",
+      ["url=", "repo=", "concurrency=", "duration=", "mix=", "new=",
+       "atoms=", "seed=", "timeout=", "make-repo=", "repo-size="]
+    )
+  except GetoptError as e:
+    raise LoadTestError("Invalid script invocation: %s" % e)
+
+  try:
+    for o, v in opts:
+      if o in ("-u", "--url"):
+        options["url"] = v
+      elif o in ("-r", "--repo"):
+        options["repo"] = v
+      elif o in ("-c", "--concurrency"):
+        options["concurrency"] = int(v)
+      elif o in ("-d", "--duration"):
+        options["duration"] = float(v)
+      elif o in ("-m", "--mix"):
+        parse_mix(v)
+        options["mix"] = v
+      elif o in ("-N", "--new"):
+        options["new"] = float(v)
+      elif o in ("-a", "--atoms"):
+        options["atoms"] = int(v)
+      elif o in ("-s", "--seed"):
+        options["seed"] = int(v)
+      elif o == "--timeout":
+        options["timeout"] = float(v)
+      elif o == "--make-repo":
+        options["make_repo"] = v
+      elif o in ("-R", "--repo-size"):
+        options["repo_size"] = int(v)
+  except ValueError as e:
+    raise LoadTestError("Invalid option value: %s" % e)
+  return options
+
+def main(argv):
+  try:
+    options = parse_args(argv)
+    if "make_repo" in options:
+      make_repository(
+        options["make_repo"], options.get("repo_size", 20), options["atoms"],
+        options["seed"]
+      )
+      return 0
+    options.pop("repo_size", None)
+    report = LoadTest(options).run()
+  except LoadTestError as e:
+    print json.dumps({'error': e.message})
+    return 2
+
+  print json.dumps(report, indent=2, sort_keys=True)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
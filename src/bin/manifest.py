@@ -0,0 +1,130 @@
+"""
+Manifest of stored .off files.
+
+Every generated .off file is recorded with the repository it was generated
+from, the digest of that repository's content and the id of the matcher
+build, so that an update only has to throw away what it actually made stale.
+Files that left out molecules which ran out of time are recorded with the
+ids of those molecules, so that they are never taken as complete. The
+manifest is a small SQLite database next to the fragment files.
+"""
+from contextlib import closing
+import json
+import os
+import sqlite3
+from time import time
+
+
+MANIFEST = "%s/fragments/manifest.sqlite" % \
+    os.path.dirname(os.path.abspath(__file__))
+TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS offs (
+  name TEXT PRIMARY KEY,
+  repo TEXT NOT NULL,
+  shell TEXT NOT NULL,
+  repo_digest TEXT,
+  build_id TEXT,
+  query TEXT,
+  created REAL NOT NULL,
+  requests INTEGER NOT NULL DEFAULT 0,
+  skipped TEXT
+)
+"""
+# Columns added since the first version of the table
+ADDED_COLUMNS = [("skipped", "TEXT")]
+
+
+def connect():
+  conn = sqlite3.connect(MANIFEST, timeout=TIMEOUT)
+  conn.execute(SCHEMA)
+  columns = set(map(lambda c: c[1], conn.execute("PRAGMA table_info(offs)")))
+  for column, decl in ADDED_COLUMNS:
+    if not column in columns:
+      try:
+        conn.execute("ALTER TABLE offs ADD COLUMN %s %s" % (column, decl))
+      except sqlite3.OperationalError:
+        # Another process added it first
+        pass
+  return conn
+
+
+def record(name, repo, shell, repo_digest, build_id, query=None,
+    skipped=None):
+  """`skipped` are the molecules a partial file left out, None if complete."""
+  if skipped is not None:
+    skipped = json.dumps(skipped)
+  with closing(connect()) as conn:
+    with conn:
+      conn.execute(
+        "INSERT OR REPLACE INTO offs "
+        "(name, repo, shell, repo_digest, build_id, query, created, skipped) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (name, repo, str(shell), repo_digest, build_id, query, time(), skipped)
+      )
+
+def copy(src, dst, query=None):
+  """Records `dst` as generated with the same repository and build as `src`."""
+  with closing(connect()) as conn:
+    with conn:
+      conn.execute(
+        "INSERT OR REPLACE INTO offs "
+        "(name, repo, shell, repo_digest, build_id, query, created, skipped) "
+        "SELECT ?, repo, shell, repo_digest, build_id, ?, ?, skipped "
+        "FROM offs WHERE name = ?",
+        (dst, query, time(), src)
+      )
+
+def touch(name):
+  with closing(connect()) as conn:
+    with conn:
+      conn.execute(
+        "UPDATE offs SET requests = requests + 1 WHERE name = ?", (name,)
+      )
+
+def entry(name):
+  with closing(connect()) as conn:
+    return conn.execute(
+      "SELECT name, repo, shell, repo_digest, build_id, query, requests "
+      "FROM offs WHERE name = ?", (name,)
+    ).fetchone()
+
+def skipped(name):
+  """
+  Returns the molecules the partial file `name` left out, or None if it is
+  complete or unknown.
+  """
+  with closing(connect()) as conn:
+    row = conn.execute(
+      "SELECT skipped FROM offs WHERE name = ?", (name,)
+    ).fetchone()
+  if row is None or row[0] is None:
+    return None
+  return json.loads(row[0])
+
+def entries():
+  with closing(connect()) as conn:
+    return conn.execute(
+      "SELECT name, repo, shell, repo_digest, build_id, query, requests "
+      "FROM offs"
+    ).fetchall()
+
+def remove(names):
+  with closing(connect()) as conn:
+    with conn:
+      conn.executemany(
+        "DELETE FROM offs WHERE name = ?", map(lambda n: (n,), names)
+      )
+
+
+def stale_entries(repo_digests, build_id):
+  """
+  Returns the entries that were generated with another matcher build or from
+  a repository whose content changed since, most requested first.
+  """
+  stale = filter(
+    lambda e: e[4] != build_id or repo_digests.get(e[1]) != e[3],
+    entries()
+  )
+  return sorted(stale, key=(lambda e: e[6]), reverse=True)
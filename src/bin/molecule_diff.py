@@ -0,0 +1,63 @@
+"""
+Differences between two versions of a molecule.
+
+Atoms are matched by id. An atom is changed when it was added, removed or
+given another atom type, or when a bond to it was added or removed. The
+fragments of an atom only depend on the atoms within `shell` bonds of it, so
+after an edit only the atoms within `shell` bonds of a changed atom need to
+be matched again.
+"""
+
+
+def bond_set(molecule):
+  return set(frozenset((b["a1"], b["a2"])) for b in molecule["bonds"])
+
+def changed_atoms(old, new):
+  old_types = dict((a["id"], a["type"]) for a in old["atoms"])
+  new_types = dict((a["id"], a["type"]) for a in new["atoms"])
+  changed = set(old_types) ^ set(new_types)
+  for aid in set(old_types) & set(new_types):
+    if old_types[aid] != new_types[aid]:
+      changed.add(aid)
+  for bond in bond_set(old) ^ bond_set(new):
+    changed.update(bond)
+  return changed
+
+def within(bonds, sources, distance):
+  """Returns the atoms at most `distance` bonds away from `sources`."""
+  neighbours = {}
+  for bond in bonds:
+    # Sets of one atom are bonds of an atom to itself
+    ends = tuple(bond)
+    a1, a2 = ends[0], ends[-1]
+    neighbours.setdefault(a1, set()).add(a2)
+    neighbours.setdefault(a2, set()).add(a1)
+
+  reached = set(sources)
+  frontier = set(sources)
+  for _ in range(distance):
+    frontier = set(
+      n for aid in frontier for n in neighbours.get(aid, ())
+    ) - reached
+    if len(frontier) == 0:
+      break
+    reached.update(frontier)
+  return reached
+
+def affected_atoms(old, new, shell):
+  """
+  Returns the atoms of either version within `shell` bonds of a changed atom,
+  in the old or the new bonds.
+  """
+  return within(
+    bond_set(old) | bond_set(new), changed_atoms(old, new), shell
+  )
+
+def submolecule(molecule, atoms):
+  """Returns the part of `molecule` made up of `atoms` and their bonds."""
+  return {
+    'atoms': filter(lambda a: a["id"] in atoms, molecule["atoms"]),
+    'bonds': filter(
+      lambda b: b["a1"] in atoms and b["a2"] in atoms, molecule["bonds"]
+    )
+  }
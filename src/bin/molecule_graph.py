@@ -0,0 +1,116 @@
+"""
+Compact molecule graphs.
+
+The atoms of a molecule are numbered 0 to n - 1 in input order. Their ids and
+types are kept in lists, and their bonds as neighbour lists in compressed
+sparse row form, built on first use: the neighbours of atom v are the slice
+adjacency[offsets[v]:offsets[v + 1]] of two flat integer arrays. Building a
+graph, looking up the neighbours or hydrogens of an atom and writing the
+graph as LGF all take time linear in the size of the molecule (or of the
+answer), so that molecules of tens of thousands of atoms stay cheap.
+"""
+from array import array
+from itertools import count, izip
+
+
+HYDROGEN = 20
+
+LGF_NODES = "@nodes\n" \
+    "partial_charge\tlabel\tlabel2\tatomType\tcoordX\tcoordY\tcoordZ\t" \
+    "initColor\t\n"
+LGF_EDGES = "@edges\n\t\tlabel\n"
+
+
+class MoleculeGraph:
+  def __init__(self, ids, types, bonds, index=None):
+    """`bonds` are (v, w) pairs of atom numbers."""
+    self.ids = ids
+    self.types = types
+    self.bonds = bonds
+    self._index = index
+    self._offsets = None
+    self._adjacency = None
+
+  def _build(self):
+    """Lays out the neighbour lists, on the first neighbour lookup."""
+    offsets = array('i', [0]) * (len(self.ids) + 1)
+    for v, w in self.bonds:
+      offsets[v + 1] += 1
+      offsets[w + 1] += 1
+    for v in xrange(len(self.ids)):
+      offsets[v + 1] += offsets[v]
+
+    fill = offsets[:-1]
+    adjacency = array('i', [0]) * offsets[-1]
+    for v, w in self.bonds:
+      adjacency[fill[v]] = w
+      fill[v] += 1
+      adjacency[fill[w]] = v
+      fill[w] += 1
+    self._offsets = offsets
+    self._adjacency = adjacency
+
+  def __len__(self):
+    return len(self.ids)
+
+  def index(self, aid):
+    """Returns the number of the atom with id `aid`."""
+    if self._index is None:
+      self._index = dict(izip(self.ids, count()))
+    return self._index[aid]
+
+  def neighbours(self, v):
+    if self._adjacency is None:
+      self._build()
+    return self._adjacency[self._offsets[v]:self._offsets[v + 1]]
+
+  def degree(self, v):
+    if self._offsets is None:
+      self._build()
+    return self._offsets[v + 1] - self._offsets[v]
+
+  def hydrogens(self, v):
+    """Returns the numbers of the hydrogens bonded to atom v."""
+    types = self.types
+    return [w for w in self.neighbours(v) if types[w] == HYDROGEN]
+
+  def heavy_atoms(self):
+    types = self.types
+    return [v for v in xrange(len(types)) if types[v] != HYDROGEN]
+
+  def to_lgf(self):
+    """Returns the graph as LGF, with the atom ids as labels."""
+    ids = self.ids
+    return "".join([
+      LGF_NODES,
+      "".join(["0\t%s\tX\t%s\t0\t0\t0\t0\t\n" % a
+               for a in izip(ids, self.types)]),
+      LGF_EDGES,
+      "".join(["%s\t%s\t%s\t\n" % (ids[v], ids[w], i)
+               for i, (v, w) in enumerate(self.bonds)])
+    ])
+
+
+def from_molecule(molecule):
+  """Returns the graph of a molecule of {atoms: [{id, type}], bonds: [...]}."""
+  atoms = molecule["atoms"]
+  ids = [a["id"] for a in atoms]
+  index = dict(izip(ids, count()))
+  bonds = [(index[b["a1"]], index[b["a2"]]) for b in molecule["bonds"]]
+  return MoleculeGraph(ids, [a["type"] for a in atoms], bonds, index)
+
+def from_lgf(atoms, bonds):
+  """
+  Returns the graph of the atoms and bonds of lgf.parse_lgf, with the labels
+  as ids and the atomType columns as types. Bonds to unknown labels are left
+  out.
+  """
+  ids = [a["label"] for a in atoms]
+  index = dict(izip(ids, count()))
+  return MoleculeGraph(
+    ids,
+    [a.get("atomType", "") for a in atoms],
+    [(index[a1], index[a2]) for a1, a2 in bonds
+     if a1 in index and a2 in index],
+    index
+  )
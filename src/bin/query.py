@@ -0,0 +1,86 @@
+"""
+Queries of the fragment generator and finder.
+
+A query is parsed from its JSON text and validated once, where it enters the
+web application or a script, and is then handed on as a Query: in-process to
+the finder, and through the worker pool's pipe to the generator. Molecules
+are checked for the atoms and bonds the generator needs. The JSON text is
+kept for the manifest, lock names and logs.
+"""
+import json
+import sys
+
+
+class QueryError(Exception):
+  pass
+
+
+class Query:
+  def __init__(self, data, text=None):
+    if not isinstance(data, dict):
+      raise QueryError("Query data needs to be a JSON object")
+    if "molecule" in data:
+      check_molecule(data["molecule"])
+    if "molecules" in data:
+      if not isinstance(data["molecules"], list):
+        raise QueryError("Molecules need to be a list")
+      for md in data["molecules"]:
+        check_molecule(md)
+    self.data = data
+    self._text = text
+
+  @property
+  def text(self):
+    if self._text is None:
+      self._text = json.dumps(self.data)
+    return self._text
+
+  @property
+  def molecule(self):
+    return self.data.get("molecule")
+
+
+def parse(text):
+  try:
+    data = json.loads(text)
+  except (TypeError, ValueError) as e:
+    raise QueryError("Query data not in JSON format (%s)" % e)
+  return Query(data, text)
+
+def as_query(value):
+  """Returns `value` if it is a Query already, and parses it otherwise."""
+  if isinstance(value, Query):
+    return value
+  return parse(value)
+
+def check_molecule(md):
+  if not isinstance(md, dict):
+    raise QueryError("Molecule needs to be a JSON object")
+  atoms = md.get("atoms")
+  bonds = md.get("bonds")
+  if not isinstance(atoms, list) or not isinstance(bonds, list):
+    raise QueryError("Molecule needs lists of atoms and bonds")
+
+  if "molid" in md and not isinstance(md["molid"], basestring):
+    raise QueryError("Molecule id needs to be a string")
+
+  ids = set()
+  for atom in atoms:
+    if not isinstance(atom, dict) or not "id" in atom or not "type" in atom:
+      raise QueryError("Atoms need an id and a type")
+    if not isinstance(atom["id"], (int, long, basestring)):
+      raise QueryError("Atom ids need to be numbers or strings")
+    ids.add(atom["id"])
+  for bond in bonds:
+    try:
+      joined = bond["a1"] in ids and bond["a2"] in ids
+    except (KeyError, TypeError):
+      joined = False
+    if not joined:
+      raise QueryError("Bonds need to join two atoms of the molecule")
+
+def read_argument(args):
+  """Returns the first argument, or standard input if it is missing or -."""
+  if len(args) == 0 or args[0] == "-":
+    return sys.stdin.read()
+  return args[0]
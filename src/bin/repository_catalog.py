@@ -0,0 +1,125 @@
+"""
+In-memory catalog of the fragment repositories.
+
+The catalog lists the .lgf files of every repository together with their
+atom counts and sizes. A repository is only rescanned when the mtime of its
+directory changes, and a file is only re-read when its own mtime or size
+changes, so most lookups cost a couple of stat calls.
+"""
+from hashlib import sha1
+import os
+from threading import Lock
+
+import lgf
+
+
+class RepositoryCatalog:
+  def __init__(self, repodir):
+    self.repodir = repodir
+    self._mtime = None
+    self._repos = {}
+    self._files = {}
+    self._digests = {}
+    self._lock = Lock()
+
+  def refresh(self):
+    with self._lock:
+      try:
+        mtime = os.stat(self.repodir).st_mtime
+      except OSError:
+        self._mtime = None
+        self._repos = {}
+        return self._repos
+
+      if mtime != self._mtime:
+        names = filter(
+          lambda d: os.path.isdir("%s/%s" % (self.repodir, d)),
+          os.listdir(self.repodir)
+        )
+        self._repos = dict(
+          (name, self._repos.get(name, (None, []))) for name in names
+        )
+        self._mtime = mtime
+
+      for name in self._repos.keys():
+        self._refresh_repo(name)
+      return self._repos
+
+  def _refresh_repo(self, name):
+    repo_path = os.path.normpath("%s/%s" % (self.repodir, name))
+    try:
+      mtime = os.stat(repo_path).st_mtime
+    except OSError:
+      del self._repos[name]
+      return
+    if self._repos[name][0] == mtime:
+      return
+
+    molecules = []
+    for file in sorted(os.listdir(repo_path)):
+      molid, ext = os.path.splitext(file)
+      if ext != ".lgf":
+        continue
+
+      path = "%s/%s" % (repo_path, file)
+      st = os.stat(path)
+      key = (st.st_mtime, st.st_size)
+      cached = self._files.get(path)
+      if cached is None or cached[0] != key:
+        try:
+          atoms, _ = lgf.read_lgf(path)
+          count = len(atoms)
+        except (IOError, lgf.FormatError):
+          count = None
+        cached = (key, count)
+        self._files[path] = cached
+      molecules.append({
+        'name': molid,
+        'path': path,
+        'atoms': cached[1],
+        'size': st.st_size
+      })
+    self._repos[name] = (mtime, molecules)
+
+  def exists(self, repo):
+    return repo in self.refresh()
+
+  def molecules(self, repo):
+    """Returns the (name, path) of every .lgf file of a repository."""
+    repos = self.refresh()
+    if not repo in repos:
+      return []
+    return map(lambda m: (m['name'], m['path']), repos[repo][1])
+
+  def digest(self, repo):
+    """Returns a digest of the names and contents of a repository's files."""
+    digest = sha1()
+    for name, path in self.molecules(repo):
+      digest.update("%s\0%s\0" % (name, self._content_digest(path)))
+    return digest.hexdigest()
+
+  def _content_digest(self, path):
+    st = os.stat(path)
+    key = (st.st_mtime, st.st_size)
+    cached = self._digests.get(path)
+    if cached is None or cached[0] != key:
+      with open(path, 'rb') as fp:
+        cached = (key, sha1(fp.read()).hexdigest())
+      self._digests[path] = cached
+    return cached[1]
+
+  def statistics(self, details=False):
+    stats = {}
+    for name, (_, molecules) in self.refresh().items():
+      repo = {
+        'molecules': len(molecules),
+        'atoms': sum(m['atoms'] or 0 for m in molecules),
+        'size': sum(m['size'] for m in molecules)
+      }
+      if details:
+        repo['files'] = map(
+          lambda m: {'name': m['name'], 'atoms': m['atoms'], 'size': m['size']},
+          molecules
+        )
+      stats[name] = repo
+    return stats
@@ -0,0 +1,103 @@
+"""
+Streaming .off files.
+
+A streaming .off file is written one line at a time: a header line, one JSON
+record per repository molecule as soon as its fragments are known, and a
+trailer line holding missing_atoms. Readers go through it line by line, so
+neither side needs to hold more than one molecule in memory.
+"""
+import json
+import os
+
+
+HEADER = '{"format": "off-stream", "version": 1}'
+
+
+class FormatError(Exception):
+  pass
+
+
+def is_stream(path):
+  with open(path, 'r') as fp:
+    return fp.read(len(HEADER)) == HEADER
+
+
+class StreamWriter:
+  def __init__(self, path):
+    self.fp = open(path, 'w')
+    self.fp.write(HEADER + "\n")
+
+  def write_molecule(self, molecule):
+    self.fp.write(json.dumps(molecule, default=(lambda o: o.__dict__)))
+    self.fp.write("\n")
+    self.fp.flush()
+
+  def close(self, missing_atoms):
+    self.fp.write(json.dumps({'missing_atoms': missing_atoms}))
+    self.fp.write("\n")
+    self.fp.close()
+
+
+class StreamOff:
+  """Reader for streaming .off files; every query is a single pass."""
+
+  def __init__(self, path):
+    self.path = path
+
+  def records(self):
+    with open(self.path, 'r') as fp:
+      if fp.readline().rstrip("\n") != HEADER:
+        raise FormatError("Invalid streaming fragment file: bad header")
+      for line in fp:
+        try:
+          record = json.loads(line)
+        except ValueError as e:
+          raise FormatError("Invalid streaming fragment file: %s" % e)
+        yield record
+
+  def molecules(self):
+    for record in self.records():
+      if "atb_id" in record:
+        yield record
+
+  @property
+  def missing_atoms(self):
+    # The trailer is the last line, so only the end of the file is read
+    with open(self.path, 'rb') as fp:
+      fp.seek(0, os.SEEK_END)
+      end = fp.tell()
+      block = 4096
+      tail = ""
+      while end > 0 and tail.count("\n") < 2:
+        start = max(0, end - block)
+        fp.seek(start)
+        tail = fp.read(end - start) + tail
+        end = start
+    lines = tail.rstrip("\n").rsplit("\n", 1)
+    try:
+      trailer = json.loads(lines[-1])
+    except ValueError as e:
+      raise FormatError("Incomplete streaming fragment file: %s" % e)
+    if not isinstance(trailer, dict) or not "missing_atoms" in trailer:
+      raise FormatError("Incomplete streaming fragment file: no trailer")
+    return trailer["missing_atoms"]
+
+  def search(self, needle):
+    needle = set(needle)
+    matches = []
+    for molecule in self.molecules():
+      for fragment in molecule["fragments"]:
+        if not "pairs" in fragment:
+          continue
+
+        aids = set(map(lambda p: p["id1"], fragment["pairs"]))
+        if needle.issubset(aids):
+          matches.append((molecule["atb_id"], fragment))
+    return matches
+
+  @property
+  def off(self):
+    return {
+      'molecules': list(self.molecules()),
+      'missing_atoms': self.missing_atoms
+    }
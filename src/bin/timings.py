@@ -0,0 +1,38 @@
+"""
+Stage timings and counters of a single generator run.
+
+The generator times its stages (LGF conversion, listing the repository,
+spawning and waiting for the matcher, writing the .off file) into a Timings
+object and returns it in its ack, so that the web application can aggregate
+runs that happened in another process.
+"""
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+
+
+class Timings:
+  def __init__(self):
+    self.stages = {}
+    self.counters = {}
+    self._lock = Lock()
+
+  @contextmanager
+  def span(self, stage):
+    start = time()
+    try:
+      yield
+    finally:
+      self.add(stage, time() - start)
+
+  def add(self, stage, seconds):
+    with self._lock:
+      self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+  def count(self, counter, n=1):
+    with self._lock:
+      self.counters[counter] = self.counters.get(counter, 0) + n
+
+  def report(self):
+    with self._lock:
+      return {'stages': dict(self.stages), 'counters': dict(self.counters)}
@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+from Queue import Queue, Full
+import re
+import socket
+from tempfile import mkstemp
+from threading import Lock, Thread
+from time import time
+from uuid import uuid4
+
+from omfraf.main.metrics import is_running
+
+
+logger = logging.getLogger('omfraf')
+
+JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class QueueFullError(Exception):
+  pass
+
+
+def write_json(path, data):
+  fd, tmp = mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+  with os.fdopen(fd, 'w') as fp:
+    fp.write(json.dumps(data, default=(lambda o: o.__dict__)))
+  os.rename(tmp, path)
+
+
+class BackgroundExecutor:
+  """
+  Runs submitted calls on `workers` daemon threads. At most `queue_size`
+  calls wait for a thread; further submissions raise a QueueFullError.
+  """
+
+  def __init__(self, workers, queue_size):
+    self.workers = workers
+    self._queue = Queue(queue_size)
+    self._threads = []
+    self._lock = Lock()
+
+  def submit(self, fn, *args):
+    with self._lock:
+      if len(self._threads) < self.workers:
+        thread = Thread(target=self._work)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    try:
+      self._queue.put_nowait((fn, args))
+    except Full:
+      raise QueueFullError("Too many queued jobs")
+
+  def _work(self):
+    while True:
+      fn, args = self._queue.get()
+      try:
+        fn(*args)
+      except Exception as e:
+        logger.exception("Background job failed: %s" % e)
+
+
+class JobStore:
+  """
+  Job states kept as small JSON files, so that any process can answer status
+  requests for jobs started by another one. Jobs only run in the process
+  that created them; a job that is not done when that process is gone never
+  will be, and is reported as failed.
+  """
+
+  def __init__(self, dir, ttl):
+    self.dir = dir
+    self.ttl = ttl
+
+  def _path(self, job_id, ext="json"):
+    return "%s/%s.%s" % (self.dir, job_id, ext)
+
+  def progress_path(self, job_id):
+    return self._path(job_id, "progress")
+
+  def create(self):
+    if not os.path.isdir(self.dir):
+      try:
+        os.makedirs(self.dir)
+      except OSError:
+        pass
+    self.prune()
+
+    job_id = uuid4().hex
+    write_json(self._path(job_id), {
+      'job': job_id,
+      'status': 'queued',
+      'created': time(),
+      'host': socket.gethostname(),
+      'pid': os.getpid()
+    })
+    return job_id
+
+  def update(self, job_id, **fields):
+    job = self.get(job_id) or {'job': job_id}
+    job.update(fields)
+    job.pop('progress', None)
+    write_json(self._path(job_id), job)
+
+  def get(self, job_id):
+    if not JOB_ID.match(job_id):
+      return None
+
+    try:
+      with open(self._path(job_id), 'r') as fp:
+        job = json.loads(fp.read())
+    except (IOError, ValueError):
+      return None
+
+    if job.get('status') in ('queued', 'running') and self._lost(job):
+      job.update({
+        'status': 'done',
+        'finished': time(),
+        'error': "Job lost, its process (%s) exited" % job['pid']
+      })
+      write_json(self._path(job_id), job)
+
+    try:
+      with open(self.progress_path(job_id), 'r') as fp:
+        job['progress'] = json.loads(fp.read())
+    except (IOError, ValueError):
+      pass
+    return job
+
+  def _lost(self, job):
+    """Whether the process that owns `job` is gone."""
+    if not 'pid' in job or job.get('host') != socket.gethostname():
+      return False
+    return not is_running(job['pid'])
+
+  def remove(self, job_id):
+    for path in (self._path(job_id), self.progress_path(job_id)):
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+
+  def prune(self):
+    limit = time() - self.ttl
+    for file in os.listdir(self.dir):
+      job_id, ext = os.path.splitext(file)
+      if ext != ".json":
+        continue
+      try:
+        if os.path.getmtime(self._path(job_id)) < limit:
+          self.remove(job_id)
+      except OSError:
+        pass
@@ -0,0 +1,72 @@
+from contextlib import contextmanager
+import errno
+import fcntl
+import os
+from time import sleep, time
+
+
+POLL_INTERVAL = 0.05
+
+
+class LockTimeout(Exception):
+  pass
+
+
+def acquire(path, deadline, timeout):
+  """
+  Returns a descriptor of `path` holding its lock. A holder removes the file
+  when it releases it, so a lock taken on a file that is no longer at `path`
+  is dropped and taken again on the new one.
+  """
+  while True:
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+      while True:
+        try:
+          fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+          break
+        except IOError:
+          if time() >= deadline:
+            raise LockTimeout("Timed out after %ss waiting for %s" %
+                (timeout, os.path.basename(path)))
+          sleep(POLL_INTERVAL)
+
+      try:
+        current = os.stat(path)
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+      else:
+        if os.path.samestat(current, os.fstat(fd)):
+          return fd
+    except:
+      os.close(fd)
+      raise
+    os.close(fd)
+
+
+@contextmanager
+def file_lock(path, timeout):
+  """
+  Holds an exclusive lock on `path` for the duration of the block. The lock
+  is shared by all processes on the host, and waiting for it gives up with a
+  LockTimeout after `timeout` seconds. The file is removed again on release.
+  """
+  dir = os.path.dirname(path)
+  if not os.path.isdir(dir):
+    try:
+      os.makedirs(dir)
+    except OSError:
+      pass
+
+  fd = acquire(path, time() + timeout, timeout)
+  try:
+    yield
+  finally:
+    # Removed while still held, so waiters notice and open the file anew
+    try:
+      os.unlink(path)
+    except OSError:
+      pass
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+
+from omfraf.main.util import STORE
+
+
+class Command(NoArgsCommand):
+  help = "Moves fragment files of the old, flat layout into their shards."
+
+  def handle_noargs(self, **options):
+    moved = STORE.migrate()
+    self.stdout.write("Moved %s fragment files into %s" %
+        (len(moved), STORE.root))
@@ -0,0 +1,269 @@
+"""
+Counters and histograms, rendered in the Prometheus text exposition format.
+
+Every web server process counts in memory and, once shared through a
+directory, writes its series to a file of its own there every few seconds.
+A scrape lands on any one process, which adds up the counters and histograms
+of every file, so the totals cover the whole server and never go backwards
+when a process is replaced: the files of processes that are gone are merged
+into an archive file rather than dropped. Gauges describe state shared by
+all processes (e.g. the fragment store) and are the rendering process's own.
+"""
+from contextlib import contextmanager
+import errno
+import json
+import os
+from tempfile import mkstemp
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+from omfraf.main.locking import file_lock
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+           120, 300)
+# Seconds between writes of a process's series to its file
+WRITE_INTERVAL = 5
+ARCHIVE = "archive"
+LOCK_TIMEOUT = 10
+
+
+def format_labels(labels, extra=()):
+  pairs = list(labels) + list(extra)
+  if len(pairs) == 0:
+    return ""
+  return "{%s}" % ",".join(map(
+    lambda p: '%s="%s"' % (p[0], unicode(p[1]).replace("\\", "\\\\")
+                           .replace('"', '\\"').replace("\n", "\\n")),
+    pairs
+  ))
+
+def format_value(v):
+  if v == float("inf"):
+    return "+Inf"
+  return repr(float(v)) if isinstance(v, float) else str(v)
+
+def is_running(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True
+
+def read_series(path):
+  """Returns the {(name, labels): value} series of a metrics file."""
+  try:
+    with open(path, 'r') as fp:
+      rows = json.loads(fp.read())
+  except (IOError, ValueError):
+    return {}
+  return dict(((name, tuple(map(tuple, labels))), value)
+              for name, labels, value in rows)
+
+def write_series(path, series):
+  fd, tmp = mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+  with os.fdopen(fd, 'w') as fp:
+    fp.write(json.dumps([[k[0], k[1], v] for k, v in series.items()]))
+  os.rename(tmp, path)
+
+def add_series(totals, series):
+  for key, value in series.items():
+    if not key in totals:
+      totals[key] = list(value) if isinstance(value, list) else value
+    elif isinstance(value, list):
+      totals[key] = map(lambda a, b: a + b, totals[key], value)
+    else:
+      totals[key] += value
+
+
+class Registry:
+  def __init__(self, buckets=BUCKETS):
+    self.buckets = buckets
+    self._metrics = {}
+    self._series = {}
+    self._lock = Lock()
+    self.dir = None
+    self._written = 0
+    self._pid = None
+    self._file = None
+
+  def share(self, dir):
+    """Adds up the series of every process writing to `dir`."""
+    self.dir = dir
+
+  def describe(self, name, kind, text):
+    """Declares a counter, gauge or histogram."""
+    self._metrics[name] = (kind, text)
+
+  def _key(self, name, labels):
+    if not name in self._metrics:
+      raise KeyError("Undeclared metric: %s" % name)
+    return name, tuple(sorted(labels.items()))
+
+  def inc(self, name, n=1, **labels):
+    key = self._key(name, labels)
+    with self._lock:
+      self._series[key] = self._series.get(key, 0) + n
+    self._changed()
+
+  def set(self, name, value, **labels):
+    key = self._key(name, labels)
+    with self._lock:
+      self._series[key] = value
+    self._changed()
+
+  def observe(self, name, value, **labels):
+    key = self._key(name, labels)
+    with self._lock:
+      series = self._series.get(key)
+      if series is None:
+        series = self._series[key] = [0] * (len(self.buckets) + 2)
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          series[i] += 1
+      series[-2] += value
+      series[-1] += 1
+    self._changed()
+
+  def _changed(self):
+    if self.dir is not None and time() - self._written >= WRITE_INTERVAL:
+      # Counting never fails a request; the next write catches up
+      try:
+        self.write()
+      except (IOError, OSError):
+        pass
+
+  def _path(self, name):
+    return "%s/%s.json" % (self.dir, name)
+
+  def write(self):
+    """Writes the series of this process to its file in the shared dir."""
+    # Files are told apart by pid and a token, as pids get reused
+    if self._pid != os.getpid():
+      self._pid = os.getpid()
+      self._file = "%s-%s" % (self._pid, uuid4().hex[:8])
+    with self._lock:
+      self._written = time()
+      series = self._summed(self._series)
+    if not os.path.isdir(self.dir):
+      try:
+        os.makedirs(self.dir)
+      except OSError:
+        pass
+    write_series(self._path(self._file), series)
+
+  def collect(self):
+    """
+    Returns the series to render: the sums over every process sharing the
+    directory, or this process's own when it is not shared.
+    """
+    with self._lock:
+      own = dict(
+        (k, list(v) if isinstance(v, list) else v)
+        for k, v in self._series.items()
+      )
+    if self.dir is None:
+      return own
+
+    self.write()
+    totals = dict(
+      (k, v) for k, v in own.items() if self._metrics[k[0]][0] == "gauge"
+    )
+    # Merging and reading under one lock, so no scrape counts a file twice
+    with file_lock("%s/metrics.lock" % self.dir, LOCK_TIMEOUT):
+      archive = self._summed(read_series(self._path(ARCHIVE)))
+      merged = []
+      for file in os.listdir(self.dir):
+        name, ext = os.path.splitext(file)
+        pid = name.split("-")[0]
+        if ext != ".json" or not pid.isdigit():
+          continue
+        series = self._summed(read_series("%s/%s" % (self.dir, file)))
+        if is_running(int(pid)):
+          add_series(totals, series)
+        else:
+          add_series(archive, series)
+          merged.append(file)
+      if len(merged) > 0:
+        write_series(self._path(ARCHIVE), archive)
+        for file in merged:
+          os.remove("%s/%s" % (self.dir, file))
+    add_series(totals, archive)
+    return totals
+
+  def _summed(self, series):
+    """The counter and histogram series, of metrics this process knows."""
+    return dict(
+      (k, list(v) if isinstance(v, list) else v) for k, v in series.items()
+      if k[0] in self._metrics and self._metrics[k[0]][0] != "gauge"
+    )
+
+  @contextmanager
+  def span(self, stage):
+    """Times a block into the stage duration histogram."""
+    start = time()
+    try:
+      yield
+    finally:
+      self.observe("omfraf_stage_duration_seconds", time() - start,
+                   stage=stage)
+
+  def render(self):
+    series = sorted(self.collect().items())
+
+    lines = []
+    for name, (kind, text) in sorted(self._metrics.items()):
+      lines.append("# HELP %s %s" % (name, text))
+      lines.append("# TYPE %s %s" % (name, kind))
+      for (series_name, labels), value in series:
+        if series_name != name:
+          continue
+        if kind != "histogram":
+          lines.append("%s%s %s" % (
+            name, format_labels(labels), format_value(value)
+          ))
+          continue
+        for bound, count in zip(self.buckets + (float("inf"),),
+                                value[:len(self.buckets)] + [value[-1]]):
+          lines.append("%s_bucket%s %s" % (
+            name, format_labels(labels, [("le", format_value(bound))]), count
+          ))
+        lines.append("%s_sum%s %s" % (
+          name, format_labels(labels), format_value(value[-2])
+        ))
+        lines.append("%s_count%s %s" % (name, format_labels(labels), value[-1]))
+    return "\n".join(lines) + "\n"
+
+
+METRICS = Registry()
+METRICS.describe("omfraf_requests_total", "counter",
+                 "HTTP requests by view and status code.")
+METRICS.describe("omfraf_request_duration_seconds", "histogram",
+                 "HTTP request duration by view.")
+METRICS.describe("omfraf_stage_duration_seconds", "histogram",
+                 "Duration of request and generator stages.")
+METRICS.describe("omfraf_stored_fragments_total", "counter",
+                 "Generation requests answered from stored fragments (hit) "
+                 "or by running the generator (miss).")
+METRICS.describe("omfraf_off_cache_hits_total", "counter",
+                 "Fragment file lookups answered from the in-memory cache.")
+METRICS.describe("omfraf_off_cache_misses_total", "counter",
+                 "Fragment file lookups that had to read the file.")
+METRICS.describe("omfraf_matcher_calls_total", "counter",
+                 "Matcher subprocesses started, by repository.")
+METRICS.describe("omfraf_matcher_seconds_total", "counter",
+                 "Time spent spawning and waiting for the matcher, by "
+                 "repository.")
+METRICS.describe("omfraf_matcher_timeouts_total", "counter",
+                 "Matcher runs killed for running out of time, by "
+                 "repository.")
+METRICS.describe("omfraf_skipped_molecules_total", "counter",
+                 "Repository molecules left out of partial results, by "
+                 "repository.")
+METRICS.describe("omfraf_bytes_written_total", "counter",
+                 "Bytes of fragment files written by the generator.")
+METRICS.describe("omfraf_store_entries", "gauge",
+                 "Files in the fragment store.")
+METRICS.describe("omfraf_store_bytes", "gauge",
+                 "Bytes of files in the fragment store.")
@@ -0,0 +1,265 @@
+"""
+Pool of long-lived worker processes.
+
+Workers are started as fresh interpreters (python -m omfraf.main.pool) rather
+than forked from the Django process: a fork of a multi-threaded process
+inherits the locks other threads hold at that moment (of the fragment store,
+logging or the repository catalog), and nobody ever releases them in the
+child. Jobs and results are pickled and sent as length-prefixed frames over
+the worker's stdin and stdout.
+"""
+import cPickle as pickle
+import errno
+import os
+from Queue import Queue, Empty
+from select import select, error as SelectError
+import signal
+import struct
+from subprocess import Popen, PIPE
+import sys
+from threading import BoundedSemaphore, Lock
+from time import sleep, time
+
+
+FRAME = struct.Struct("!I")
+MODULE = "omfraf.main.pool"
+
+
+class PoolFullError(Exception):
+  pass
+
+class WorkerCrashError(Exception):
+  pass
+
+class WorkerTimeoutError(Exception):
+  pass
+
+
+def write_frame(fp, obj):
+  data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+  fp.write(FRAME.pack(len(data)) + data)
+  fp.flush()
+
+def read_exactly(fd, size, deadline=None):
+  """Reads `size` bytes from `fd`, waiting until `deadline` at most."""
+  chunks = []
+  while size > 0:
+    if deadline is not None:
+      left = deadline - time()
+      if left <= 0:
+        raise WorkerTimeoutError("No result before the deadline")
+      try:
+        if len(select([fd], [], [], left)[0]) == 0:
+          continue
+      except SelectError as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+    chunk = os.read(fd, min(size, 65536))
+    if len(chunk) == 0:
+      raise EOFError("Worker closed its pipe")
+    chunks.append(chunk)
+    size -= len(chunk)
+  return "".join(chunks)
+
+def read_frame(fd, deadline=None):
+  size, = FRAME.unpack(read_exactly(fd, FRAME.size, deadline))
+  return pickle.loads(read_exactly(fd, size, deadline))
+
+
+def interpreter(python=None):
+  """
+  Returns the Python binary to start workers with: `python` if set, else
+  this process's own binary when it is a Python interpreter (under mod_wsgi
+  it is the web server), else the interpreter of the running Python prefix.
+  """
+  if python:
+    return python
+  if os.path.basename(sys.executable).startswith("python"):
+    return sys.executable
+  bindir = os.path.join(sys.exec_prefix, "bin")
+  for name in ("python%s.%s" % sys.version_info[:2], "python"):
+    if os.access(os.path.join(bindir, name), os.X_OK):
+      return os.path.join(bindir, name)
+  raise WorkerCrashError(
+    "No Python interpreter to start workers with, set GENERATOR_PYTHON"
+  )
+
+
+def serve(max_jobs):
+  # Results go to the original stdout; anything the jobs print to stderr
+  out = os.fdopen(os.dup(1), 'wb')
+  os.dup2(2, 1)
+  sys.stdout = sys.stderr
+  try:
+    initializer = read_frame(0)
+    if initializer is not None:
+      initializer()
+    for _ in range(max_jobs):
+      job = read_frame(0)
+      if job is None:
+        break
+      target, kwargs = job
+      write_frame(out, target(**kwargs))
+  except EOFError:
+    pass
+  out.close()
+
+
+class Worker:
+  def __init__(self, max_jobs, initializer=None, python=None):
+    self.jobs = 0
+    self.max_jobs = max_jobs
+    # The worker imports job functions from the same path as this process
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, sys.path)))
+    # In a session of its own, which the matchers its jobs start inherit, so
+    # that they are killed together with the worker
+    self.process = Popen(
+      [interpreter(python), "-m", MODULE, str(max_jobs)],
+      stdin=PIPE, stdout=PIPE, close_fds=True, env=env, preexec_fn=os.setsid
+    )
+    try:
+      write_frame(self.process.stdin, initializer)
+    except IOError as e:
+      self.kill()
+      raise WorkerCrashError("Worker %s died: %s" % (self.process.pid, e))
+
+  def run(self, job, deadline=None):
+    try:
+      write_frame(self.process.stdin, job)
+      result = read_frame(self.process.stdout.fileno(), deadline)
+    except (EOFError, IOError, struct.error) as e:
+      raise WorkerCrashError("Worker %s died: %s" % (self.process.pid, e))
+    self.jobs += 1
+    return result
+
+  @property
+  def exhausted(self):
+    return self.jobs >= self.max_jobs
+
+  def is_alive(self):
+    return self.process.poll() is None
+
+  def stop(self):
+    if self.is_alive() and not self.exhausted:
+      try:
+        write_frame(self.process.stdin, None)
+      except IOError:
+        pass
+    for _ in range(10):
+      if not self.is_alive():
+        break
+      sleep(0.1)
+    self.kill()
+
+  def kill(self):
+    # The group outlives the worker while any of its matchers still runs
+    try:
+      os.killpg(self.process.pid, signal.SIGKILL)
+    except OSError:
+      pass
+    self.process.wait()
+    self.process.stdin.close()
+    self.process.stdout.close()
+
+
+class WorkerPool:
+  """
+  Long-lived pool of worker processes, each running up to `max_jobs` jobs
+  before being replaced. A job is a module-level function and its keyword
+  arguments. At most `size` jobs run at once and at most `queue_size` more
+  wait for a free worker; anything beyond that is rejected with a
+  PoolFullError. A job with a `deadline` argument (seconds since the epoch)
+  that has not returned `grace` seconds after it is given up with a
+  WorkerTimeoutError, and its worker is killed and replaced. Every worker
+  calls `initializer`, a module-level function, before its first job.
+  Workers run on the `python` binary (see interpreter()).
+  """
+
+  def __init__(self, size, queue_size, max_jobs, grace=0, initializer=None,
+      python=None):
+    self.size = size
+    self.max_jobs = max_jobs
+    self.grace = grace
+    self.initializer = initializer
+    self.python = python
+    self._slots = BoundedSemaphore(size + queue_size)
+    self._idle = Queue()
+    self._lock = Lock()
+    self._workers = 0
+
+  def submit(self, target, **kwargs):
+    deadline = kwargs.get("deadline")
+    if deadline is not None:
+      deadline += self.grace
+    if not self._slots.acquire(False):
+      raise PoolFullError("Too many pending jobs")
+
+    try:
+      worker = self._checkout(deadline)
+      try:
+        result = worker.run((target, kwargs), deadline)
+      except (WorkerCrashError, WorkerTimeoutError):
+        self._retire(worker, kill=True)
+        raise
+      self._checkin(worker)
+      return result
+    finally:
+      self._slots.release()
+
+  def _checkout(self, deadline=None):
+    while True:
+      try:
+        worker = self._idle.get_nowait()
+      except Empty:
+        if self._reserve():
+          try:
+            return Worker(self.max_jobs, self.initializer, self.python)
+          except Exception:
+            self._release()
+            raise
+        worker = self._wait(deadline)
+
+      # None only wakes up a waiter after a worker was retired
+      if worker is None:
+        continue
+      if worker.is_alive():
+        return worker
+      self._retire(worker)
+
+  def _wait(self, deadline=None):
+    if deadline is None:
+      return self._idle.get()
+    try:
+      return self._idle.get(timeout=max(0, deadline - time()))
+    except Empty:
+      raise WorkerTimeoutError("No free worker before the deadline")
+
+  def _checkin(self, worker):
+    if worker.exhausted:
+      self._retire(worker)
+    else:
+      self._idle.put(worker)
+
+  def _retire(self, worker, kill=False):
+    if kill:
+      worker.kill()
+    else:
+      worker.stop()
+    self._release()
+
+  def _reserve(self):
+    with self._lock:
+      if self._workers < self.size:
+        self._workers += 1
+        return True
+      return False
+
+  def _release(self):
+    with self._lock:
+      self._workers -= 1
+    self._idle.put(None)
+
+
+if __name__ == "__main__":
+  serve(int(sys.argv[1]))
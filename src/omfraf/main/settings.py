@@ -1 +1,67 @@
 VERSION = "1.0.1"
+
+# Number of parsed fragment files kept in memory by each worker
+OFF_CACHE_SIZE = 32
+
+# Fragment generator workers per Django process, the number of requests that
+# may wait for a free worker, and the number of jobs after which a worker is
+# replaced by a fresh process
+GENERATOR_POOL_SIZE = 4
+GENERATOR_QUEUE_SIZE = 16
+GENERATOR_MAX_JOBS = 100
+
+# Python binary that generator workers run on. None uses the interpreter
+# running Django, which under mod_wsgi is the web server binary; the workers
+# then fall back to the python of the same installation (sys.exec_prefix).
+# Set this to the virtualenv's python when that is not the right one.
+GENERATOR_PYTHON = None
+
+# Repository molecules matched in parallel by each generator job
+GENERATOR_JOBS = 4
+
+# Format of newly generated fragment files: "json", "binary" or "stream"
+GENERATOR_FORMAT = "json"
+
+# Seconds a generation request waits for an identical one that is already
+# running before giving up
+GENERATE_LOCK_TIMEOUT = 600
+
+# Seconds a generator run may take, and seconds the matcher may take for one
+# repository molecule; molecules that run out of time are skipped and the
+# result is marked partial
+GENERATE_DEADLINE = 300
+MATCHER_TIMEOUT = 60
+
+# Seconds past the deadline that a generator worker may take to write a
+# partial result before it is killed and replaced
+GENERATOR_GRACE = 30
+
+# Background threads per Django process running asynchronous generation jobs,
+# the number of jobs that may wait for one, and the number of seconds after
+# which finished jobs are forgotten
+JOB_WORKERS = 2
+JOB_QUEUE_SIZE = 32
+JOB_TTL = 86400
+
+# Skip repository molecules that share no atom environment with the query.
+# Off until PrefilterTest.test_matcher has passed against the mop build in
+# use: the filter assumes the matcher only pairs atoms with identical shell
+# neighbourhoods, which only the fake matcher is known to do.
+GENERATOR_PREFILTER = False
+
+# Number of invalidated fragment files, most requested first, that are
+# regenerated in the background after a mop update
+REGENERATE_TOP = 10
+
+# Budget of the fragment store, in bytes and in number of files (None for no
+# limit), and whether the least recently (lru) or least frequently (lfu) used
+# files are evicted first when it is exceeded. Files of the old, flat layout
+# are moved into the store with manage.py migrate_fragments.
+STORE_MAX_BYTES = 10 * 1024 ** 3
+STORE_MAX_ENTRIES = None
+STORE_EVICTION = "lru"
+
+# Responses holding more list items (e.g. fragments) than this are streamed
+# in compact chunks of STREAM_CHUNK_SIZE items instead of being buffered
+STREAM_THRESHOLD = 5000
+STREAM_CHUNK_SIZE = 500
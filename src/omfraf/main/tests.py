@@ -5,8 +5,99 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import json
+import os
+import random
+import sys
+from shutil import rmtree
+from subprocess import Popen
+from tempfile import mkdtemp, NamedTemporaryFile
+from threading import Thread
+from time import sleep, time
+from unittest import skipIf
+
 from django.test import TestCase
 
+from omfraf.main import settings, util
+from omfraf.main.jobs import JobStore
+from omfraf.main.locking import file_lock, LockTimeout
+from omfraf.main.metrics import Registry, write_series
+from omfraf.main.pool import interpreter, WorkerPool, WorkerCrashError, \
+    WorkerTimeoutError
+from omfraf.main.util import fragment_finder
+import binary_off
+import canonical
+import charge_stats
+import environment_index
+import fragment_generator
+from fragment_store import FragmentStore, InvalidName, STORE
+import manifest
+import molecule_diff
+import molecule_graph
+import query
+from repository_catalog import RepositoryCatalog
+import stream_off
+
+
+def pid_job(crash=False, deadline=None, seconds=0):
+    if crash:
+        os._exit(1)
+    sleep(seconds)
+    return os.getpid()
+
+def matcher_job(infile, molfile, deadline=None):
+    return fragment_generator.generate_molecule_fragments(
+        "7", molfile, 1, infile)
+
+def initialize_worker():
+    os.environ["OMFRAF_TEST_WORKER"] = str(os.getpid())
+
+def initialized_job():
+    return os.environ.get("OMFRAF_TEST_WORKER")
+
+
+class StoreTestCase(TestCase):
+    """Runs tests against an empty fragment store and manifest."""
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.root = STORE.root
+        self.manifest = manifest.MANIFEST
+        STORE.root = self.dir
+        manifest.MANIFEST = "%s/manifest.sqlite" % self.dir
+        util.OFF_CACHE.invalidate()
+
+    def tearDown(self):
+        STORE.root = self.root
+        manifest.MANIFEST = self.manifest
+        util.OFF_CACHE.invalidate()
+        rmtree(self.dir)
+
+    def put_off(self, name, off):
+        with STORE.write(name) as path:
+            with open(path, 'w') as fp:
+                fp.write(json.dumps(off))
+
+
+class RepositoryTestCase(StoreTestCase):
+    """Adds an empty lipids repository to the fragment store tests."""
+
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        self.repodir = mkdtemp()
+        os.mkdir("%s/lipids" % self.repodir)
+        self.catalog = fragment_generator.CATALOG
+        fragment_generator.CATALOG = RepositoryCatalog(self.repodir)
+
+    def tearDown(self):
+        fragment_generator.CATALOG = self.catalog
+        rmtree(self.repodir)
+        StoreTestCase.tearDown(self)
+
+    def write_molecule(self, name, content):
+        with open("%s/lipids/%s.lgf" % (self.repodir, name), 'w') as fp:
+            fp.write(content)
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +105,1350 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class OffCacheTest(TestCase):
+    def setUp(self):
+        self.fp = NamedTemporaryFile(suffix=".off", delete=False)
+        self.fp.write(json.dumps({'molecules': [], 'missing_atoms': [1]}))
+        self.fp.close()
+
+    def tearDown(self):
+        os.remove(self.fp.name)
+
+    def test_hits_and_misses(self):
+        """
+        Tests that a parsed file is reused until it changes on disk.
+        """
+        cache = fragment_finder.OffCache(2)
+        cache.get(self.fp.name)
+        od = cache.get(self.fp.name).off
+        self.assertEqual(od['missing_atoms'], [1])
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        with open(self.fp.name, 'w') as fp:
+            fp.write(json.dumps({'molecules': [], 'missing_atoms': [1, 2]}))
+        od = cache.get(self.fp.name).off
+        self.assertEqual(od['missing_atoms'], [1, 2])
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_missing_file(self):
+        """
+        Tests that a deleted file is dropped from the cache.
+        """
+        cache = fragment_finder.OffCache(2)
+        cache.get(self.fp.name)
+        os.remove(self.fp.name)
+        self.assertRaises(fragment_finder.LoadError, cache.get, self.fp.name)
+        self.assertEqual(cache.stats()['size'], 0)
+        open(self.fp.name, 'w').close()
+
+
+class FragmentIndexTest(TestCase):
+    def test_search(self):
+        """
+        Tests that only fragments containing every needle atom are returned,
+        in file order.
+        """
+        off = {'molecules': [
+            {'atb_id': '1', 'fragments': [
+                {'score': 1, 'pairs': [{'id1': 1}, {'id1': 2}]},
+                {'score': 2, 'pairs': [{'id1': 2}, {'id1': 3}]},
+                {'score': 3},
+            ]},
+            {'atb_id': '2', 'fragments': [
+                {'score': 4, 'pairs': [{'id1': 3}, {'id1': 2}, {'id1': 2}]},
+            ]},
+        ]}
+        index = fragment_finder.FragmentIndex(off)
+        scores = lambda r: [f['score'] for _, f in r]
+        self.assertEqual(scores(index.search([2])), [1, 2, 4])
+        self.assertEqual(scores(index.search([3, 2])), [2, 4])
+        self.assertEqual(index.search([1, 4]), [])
+        self.assertEqual(index.search([5]), [])
+
+    def test_select(self):
+        """
+        Tests that pages of the best fragments above a minimum score do not
+        overlap and that the total counts every fragment above it.
+        """
+        off = {'molecules': [{'atb_id': '1', 'fragments': map(
+            lambda s: {'score': s, 'pairs': [{'id1': 1, 'id2': s,
+                                              'charge': 0}]},
+            [3, 1, 4, 1, 5, 9, 2, 6]
+        )}]}
+        index = fragment_finder.FragmentIndex(off)
+        page = lambda o: fragment_finder.select_fragments(index, [1], 2, o, 2)
+        scores = lambda p: [f['score'] for f in p[0]]
+        self.assertEqual(scores(page(0)), [9, 6])
+        self.assertEqual(scores(page(2)), [5, 4])
+        self.assertEqual(scores(page(4)), [3, 2])
+        self.assertEqual(page(6), ([], 6))
+
+
+class BinaryOffTest(TestCase):
+    def test_roundtrip(self):
+        """
+        Tests that a binary .off file holds the same fragments and answers
+        needle queries like the JSON file it was converted from.
+        """
+        off = {'missing_atoms': [9], 'molecules': [
+            {'atb_id': u'12', 'fragments': [
+                {'score': 2, 'pairs': [
+                    {'id1': 1, 'id2': 4, 'charge': 0.25},
+                    {'id1': 2, 'id2': 5, 'charge': -0.5},
+                ]},
+            ]},
+            {'atb_id': u'13', 'fragments': [
+                {'score': 1, 'pairs': [{'id1': 2, 'id2': 6, 'charge': 0.0}]},
+            ]},
+        ]}
+        fp = NamedTemporaryFile(suffix=".off", delete=False)
+        fp.close()
+        try:
+            binary_off.write_binary(off, fp.name)
+            self.assertTrue(binary_off.is_binary(fp.name))
+            boff = binary_off.BinaryOff(fp.name)
+            self.assertEqual(boff.missing_atoms, [9])
+            self.assertEqual(boff.off, off)
+            self.assertEqual(
+                boff.search([2]),
+                fragment_finder.FragmentIndex(off).search([2])
+            )
+            self.assertEqual(boff.search([1, 6]), [])
+            boff.close()
+        finally:
+            os.remove(fp.name)
+
+    def test_select(self):
+        """
+        Tests that pages of a binary file match those of the JSON file and
+        that fragments are only built for the selected page.
+        """
+        off = {'missing_atoms': [], 'molecules': [{
+            'atb_id': u'1', 'fragments': map(
+                lambda s: {'score': s, 'pairs': [
+                    {'id1': 1, 'id2': s, 'charge': 0.0}]},
+                [3, 1, 4, 1, 5, 9, 2, 6]
+            )
+        }]}
+        fp = NamedTemporaryFile(suffix=".off", delete=False)
+        fp.close()
+        try:
+            binary_off.write_binary(off, fp.name)
+            boff = binary_off.BinaryOff(fp.name)
+            built = []
+            hit = boff.hit
+            boff.hit = lambda o: built.append(o) or hit(o)
+            index = fragment_finder.FragmentIndex(off)
+            for args in [(2, 0, None), (2, 2, 2), (None, 1, 4)]:
+                built[:] = []
+                page = fragment_finder.select_fragments(boff, [1], *args)
+                self.assertEqual(
+                    page, fragment_finder.select_fragments(index, [1], *args)
+                )
+                self.assertEqual(len(built), len(page[0]))
+            boff.close()
+        finally:
+            os.remove(fp.name)
+
+
+class StreamOffTest(TestCase):
+    def setUp(self):
+        fp = NamedTemporaryFile(suffix=".off", delete=False)
+        fp.close()
+        self.path = fp.name
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_roundtrip(self):
+        """
+        Tests that a streaming .off file holds the molecules written to it, in
+        order, and answers needle queries like the equivalent JSON file.
+        """
+        off = {'missing_atoms': [7, 9], 'molecules': [
+            {'atb_id': u'12', 'fragments': [
+                {'score': 2, 'pairs': [
+                    {'id1': 1, 'id2': 4, 'charge': 0.25},
+                    {'id1': 2, 'id2': 5, 'charge': -0.5},
+                ]},
+                {'score': 1},
+            ]},
+            {'atb_id': u'13', 'fragments': [
+                {'score': 1, 'pairs': [{'id1': 2, 'id2': 6, 'charge': 0.0}]},
+            ]},
+        ]}
+        writer = stream_off.StreamWriter(self.path)
+        for molecule in off['molecules']:
+            writer.write_molecule(molecule)
+        writer.close(off['missing_atoms'])
+
+        self.assertTrue(stream_off.is_stream(self.path))
+        self.assertFalse(binary_off.is_binary(self.path))
+        soff = fragment_finder.open_off(self.path)
+        self.assertTrue(isinstance(soff, stream_off.StreamOff))
+        self.assertEqual(soff.missing_atoms, [7, 9])
+        self.assertEqual(soff.off, off)
+        index = fragment_finder.FragmentIndex(off)
+        for needle in [[2], [1, 2], [1, 6]]:
+            self.assertEqual(soff.search(needle), index.search(needle))
+        self.assertEqual(
+            fragment_finder.select_fragments(soff, [2], None, 0, None),
+            fragment_finder.select_fragments(index, [2], None, 0, None)
+        )
+
+    def test_incomplete(self):
+        """
+        Tests that a file whose writer has not closed it yet can be read but
+        has no missing_atoms.
+        """
+        writer = stream_off.StreamWriter(self.path)
+        writer.write_molecule({'atb_id': u'12', 'fragments': []})
+        soff = stream_off.StreamOff(self.path)
+        self.assertEqual(list(soff.molecules()),
+                         [{'atb_id': u'12', 'fragments': []}])
+        self.assertRaises(stream_off.FormatError, lambda: soff.missing_atoms)
+        writer.close([])
+        self.assertEqual(soff.missing_atoms, [])
+
+
+class ChargeStatsTest(StoreTestCase):
+    OFF = {'missing_atoms': [], 'molecules': [{'atb_id': '1', 'fragments': [
+        {'score': 1, 'pairs': [{'id1': 2, 'id2': 1, 'charge': 0.5},
+                               {'id1': 1, 'id2': 2, 'charge': -0.1}]},
+        {'score': 3, 'pairs': [{'id1': 2, 'id2': 1, 'charge': 0.1}]},
+        {'score': 0, 'pairs': [{'id1': 2, 'id2': 3, 'charge': 0.3}]}
+    ]}]}
+
+    def check_rows(self, rows):
+        self.assertEqual([r[:2] for r in rows], [[1, 1], [2, 3]])
+        self.assertEqual(rows[0][2:], [-0.1, 0.0, -0.1, -0.1, -0.1, -0.1])
+        for value, expected in zip(rows[1][2:],
+                                   [0.3, 0.163299, 0.1, 0.5, 0.3, 0.2]):
+            self.assertAlmostEqual(value, expected, places=6)
+
+    def test_python_charge_table(self):
+        """
+        Tests the statistics of every atom over the pairs of all fragments,
+        weighting the mean by fragment score, for JSON and binary files.
+        """
+        index = fragment_finder.FragmentIndex(self.OFF)
+        self.check_rows(charge_stats.python_charge_table(
+            *charge_stats.pair_lists(index)
+        ))
+        fp = NamedTemporaryFile(suffix=".off", delete=False)
+        fp.close()
+        try:
+            binary_off.write_binary(self.OFF, fp.name)
+            boff = binary_off.BinaryOff(fp.name)
+            self.assertEqual(charge_stats.pair_lists(boff),
+                             charge_stats.pair_lists(index))
+            boff.close()
+        finally:
+            os.remove(fp.name)
+
+    @skipIf(charge_stats.numpy is None, "NumPy is not installed")
+    def test_charge_table(self):
+        """
+        Tests that NumPy computes the same table, also from the mapped
+        columns of a binary file.
+        """
+        self.check_rows(charge_stats.charge_table(*charge_stats.pair_arrays(
+            fragment_finder.FragmentIndex(self.OFF)
+        )))
+        fp = NamedTemporaryFile(suffix=".off", delete=False)
+        fp.close()
+        try:
+            binary_off.write_binary(self.OFF, fp.name)
+            boff = binary_off.BinaryOff(fp.name)
+            self.check_rows(charge_stats.charge_table(
+                *charge_stats.pair_arrays(boff)
+            ))
+            boff.close()
+        finally:
+            os.remove(fp.name)
+
+    def test_view(self):
+        """
+        Tests the /load/charges/ endpoint, and that a file with atom ids
+        that are not integers is a bad request.
+        """
+        self.put_off("stats.off", self.OFF)
+        response = self.client.post('/load/charges/', {
+            'data': json.dumps({'off': "stats.off", 'atoms': [1, 5]})
+        })
+        self.assertEqual(response.status_code, 200)
+        stats = json.loads(response.content)
+        self.assertEqual([r[:2] for r in stats['rows']], [[1, 1]])
+        self.assertEqual(stats['unmatched'], [5])
+
+        bad = json.loads(json.dumps(self.OFF))
+        bad['molecules'][0]['fragments'][0]['pairs'][0]['id1'] = "a"
+        self.put_off("bad.off", bad)
+        response = self.client.post('/load/charges/', {
+            'data': json.dumps({'off': "bad.off"})
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', json.loads(response.content))
+
+
+class CanonicalTest(TestCase):
+    def test_renumbered_molecule(self):
+        """
+        Tests that renumbering and reordering atoms keeps the molecule hash
+        and that the canonical orders map bonded atoms onto bonded atoms.
+        """
+        m1 = {
+            'atoms': [{'id': 1, 'type': 12}, {'id': 2, 'type': 20},
+                      {'id': 3, 'type': 20}, {'id': 4, 'type': 3}],
+            'bonds': [{'a1': 1, 'a2': 2}, {'a1': 1, 'a2': 3},
+                      {'a1': 1, 'a2': 4}],
+        }
+        m2 = {
+            'atoms': [{'id': 7, 'type': 3}, {'id': 5, 'type': 20},
+                      {'id': 8, 'type': 12}, {'id': 6, 'type': 20}],
+            'bonds': [{'a1': 5, 'a2': 8}, {'a1': 8, 'a2': 7},
+                      {'a1': 6, 'a2': 8}],
+        }
+        h1, o1 = canonical.molecule_hash(m1)
+        h2, o2 = canonical.molecule_hash(m2)
+        self.assertEqual(h1, h2)
+        mapping = dict(zip(o1, o2))
+        self.assertEqual(mapping[1], 8)
+        self.assertEqual(mapping[4], 7)
+
+        m2['atoms'][0]['type'] = 12
+        self.assertNotEqual(canonical.molecule_hash(m2)[0], h1)
+
+    def test_symmetric_molecule(self):
+        """
+        Tests that rings, whose atoms refinement cannot tell apart, get the
+        same hash however they are numbered, and differ from a chain.
+        """
+        ring = lambda ids: {
+            'atoms': [{'id': i, 'type': 12} for i in ids],
+            'bonds': [{'a1': ids[i - 1], 'a2': ids[i]}
+                      for i in range(len(ids))]
+        }
+        h1, o1 = canonical.molecule_hash(ring(range(200)))
+        h2, o2 = canonical.molecule_hash(ring(range(399, 0, -2)))
+        self.assertEqual(h1, h2)
+        self.assertEqual(sorted(o1), range(200))
+        chain = ring(range(200))
+        chain['bonds'].pop(0)
+        self.assertNotEqual(canonical.molecule_hash(chain)[0], h1)
+
+    def test_regular_graphs(self):
+        """
+        Tests that graphs whose atoms all look alike after refinement get a
+        single hash over many numberings and orders of their atoms.
+        """
+        def molecule(bonds, size, rng):
+            ids = range(1, size + 1)
+            rng.shuffle(ids)
+            atoms = [{'id': i, 'type': 12} for i in ids]
+            rng.shuffle(atoms)
+            bonds = [{'a1': ids[v], 'a2': ids[w]} for v, w in bonds]
+            rng.shuffle(bonds)
+            return {'atoms': atoms, 'bonds': bonds}
+
+        # Two K4s without an edge, joined where the edges are missing
+        cubic = [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (4, 5), (4, 6),
+                 (4, 7), (5, 6), (5, 7), (2, 6), (3, 7)]
+        triangle_hexagon = [(0, 1), (1, 2), (2, 0), (3, 4), (4, 5), (5, 6),
+                            (6, 7), (7, 8), (8, 3)]
+        ring = [(v, (v + 1) % 9) for v in range(9)]
+        rng = random.Random(1)
+        hashes = []
+        for bonds, size in [(cubic, 8), (triangle_hexagon, 9), (ring, 9)]:
+            seen = set(
+                canonical.molecule_hash(molecule(bonds, size, rng))[0]
+                for _ in range(50))
+            self.assertEqual(len(seen), 1)
+            hashes.extend(seen)
+        self.assertEqual(len(set(hashes)), 3)
+
+
+class StoredFragmentsTest(StoreTestCase):
+    def test_atb_outfile_first(self):
+        """
+        Tests that a stored ATB result is returned without computing the
+        structure key of the molecule.
+        """
+        self.put_off(util.get_atb_outfile("42"),
+                     {'molecules': [], 'missing_atoms': [3]})
+        key = util.get_structure_key
+        util.get_structure_key = None
+        try:
+            ack = util.generate_fragments({'data': json.dumps({'molecule': {
+                'molid': "42", 'atoms': [{'id': 3, 'type': 12}], 'bonds': []
+            }})})
+        finally:
+            util.get_structure_key = key
+        self.assertEqual(ack, {'off': util.get_atb_outfile("42"),
+                               'missing_atoms': [3]})
+
+
+class JobTest(TestCase):
+    QUERY = json.dumps({'molecule': {
+        'atoms': [{'id': 1, 'type': 12}, {'id': 2, 'type': 20}],
+        'bonds': [{'a1': 1, 'a2': 2}]
+    }})
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.jobs = util.JOBS
+        self.generate = util.generate_fragments
+        util.JOBS = JobStore(self.dir, 60)
+
+    def tearDown(self):
+        util.JOBS = self.jobs
+        util.generate_fragments = self.generate
+        rmtree(self.dir)
+
+    def status(self, job_id):
+        response = self.client.get('/jobs/%s/' % job_id)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_lifecycle(self):
+        """
+        Tests that a job is queued, running while it generates and done with
+        the result of the generation.
+        """
+        seen = []
+        def generate(args, progress=None):
+            seen.append(util.get_job(job_id)['status'])
+            return {'off': "result.off", 'missing_atoms': [2]}
+        util.generate_fragments = generate
+
+        job_id = util.JOBS.create()
+        self.assertEqual(self.status(job_id)['status'], 'queued')
+        util.run_generation_job(job_id, {'data': self.QUERY})
+        self.assertEqual(seen, ['running'])
+        job = self.status(job_id)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['off'], "result.off")
+        self.assertEqual(job['missing_atoms'], [2])
+        self.assertTrue(job['started'] <= job['finished'])
+        self.assertFalse('error' in job)
+
+    def test_lost(self):
+        """
+        Tests that a job whose process exited before finishing it is reported
+        done with an error, and that jobs of live processes are left as is.
+        """
+        job_id = util.JOBS.create()
+        self.assertEqual(util.JOBS.get(job_id)['pid'], os.getpid())
+        process = Popen(["true"])
+        process.wait()
+        util.JOBS.update(job_id, status='running', pid=process.pid)
+        job = self.status(job_id)
+        self.assertEqual(job['status'], 'done')
+        self.assertIn(str(process.pid), job['error'])
+        self.assertEqual(util.JOBS.get(job_id)['finished'], job['finished'])
+
+        job_id = util.JOBS.create()
+        util.JOBS.update(job_id, status='running')
+        self.assertEqual(self.status(job_id)['status'], 'running')
+
+    def test_errors(self):
+        """
+        Tests that failed generations leave their job done with an error and
+        that unknown jobs are reported as such.
+        """
+        def fail(args, progress=None):
+            raise RuntimeError("matcher vanished")
+        util.generate_fragments = fail
+        job_id = util.JOBS.create()
+        util.run_generation_job(job_id, {'data': self.QUERY})
+        job = self.status(job_id)
+        self.assertEqual(job['status'], 'done')
+        self.assertIn("matcher vanished", job['error'])
+
+        util.generate_fragments = lambda args, progress=None: \
+            {'error': "Invalid repository"}
+        job_id = util.JOBS.create()
+        util.run_generation_job(job_id, {'data': self.QUERY})
+        job = self.status(job_id)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['error'], "Invalid repository")
+
+        self.assertIn('error', self.status("0" * 32))
+
+    def test_async(self):
+        """
+        Tests that an asynchronous generate request returns a queued job that
+        runs in the background, and that invalid requests start no job.
+        """
+        util.generate_fragments = lambda args, progress=None: \
+            {'off': "result.off", 'missing_atoms': []}
+        response = self.client.post('/generate/', {
+            'data': self.QUERY, 'async': 'true'
+        })
+        ack = json.loads(response.content)
+        self.assertEqual(ack['status'], 'queued')
+
+        deadline = time() + 10
+        while self.status(ack['job'])['status'] != 'done':
+            self.assertTrue(time() < deadline)
+            sleep(0.05)
+        self.assertEqual(self.status(ack['job'])['off'], "result.off")
+
+        response = self.client.post('/generate/', {
+            'data': "{", 'async': 'true'
+        })
+        self.assertIn('error', json.loads(response.content))
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+
+
+class BatchTest(StoreTestCase):
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        self.store = util.store_batch_fragments
+        self.generated = []
+        util.store_batch_fragments = self.store_batch
+
+    def tearDown(self):
+        util.store_batch_fragments = self.store
+        StoreTestCase.tearDown(self)
+
+    def store_batch(self, molecules, outfiles, repo=None, shell_size=None):
+        """Stands in for the generator: carbons are reported missing."""
+        acks = []
+        for md, outfile in zip(molecules, outfiles):
+            self.generated.append(md)
+            outfile = outfile or util.new_name()
+            missing = [a['id'] for a in md['atoms'] if a['type'] == 12]
+            self.put_off(outfile, {'molecules': [], 'missing_atoms': missing})
+            acks.append({'off': outfile, 'missing_atoms': missing})
+        return acks
+
+    def post(self, url, data):
+        response = self.client.post(url, {'data': json.dumps(data)})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_generate_batch(self):
+        """
+        Tests that a batch reuses stored ATB results, generates identical
+        molecules once and answers a repeated batch from the store.
+        """
+        self.put_off(util.get_atb_outfile("42"),
+                     {'molecules': [], 'missing_atoms': [7]})
+        molecules = [
+            {'molid': "42", 'atoms': [{'id': 7, 'type': 12}], 'bonds': []},
+            {'atoms': [{'id': 1, 'type': 12}, {'id': 2, 'type': 20}],
+             'bonds': [{'a1': 1, 'a2': 2}]},
+            {'atoms': [{'id': 20, 'type': 20}, {'id': 10, 'type': 12}],
+             'bonds': [{'a1': 10, 'a2': 20}]},
+        ]
+        acks = self.post('/generate/batch/', {'molecules': molecules})
+        results = acks['results']
+        self.assertEqual(results[0], {'off': util.get_atb_outfile("42"),
+                                      'missing_atoms': [7]})
+        self.assertEqual(len(self.generated), 1)
+        self.assertEqual(results[1]['missing_atoms'], [1])
+        self.assertEqual(results[2]['missing_atoms'], [10])
+        for result in results:
+            self.assertTrue(STORE.exists(result['off']))
+
+        again = self.post('/generate/batch/', {'molecules': molecules[1:]})
+        self.assertEqual(len(self.generated), 1)
+        self.assertEqual(again['results'][0], results[1])
+
+        self.assertIn('error', self.post('/generate/batch/', {}))
+
+    def test_load_batch(self):
+        """
+        Tests that one request answers several needles from the same file.
+        """
+        self.put_off("batch.off", {'missing_atoms': [], 'molecules': [
+            {'atb_id': "1", 'fragments': [
+                {'score': 2, 'pairs': [{'id1': 1, 'id2': 3, 'charge': 0.5},
+                                       {'id1': 2, 'id2': 4, 'charge': 0.0}]},
+                {'score': 5, 'pairs': [{'id1': 2, 'id2': 4, 'charge': 0.1}]},
+            ]},
+        ]})
+        results = self.post('/load/batch/', {
+            'off': "batch.off", 'needles': [[2], [1, 2], [3]]
+        })['results']
+        scores = lambda k: [f['score'] for f in results[k]['fragments']]
+        self.assertEqual(scores("2"), [5, 2])
+        self.assertEqual(scores("1,2"), [2])
+        self.assertEqual(scores("3"), [])
+
+        self.assertIn('error', self.post('/load/batch/', {
+            'off': "batch.off", 'needles': [[]]
+        }))
+        self.assertIn('error', self.post('/load/batch/', {
+            'off': "missing.off", 'needles': [[1]]
+        }))
+
+
+class InvalidateTest(RepositoryTestCase):
+    def setUp(self):
+        RepositoryTestCase.setUp(self)
+        self.write_molecule("1", "@nodes\n")
+
+    def put_entry(self, name, digest):
+        self.put_off(name, {'molecules': [], 'missing_atoms': []})
+        manifest.record(name, "lipids", 1, digest,
+                        fragment_generator.build_id(), "{}")
+
+    def put_file(self, name, content):
+        with STORE.write(name) as path:
+            with open(path, 'w') as fp:
+                fp.write(content)
+
+    def test_invalidate(self):
+        """
+        Tests that stale and unrecorded .off files are removed together with
+        the .key and statistics files that refer to them.
+        """
+        self.put_entry("fresh.off",
+                       fragment_generator.CATALOG.digest("lipids"))
+        self.put_entry("stale.off", "outdated")
+        self.put_off("orphan.off", {'molecules': [], 'missing_atoms': []})
+        self.put_file("fresh.key", json.dumps({'off': "fresh.off"}))
+        self.put_file("stale.key", json.dumps({'off': "stale.off"}))
+        self.put_file("broken.key", "{")
+        self.put_file("fresh.off" + charge_stats.EXTENSION, "")
+        self.put_file("stale.off" + charge_stats.EXTENSION, "")
+
+        stale = util.invalidate_stored_fragments()
+        self.assertEqual(sorted(e[0] for e in stale),
+                         ["orphan.off", "stale.off"])
+        self.assertEqual(
+            sorted(STORE.names()),
+            ["fresh.key", "fresh.off", "fresh.off" + charge_stats.EXTENSION]
+        )
+        self.assertEqual([e[0] for e in manifest.entries()], ["fresh.off"])
+
+        # Changing the repository makes what was generated from it stale
+        self.write_molecule("1", "@nodes\n@edges\n")
+        stale = util.invalidate_stored_fragments()
+        self.assertEqual([e[0] for e in stale], ["fresh.off"])
+        self.assertEqual(list(STORE.names()), [])
+        self.assertEqual(manifest.entries(), [])
+
+
+class InlinePool:
+    """Runs generator jobs in the test process."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, target, **kwargs):
+        self.jobs.append(target.__name__)
+        return target(**kwargs)
+
+
+class GeneratorTestCase(RepositoryTestCase):
+    """Runs the generator in-process against the fake matcher."""
+
+    MOLECULE = {
+        'atoms': [{'id': 1, 'type': 12}, {'id': 2, 'type': 12},
+                  {'id': 3, 'type': 3}, {'id': 4, 'type': 20},
+                  {'id': 5, 'type': 8}],
+        'bonds': [{'a1': 1, 'a2': 2}, {'a1': 2, 'a2': 3}, {'a1': 3, 'a2': 4},
+                  {'a1': 1, 'a2': 5}]
+    }
+
+    def setUp(self):
+        RepositoryTestCase.setUp(self)
+        # The repository molecule lacks atom 5, which is left missing
+        self.write_molecule("7", molecule_graph.from_molecule({
+            'atoms': self.MOLECULE['atoms'][:4],
+            'bonds': self.MOLECULE['bonds'][:3]
+        }).to_lgf())
+        self.generator = fragment_generator.GENERATOR
+        self.pool = util.GENERATOR_POOL
+        fragment_generator.GENERATOR = "%s %s/fake_fragments.py" % (
+            sys.executable, util.BINDIR
+        )
+        util.GENERATOR_POOL = InlinePool()
+
+    def tearDown(self):
+        fragment_generator.GENERATOR = self.generator
+        util.GENERATOR_POOL = self.pool
+        RepositoryTestCase.tearDown(self)
+
+    def generate(self, md, shell, **args):
+        return util.generate_fragments(dict(args, **{
+            'data': json.dumps({'molecule': md}), 'shell': shell
+        }))
+
+
+class ShellsTest(GeneratorTestCase):
+
+    def test_atb_outfiles(self):
+        """
+        Tests that every shell size of an ATB molecule is stored under the
+        file name a request for just that shell size looks up.
+        """
+        md = dict(self.MOLECULE, molid="42")
+        results = self.generate(md, "1-2")['results']
+        self.assertEqual(util.GENERATOR_POOL.jobs, ['run_shells'])
+        for shell in [1, 2]:
+            result = results[str(shell)]
+            self.assertEqual(result['off'],
+                             util.get_atb_outfile("42", None, shell))
+            self.assertFalse(result.get('partial'))
+            self.assertEqual(manifest.entry(result['off'])[2], str(shell))
+            self.assertEqual(self.generate(md, str(shell)), result)
+        self.assertEqual(util.GENERATOR_POOL.jobs, ['run_shells'])
+
+    def test_structure_keys(self):
+        """
+        Tests that every shell size of a molecule without ATB id is stored
+        under its structure key, so that the same structure with other atom
+        ids is answered from the store.
+        """
+        results = self.generate(self.MOLECULE, "1,2")['results']
+        self.assertEqual(util.GENERATOR_POOL.jobs, ['run_shells'])
+        renumber = lambda aid: aid + 10
+        renumbered = {
+            'atoms': [dict(a, id=renumber(a['id']))
+                      for a in reversed(self.MOLECULE['atoms'])],
+            'bonds': [{'a1': renumber(b['a1']), 'a2': renumber(b['a2'])}
+                      for b in self.MOLECULE['bonds']]
+        }
+        for shell in [1, 2]:
+            result = results[str(shell)]
+            self.assertTrue(STORE.exists(result['off']))
+            self.assertIn(5, result['missing_atoms'])
+            again = self.generate(renumbered, str(shell))
+            self.assertNotEqual(again['off'], result['off'])
+            self.assertEqual(sorted(again['missing_atoms']),
+                             sorted(map(renumber, result['missing_atoms'])))
+        self.assertEqual(util.GENERATOR_POOL.jobs, ['run_shells'])
+
+
+class PartialTest(GeneratorTestCase):
+    def setUp(self):
+        GeneratorTestCase.setUp(self)
+        self.timeout = settings.MATCHER_TIMEOUT
+
+    def tearDown(self):
+        settings.MATCHER_TIMEOUT = self.timeout
+        os.environ.pop("FAKE_FRAGMENTS_LATENCY", None)
+        GeneratorTestCase.tearDown(self)
+
+    def test_partial(self):
+        """
+        Tests that a result that left out molecules is recorded as partial,
+        is never stored under the requested name or a structure key, and is
+        not reused as the previous version of a molecule.
+        """
+        md = dict(self.MOLECULE, molid="42")
+        outfile = util.get_atb_outfile("42")
+        settings.MATCHER_TIMEOUT = 0.2
+        os.environ["FAKE_FRAGMENTS_LATENCY"] = "5"
+        ack = self.generate(md, "1")
+        self.assertTrue(ack['partial'])
+        self.assertEqual(ack['skipped'], ["7"])
+        self.assertNotEqual(ack['off'], outfile)
+        self.assertFalse(STORE.exists(outfile))
+        self.assertEqual(manifest.skipped(ack['off']), ["7"])
+        self.assertEqual(list(STORE.names()), [ack['off']])
+
+        settings.MATCHER_TIMEOUT = self.timeout
+        os.environ.pop("FAKE_FRAGMENTS_LATENCY")
+        edited = dict(md, atoms=md['atoms'][:4], bonds=md['bonds'][:3])
+        again = self.generate(edited, "1", previous=ack['off'])
+        self.assertFalse(again.get('partial'))
+        self.assertFalse('recomputed_atoms' in again)
+        self.assertEqual(again['off'], outfile)
+        self.assertEqual(manifest.skipped(outfile), None)
+        index = fragment_finder.load_index(outfile)
+        self.assertEqual([m['atb_id'] for m in index.off['molecules']], ["7"])
+
+
+class RegenerateTest(GeneratorTestCase):
+
+    def chain(self, types):
+        return {
+            'atoms': [{'id': i + 1, 'type': t} for i, t in enumerate(types)],
+            'bonds': [{'a1': i, 'a2': i + 1} for i in range(1, len(types))]
+        }
+
+    def fragments(self, outfile):
+        off = fragment_finder.load_off(outfile)
+        return dict((m['atb_id'], sorted(json.dumps(f, sort_keys=True)
+                                         for f in m['fragments']))
+                    for m in off['molecules'])
+
+    def test_splice(self):
+        """
+        Tests that regenerating an edited molecule from its previous version
+        only matches the atoms near the edit, and gives the fragments and
+        missing atoms of a full run.
+        """
+        # No atom has two neighbours of the same type
+        types = [12, 3, 20, 8, 12, 16, 3, 20, 12, 8, 16, 3]
+        self.write_molecule("8", molecule_graph.from_molecule(
+            self.chain(types)).to_lgf())
+        edited = self.chain(types)
+        edited['atoms'][8]['type'] = 14
+        for shell in [1, 2]:
+            ack = self.generate(self.chain(types), str(shell))
+            again = self.generate(edited, str(shell), previous=ack['off'])
+            self.assertEqual(again['recomputed_atoms'],
+                             range(9 - shell, 10 + shell))
+
+            full = fragment_generator.generate(
+                json.dumps({'molecule': edited}), shell=str(shell))
+            self.assertEqual(sorted(again['missing_atoms']),
+                             sorted(full['missing_atoms']))
+            # Only the atoms within shell bonds of the edit have no match
+            fragments = self.fragments(full['off'])
+            self.assertEqual(len(fragments["8"]), len(types) - 1 - 2 * shell)
+            self.assertEqual(self.fragments(again['off']), fragments)
+
+
+class MoleculeDiffTest(TestCase):
+    def test_affected_atoms(self):
+        """
+        Tests that retyped atoms and the ends of added or removed bonds affect
+        the atoms within shell bonds of them in either version.
+        """
+        chain = lambda n: {
+            'atoms': [{'id': i, 'type': 12} for i in range(1, n + 1)],
+            'bonds': [{'a1': i, 'a2': i + 1} for i in range(1, n)]
+        }
+        old = chain(9)
+        new = chain(9)
+        new['atoms'][0]['type'] = 3
+        self.assertEqual(molecule_diff.affected_atoms(old, new, 2),
+                         set([1, 2, 3]))
+
+        new = chain(9)
+        new['bonds'].pop()
+        self.assertEqual(molecule_diff.affected_atoms(old, new, 1),
+                         set([7, 8, 9]))
+        new = chain(8)
+        self.assertEqual(molecule_diff.affected_atoms(old, new, 1),
+                         set([7, 8, 9]))
+        self.assertEqual(molecule_diff.submolecule(new, set([7, 8])),
+                         {'atoms': new['atoms'][6:],
+                          'bonds': [{'a1': 7, 'a2': 8}]})
+
+
+class MoleculeGraphTest(TestCase):
+    def test_graph(self):
+        """
+        Tests neighbour and hydrogen lookups by atom number, and that the graph
+        is written as the LGF the generator has always produced.
+        """
+        molecule = {
+            'atoms': [{'id': 7, 'type': 12}, {'id': 3, 'type': 20},
+                      {'id': 5, 'type': 3}, {'id': 9, 'type': 20}],
+            'bonds': [{'a1': 3, 'a2': 7}, {'a1': 7, 'a2': 5},
+                      {'a1': 5, 'a2': 9}]
+        }
+        graph = molecule_graph.from_molecule(molecule)
+        self.assertEqual(graph.index(5), 2)
+        self.assertEqual(sorted(graph.neighbours(0)), [1, 2])
+        self.assertEqual(graph.degree(3), 1)
+        self.assertEqual(graph.hydrogens(0), [1])
+        self.assertEqual(graph.heavy_atoms(), [0, 2])
+        lines = graph.to_lgf().splitlines()
+        self.assertEqual(lines[2:4],
+                         ["0\t7\tX\t12\t0\t0\t0\t0\t",
+                          "0\t3\tX\t20\t0\t0\t0\t0\t"])
+        self.assertEqual(lines[-3:],
+                         ["3\t7\t0\t", "7\t5\t1\t", "5\t9\t2\t"])
+
+
+class QueryTest(TestCase):
+    def test_parse(self):
+        """
+        Tests that a query keeps its JSON text and that molecules whose bonds
+        do not join atoms of the molecule are rejected.
+        """
+        text = '{"molecule": {"atoms": [{"id": 1, "type": 12}], "bonds": []}}'
+        q = query.parse(text)
+        self.assertEqual(q.text, text)
+        self.assertEqual(q.molecule['atoms'], [{'id': 1, 'type': 12}])
+        self.assertTrue(query.as_query(q) is q)
+
+        for text in ['[]', '{"molecule": {"atoms": []}}',
+                     '{"molecule": {"atoms": [], "bonds": [{"a1": 1}]}}']:
+            self.assertRaises(query.QueryError, query.parse, text)
+
+
+class MatcherTimeoutTest(TestCase):
+    def setUp(self):
+        self.generator = fragment_generator.GENERATOR
+        fragment_generator.GENERATOR = "sleep 10 ||"
+
+    def tearDown(self):
+        fragment_generator.GENERATOR = self.generator
+
+    def test_timeout(self):
+        """
+        Tests that a matcher running out of time is killed and that molecules
+        of a timed out run are reported as such.
+        """
+        start = time()
+        self.assertRaises(
+            fragment_generator.MatcherTimeout,
+            fragment_generator.generate_molecule_fragments,
+            "1", "molecule.lgf", 1, "query.lgf", None, 0.2
+        )
+        self.assertTrue(time() - start < 5)
+
+        limits = fragment_generator.Limits(time() - 1)
+        results = list(fragment_generator.match_molecules(
+            [("1", "molecule.lgf", "query.lgf", 1)], 1, None, limits
+        ))
+        self.assertEqual(results, [{'atb_id': "1", 'fragments': [],
+                                    'timed_out': True}])
+
+
+class FileLockTest(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.path = os.path.join(self.dir, "key.lock")
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_timeout(self):
+        """
+        Tests that a held lock makes other holders wait and time out.
+        """
+        with file_lock(self.path, 1):
+            def nested():
+                with file_lock(self.path, 0.1):
+                    pass
+            self.assertRaises(LockTimeout, nested)
+        with file_lock(self.path, 0.1):
+            pass
+
+    def test_release_removes_file(self):
+        """
+        Tests that lock files do not pile up once their locks are released.
+        """
+        with file_lock(self.path, 1):
+            self.assertTrue(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_waiter_after_removal(self):
+        """
+        Tests that a holder waiting on a removed lock file does not share the
+        lock with a holder of the new file.
+        """
+        acquired = []
+        def wait():
+            with file_lock(self.path, 5):
+                acquired.append(os.path.exists(self.path))
+                sleep(0.5)
+        with file_lock(self.path, 1):
+            waiter = Thread(target=wait)
+            waiter.start()
+            sleep(0.1)
+        sleep(0.2)
+        def nested():
+            with file_lock(self.path, 0.05):
+                pass
+        self.assertRaises(LockTimeout, nested)
+        waiter.join()
+        self.assertEqual(acquired, [True])
+        self.assertFalse(os.path.exists(self.path))
+
+
+class EnvironmentIndexTest(TestCase):
+    def test_environment_hashes(self):
+        """
+        Tests that atoms only share a hash when their environments within
+        the shell size are identical.
+        """
+        lgf = "@nodes\nlabel\tatomType\t\n%s@edges\n\t\tlabel\t\n%s"
+        ethanol = lgf % ("1\t12\t\n2\t12\t\n3\t3\t\n",
+                         "1\t2\t0\t\n2\t3\t1\t\n")
+        ethane = lgf % ("1\t12\t\n2\t12\t\n", "1\t2\t0\t\n")
+        h1 = environment_index.lgf_hashes(ethanol, 1)
+        h2 = environment_index.lgf_hashes(ethane, 1)
+        self.assertEqual(len(h1), 3)
+        self.assertEqual(len(h1 & h2), 1)
+        self.assertEqual(
+            len(environment_index.lgf_hashes(ethanol, 2) &
+                environment_index.lgf_hashes(ethane, 2)), 0
+        )
+
+
+class PrefilterTest(GeneratorTestCase):
+    """Checks the environment prefilter against the matcher's own output."""
+
+    QUERIES = [
+        GeneratorTestCase.MOLECULE,
+        {'atoms': [{'id': i, 'type': t} for i, t in
+                   enumerate([12, 12, 3, 12, 8, 20], 1)],
+         'bonds': [{'a1': 1, 'a2': 2}, {'a1': 2, 'a2': 3}, {'a1': 3, 'a2': 4},
+                   {'a1': 4, 'a2': 5}, {'a1': 4, 'a2': 6}]},
+        {'atoms': [{'id': i, 'type': 16} for i in range(1, 4)],
+         'bonds': [{'a1': 1, 'a2': 2}, {'a1': 2, 'a2': 3}]},
+    ]
+
+    def setUp(self):
+        GeneratorTestCase.setUp(self)
+        self.indexdir = environment_index.INDEXDIR
+        environment_index.INDEXDIR = mkdtemp()
+        environment_index._indexes.pop("lipids", None)
+        self.write_molecule("8", molecule_graph.from_molecule(
+            self.QUERIES[1]).to_lgf())
+        self.write_molecule("9", molecule_graph.from_molecule({
+            'atoms': [{'id': 1, 'type': 33}, {'id': 2, 'type': 34}],
+            'bonds': [{'a1': 1, 'a2': 2}]
+        }).to_lgf())
+
+    def tearDown(self):
+        rmtree(environment_index.INDEXDIR)
+        environment_index.INDEXDIR = self.indexdir
+        environment_index._indexes.pop("lipids", None)
+        GeneratorTestCase.tearDown(self)
+
+    def check_candidates(self):
+        """
+        Checks that no molecule the matcher returns fragments for is filtered
+        out; returns the number of molecules that are.
+        """
+        molfiles = fragment_generator.list_molecules("lipids")
+        dropped = 0
+        for shell in [1, 2]:
+            for md in self.QUERIES:
+                lgf = molecule_graph.from_molecule(md).to_lgf()
+                matched = set(
+                    mf['atb_id'] for mf in fragment_generator.match_query(
+                        lgf, "lipids", shell, jobs=1)
+                    if len(mf['fragments']) > 0)
+                candidates = set(name for name, _ in
+                                 environment_index.candidate_molecules(
+                                     "lipids", molfiles, shell, lgf))
+                self.assertEqual(matched - candidates, set())
+                dropped += len(molfiles) - len(candidates)
+        return dropped
+
+    def test_fake_matcher(self):
+        """
+        Tests that the prefilter keeps every molecule the fake matcher finds
+        fragments in, and leaves out some that it does not.
+        """
+        self.assertTrue(self.check_candidates() > 0)
+
+    @skipIf(not os.path.isfile(fragment_generator.GENERATOR),
+            "The mop matcher is not built")
+    def test_matcher(self):
+        """
+        Tests that the prefilter keeps every molecule the mop matcher finds
+        fragments in.
+        """
+        fragment_generator.GENERATOR = self.generator
+        self.check_candidates()
+
+
+class FragmentStoreTest(TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.store = FragmentStore(self.dir, max_entries=2)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def put(self, name):
+        with self.store.write(name) as path:
+            with open(path, 'w') as fp:
+                fp.write(name)
+
+    def test_sharding(self):
+        """
+        Tests that files are written into shards and only show up complete.
+        """
+        with self.store.write("a.off") as path:
+            self.assertFalse(self.store.exists("a.off"))
+        self.assertTrue(self.store.exists("a.off"))
+        self.assertNotEqual(os.path.dirname(self.store.path("a.off")),
+                            self.dir)
+        self.assertEqual(list(self.store.names()), ["a.off"])
+        self.assertRaises(InvalidName, self.store.path, "../a.off")
+
+    def test_lru_eviction(self):
+        """
+        Tests that the least recently used file is evicted when the store
+        outgrows its budget.
+        """
+        self.put("a.off")
+        self.put("b.off")
+        self.store.touch("a.off")
+        self.store.flush()
+        self.put("c.off")
+        self.assertEqual(sorted(self.store.names()), ["a.off", "c.off"])
+        self.assertEqual(self.store.stats()['entries'], 2)
+
+    def test_migrate(self):
+        """
+        Tests that files of the flat layout are moved into their shards and
+        that files gone meanwhile are skipped.
+        """
+        for name in ("a.off", "b.key"):
+            with open("%s/%s" % (self.dir, name), 'w') as fp:
+                fp.write(name)
+        rename = os.rename
+        def vanish(src, dst):
+            if src.endswith("b.key"):
+                os.remove(src)
+            rename(src, dst)
+        os.rename = vanish
+        try:
+            self.assertEqual(self.store.migrate(), ["a.off"])
+        finally:
+            os.rename = rename
+        self.assertEqual(list(self.store.names()), ["a.off"])
+        self.assertEqual(self.store.stats()['entries'], 1)
+        self.assertEqual(self.store.migrate(), [])
+
+
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        util.cache.clear()
+
+    def test_vary_accept(self):
+        """
+        Tests that cached responses are kept apart by Accept header, so that
+        a compact response is never served to a plain request.
+        """
+        compact = self.client.get(
+            '/repos/', HTTP_ACCEPT="application/vnd.omfraf.compact+json"
+        )
+        self.assertIn('Accept', compact['Vary'])
+        self.assertNotIn('\n', compact.content)
+        plain = self.client.get('/repos/')
+        self.assertIn('\n', plain.content)
+        self.assertEqual(json.loads(plain.content),
+                         json.loads(compact.content))
+
+
+class ResponseFormatTest(StoreTestCase):
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        self.threshold = settings.STREAM_THRESHOLD
+        self.chunk_size = settings.STREAM_CHUNK_SIZE
+        self.put_off("format.off", {'missing_atoms': [], 'molecules': [
+            {'atb_id': "1", 'fragments': map(
+                lambda s: {'score': s, 'pairs': [
+                    {'id1': 1, 'id2': s, 'charge': 0.5}]},
+                range(1, 8)
+            )},
+        ]})
+        self.query = {'data': json.dumps({'off': "format.off", 'needle': [1]})}
+
+    def tearDown(self):
+        settings.STREAM_THRESHOLD = self.threshold
+        settings.STREAM_CHUNK_SIZE = self.chunk_size
+        StoreTestCase.tearDown(self)
+
+    def test_compact(self):
+        """
+        Tests that format=compact and the compact media type both drop the
+        indentation but not any of the content.
+        """
+        plain = self.client.post('/load/', self.query)
+        self.assertIn('\n  ', plain.content)
+        expected = json.loads(plain.content)
+        self.assertEqual(len(expected['fragments']), 7)
+
+        by_param = self.client.post('/load/', dict(self.query,
+                                                   format='compact'))
+        by_type = self.client.post(
+            '/load/', self.query,
+            HTTP_ACCEPT="application/vnd.omfraf.compact+json"
+        )
+        for response in (by_param, by_type):
+            self.assertFalse(response.streaming)
+            self.assertNotIn(' ', response.content)
+            self.assertEqual(json.loads(response.content), expected)
+
+    def test_streamed(self):
+        """
+        Tests that results above the threshold are streamed in compact
+        chunks that join up to the same document.
+        """
+        expected = json.loads(self.client.post('/load/', self.query).content)
+        settings.STREAM_THRESHOLD = 5
+        settings.STREAM_CHUNK_SIZE = 3
+        response = self.client.post('/load/', self.query)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], "application/json")
+        parts = list(response.streaming_content)
+        self.assertTrue(len(parts) > 3)
+        content = "".join(parts)
+        self.assertNotIn(' ', content)
+        self.assertEqual(json.loads(content), expected)
+
+
+class MetricsTest(TestCase):
+    def test_render(self):
+        """
+        Tests that counters and histograms render in the Prometheus text
+        format, with cumulative buckets.
+        """
+        metrics = Registry(buckets=(0.1, 1))
+        metrics.describe("requests_total", "counter", "Requests.")
+        metrics.describe("duration_seconds", "histogram", "Duration.")
+        metrics.inc("requests_total", view="load")
+        metrics.inc("requests_total", 2, view="load")
+        metrics.observe("duration_seconds", 0.05)
+        metrics.observe("duration_seconds", 0.5)
+        lines = metrics.render().splitlines()
+        self.assertIn('requests_total{view="load"} 3', lines)
+        self.assertIn('duration_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('duration_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('duration_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('duration_seconds_count 2', lines)
+        self.assertIn('# TYPE duration_seconds histogram', lines)
+
+    def test_shared(self):
+        """
+        Tests that the counters and histograms of every process sharing a
+        directory are added up, that those of processes that are gone are
+        kept, and that gauges are the rendering process's own.
+        """
+        dir = mkdtemp()
+        live = Popen(["sleep", "30"])
+        dead = Popen(["true"])
+        dead.wait()
+        try:
+            metrics = Registry(buckets=(1,))
+            metrics.describe("requests_total", "counter", "Requests.")
+            metrics.describe("duration_seconds", "histogram", "Duration.")
+            metrics.describe("store_bytes", "gauge", "Bytes.")
+            metrics.share(dir)
+            metrics.inc("requests_total", view="load")
+            metrics.observe("duration_seconds", 0.5)
+            metrics.set("store_bytes", 7)
+            load = ("requests_total", (("view", "load"),))
+            write_series("%s/%s-a.json" % (dir, live.pid), {
+                load: 2, ("duration_seconds", ()): [0, 2.0, 1]
+            })
+            write_series("%s/%s-b.json" % (dir, dead.pid), {
+                load: 5, ("store_bytes", ()): 100
+            })
+
+            lines = metrics.render().splitlines()
+            self.assertIn('requests_total{view="load"} 8', lines)
+            self.assertIn('duration_seconds_bucket{le="1"} 1', lines)
+            self.assertIn('duration_seconds_count 2', lines)
+            self.assertIn('store_bytes 7', lines)
+            self.assertFalse(os.path.exists(
+                "%s/%s-b.json" % (dir, dead.pid)
+            ))
+            self.assertEqual(metrics.render().splitlines(), lines)
+        finally:
+            live.kill()
+            live.wait()
+            rmtree(dir)
+
+
+class WorkerPoolTest(TestCase):
+    def test_recycling(self):
+        """
+        Tests that workers are reused and replaced after max_jobs jobs.
+        """
+        pool = WorkerPool(1, 0, 2)
+        first = pool.submit(pid_job)
+        self.assertEqual(pool.submit(pid_job), first)
+        self.assertNotEqual(pool.submit(pid_job), first)
+
+    def test_initializer(self):
+        """
+        Tests that every worker runs the initializer before its first job.
+        """
+        pool = WorkerPool(1, 0, 2, initializer=initialize_worker)
+        for _ in range(2):
+            self.assertEqual(pool.submit(initialized_job),
+                             str(pool.submit(pid_job)))
+
+    def test_crash(self):
+        """
+        Tests that a crashed worker is reported and replaced.
+        """
+        pool = WorkerPool(1, 0, 10)
+        self.assertRaises(WorkerCrashError, pool.submit, pid_job, crash=True)
+        self.assertTrue(pool.submit(pid_job) > 0)
+
+    def test_deadline(self):
+        """
+        Tests that a job overrunning its deadline is given up and that its
+        worker is killed and replaced.
+        """
+        pool = WorkerPool(1, 0, 10, grace=0.5)
+        first = pool.submit(pid_job)
+        start = time()
+        self.assertRaises(WorkerTimeoutError, pool.submit, pid_job,
+                          deadline=time(), seconds=30)
+        self.assertTrue(time() - start < 10)
+        self.assertRaises(OSError, os.kill, first, 0)
+        self.assertNotEqual(pool.submit(pid_job), first)
+
+    @skipIf(not os.path.isdir("/proc"), "No /proc to list processes in")
+    def test_kill_matchers(self):
+        """
+        Tests that a worker killed past its deadline takes the matchers its
+        job started with it.
+        """
+        dir = mkdtemp()
+        infile = "%s/query.lgf" % dir
+        for name in [infile, "%s/7.lgf" % dir]:
+            with open(name, 'w') as fp:
+                fp.write(molecule_graph.from_molecule(
+                    GeneratorTestCase.MOLECULE).to_lgf())
+
+        def matchers():
+            pids = []
+            for pid in filter(str.isdigit, os.listdir("/proc")):
+                try:
+                    with open("/proc/%s/cmdline" % pid) as fp:
+                        if infile in fp.read():
+                            pids.append(pid)
+                except IOError:
+                    pass
+            return pids
+
+        os.environ["OMFRAF_GENERATOR"] = "%s %s/fake_fragments.py" % (
+            sys.executable, util.BINDIR)
+        os.environ["FAKE_FRAGMENTS_LATENCY"] = "30"
+        try:
+            pool = WorkerPool(1, 0, 10, grace=2)
+            self.assertRaises(WorkerTimeoutError, pool.submit, matcher_job,
+                              infile=infile, molfile="%s/7.lgf" % dir,
+                              deadline=time())
+            for _ in range(50):
+                if len(matchers()) == 0:
+                    break
+                sleep(0.1)
+            self.assertEqual(matchers(), [])
+        finally:
+            os.environ.pop("OMFRAF_GENERATOR")
+            os.environ.pop("FAKE_FRAGMENTS_LATENCY")
+            rmtree(dir)
+
+    def test_interpreter(self):
+        """
+        Tests that workers run on Python when this process is not a Python
+        binary, as under mod_wsgi, and on GENERATOR_PYTHON when it is set.
+        """
+        executable = sys.executable
+        sys.executable = "/usr/sbin/httpd"
+        try:
+            python = interpreter()
+            self.assertTrue(os.path.basename(python).startswith("python"))
+            self.assertTrue(WorkerPool(1, 0, 1).submit(pid_job) > 0)
+        finally:
+            sys.executable = executable
+        self.assertEqual(interpreter("/opt/venv/bin/python"),
+                         "/opt/venv/bin/python")
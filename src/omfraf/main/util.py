@@ -1,10 +1,21 @@
+from contextlib import contextmanager
 from django.core.cache import cache
+from hashlib import sha1
 import json
 import logging
 import omfraf
+from omfraf.main import settings
+from omfraf.main.jobs import BackgroundExecutor, JobStore, QueueFullError
+from omfraf.main.locking import file_lock, LockTimeout
+from omfraf.main.metrics import METRICS
+from omfraf.main.pool import WorkerPool, PoolFullError, WorkerCrashError, \
+    WorkerTimeoutError
 import os
 from subprocess import Popen, PIPE, STDOUT
 import re
+import sys
+from threading import Thread
+from time import time
 
 
 logger = logging.getLogger('omfraf')
@@ -12,12 +23,49 @@ logger = logging.getLogger('omfraf')
 DEFAULTSHELL = 1
 DEFAULTREPO = "lipids"
 BINDIR = os.path.normpath("%s/../bin/" % os.path.dirname(omfraf.__file__))
-REPODIR = os.path.normpath("%s/mop/data/fragments/" % BINDIR)
 FRAGMENTSDIR = "%s/fragments" % BINDIR
+LOCKSDIR = "%s/locks" % FRAGMENTSDIR
+JOBSDIR = "%s/jobs" % FRAGMENTSDIR
+METRICSDIR = "%s/metrics" % FRAGMENTSDIR
 MOPDIR = "%s/mop" % BINDIR
 MOPBINDIR = "%s/build" % MOPDIR
-FRAGMENTGENERATOR = "python fragment_generator.py"
-FRAGMENTFINDER = "python fragment_finder.py"
+
+if BINDIR not in sys.path:
+  sys.path.append(BINDIR)
+import canonical
+import charge_stats
+import fragment_finder
+import fragment_generator
+from fragment_store import STORE, new_name
+import manifest
+from query import as_query, QueryError
+
+OFF_CACHE = fragment_finder.OffCache(settings.OFF_CACHE_SIZE)
+
+STORE.configure(
+  settings.STORE_MAX_BYTES,
+  settings.STORE_MAX_ENTRIES,
+  settings.STORE_EVICTION
+)
+
+# Warm this process's repository catalog (for /repos/) without holding up the
+# first request; generator workers are separate processes and warm their own
+warmup = Thread(target=fragment_generator.CATALOG.refresh)
+warmup.daemon = True
+warmup.start()
+GENERATOR_POOL = WorkerPool(
+  settings.GENERATOR_POOL_SIZE,
+  settings.GENERATOR_QUEUE_SIZE,
+  settings.GENERATOR_MAX_JOBS,
+  settings.GENERATOR_GRACE,
+  fragment_generator.warm_catalog,
+  settings.GENERATOR_PYTHON
+)
+
+METRICS.share(METRICSDIR)
+
+JOBS = JobStore(JOBSDIR, settings.JOB_TTL)
+JOB_EXECUTOR = BackgroundExecutor(settings.JOB_WORKERS, settings.JOB_QUEUE_SIZE)
 
 
 class ValidationError(Exception):
@@ -30,79 +78,308 @@ class FinderError(Exception):
   pass
 
 
-def get_repositories():
-  repos = []
-  for _, dirs, _ in os.walk(REPODIR):
-    repos = dirs
-    break
-
-  return {'repos': repos}
+def get_repositories(details=False):
+  stats = fragment_generator.CATALOG.statistics(details)
+  return {'repos': sorted(stats.keys()), 'statistics': stats}
 
 
 def get_atb_outfile(molid, repo=None, shell=None):
   return "%s_%s_%s.off" % (repo or DEFAULTREPO, shell or DEFAULTSHELL, molid)
 
-def generate_fragments(args):
+def generate_fragments(args, progress=None):
   try:
-    validate_args(args)
+    with METRICS.span("validate"):
+      query = validate_args(args)
   except ValidationError as e:
     return {'error': e.message}
 
   # This is safe now, as all have been validated
-  data = args.get("data")
   repo = args.get("repo", None)
   shell_size = args.get("shell", None)
-
-  md = json.loads(data)["molecule"]
+  previous = args.get("previous", None)
+  if shell_size and re.search("[,-]", shell_size):
+    return generate_fragments_shells(query, args, progress)
+
+  md = query.molecule
+  if md is None:
+    return {'error': "Missing molecule"}
+  data = query.text
+  outfile = None
   if "molid" in md and md["molid"].isdigit():
     outfile = get_atb_outfile(md["molid"], repo, shell_size)
-    off = "%s/%s" % (FRAGMENTSDIR, outfile)
-    if os.path.isfile(off):
-      with open(off, 'r') as fp:
-        try:
-          od = json.loads(fp.read())
-          return {'off': outfile, 'missing_atoms': od['missing_atoms']}
-        except ValueError as e:
-          pass
 
+  # A stored ATB result is found without hashing the structure
+  with METRICS.span("lookup"):
+    ack = find_stored_fragments(outfile)
+  if not ack:
+    with METRICS.span("structure_key"):
+      key, order = get_structure_key(md, repo, shell_size)
+    with METRICS.span("lookup"):
+      ack = find_stored_fragments(outfile, key, order, data)
+  if ack:
+    METRICS.inc("omfraf_stored_fragments_total", result="hit")
+    return ack
+
+  # Identical concurrent requests wait for the first one and reuse its result
+  lockfile = "%s/%s.lock" % (LOCKSDIR, key)
   try:
-    ack = store_fragments(data, repo, shell_size)
+    with file_lock(lockfile, settings.GENERATE_LOCK_TIMEOUT):
+      ack = find_stored_fragments(outfile, key, order, data)
+      if ack:
+        METRICS.inc("omfraf_stored_fragments_total", result="hit")
+        return ack
+
+      METRICS.inc("omfraf_stored_fragments_total", result="miss")
+      with METRICS.span("generate"):
+        ack = store_fragments(query, repo, shell_size, progress, previous)
+      if not ack.get('partial'):
+        save_structure(key, order, ack['off'])
   except GeneratorError as e:
     return {'error': e.message}
+  except LockTimeout as e:
+    return {'error': "Identical request still running (%s)" % e}
 
   return ack
 
-def store_fragments(data, repo=None, shell_size=None):
-  logger.debug("Storing fragments for: %s" % data)
+def generate_fragments_shells(query, args, progress=None):
+  """
+  Generates fragments for several shell sizes (1,2,4 or 1-3) in one
+  generator run, storing every shell size under the file name and structure
+  key that a request for just that shell size looks up.
+  """
+  repo = args.get("repo", None)
 
-  md = json.loads(data)["molecule"]
-  if "molid" in md and md["molid"].isdigit():
-    args = "-o %s" % get_atb_outfile(md["molid"], repo, shell_size)
-  else:
-    args = ""
-  if repo:
-    args += " -r %s" % repo
-  if shell_size:
-    args += " -s %s" % shell_size
+  try:
+    shells = fragment_generator.validate_shell_sizes(args.get("shell"))
+  except fragment_generator.ValidationError as e:
+    return {'error': "Invalid query: %s" % e}
+
+  md = query.molecule
+  if md is None:
+    return {'error': "Missing molecule"}
+  data = query.text
+  outfiles = {}
+  for shell in shells:
+    outfiles[shell] = None
+    if "molid" in md and md["molid"].isdigit():
+      outfiles[shell] = get_atb_outfile(md["molid"], repo, shell)
+
+  # Structure keys are only computed for shell sizes without an ATB result
+  results = dict((s, find_stored_fragments(outfiles[s])) for s in shells)
+  entries = {}
+  for shell in shells:
+    if not results[shell]:
+      key, order = get_structure_key(md, repo, shell)
+      entries[shell] = (outfiles[shell], key, order, data)
+      results[shell] = find_stored_fragments(*entries[shell])
+  pending = filter(lambda s: not results[s], shells)
+  METRICS.inc(
+    "omfraf_stored_fragments_total", len(shells) - len(pending), result="hit"
+  )
 
-  p = Popen(
-    "%s %s \'%s\'" % (FRAGMENTGENERATOR, args, data),
-    cwd=BINDIR,
-    shell=True,
-    stdout=PIPE,
-    stderr=PIPE
+  try:
+    if len(pending) > 0:
+      with generation_locks(set(entries[s][1] for s in pending)):
+        for shell in pending:
+          results[shell] = find_stored_fragments(*entries[shell])
+        todo = filter(lambda s: not results[s], pending)
+        METRICS.inc(
+          "omfraf_stored_fragments_total", len(pending) - len(todo),
+          result="hit"
+        )
+        METRICS.inc("omfraf_stored_fragments_total", len(todo), result="miss")
+
+        if len(todo) > 0:
+          with METRICS.span("generate"):
+            acks = store_shell_fragments(
+              query, todo, dict((s, entries[s][0]) for s in todo), repo,
+              progress
+            )
+          for shell in todo:
+            results[shell] = acks[str(shell)]
+            if not results[shell].get('partial'):
+              save_structure(entries[shell][1], entries[shell][2],
+                             results[shell]['off'])
+  except GeneratorError as e:
+    return {'error': e.message}
+  except LockTimeout as e:
+    return {'error': "Identical request still running (%s)" % e}
+
+  return {'results': dict((str(s), results[s]) for s in shells)}
+
+@contextmanager
+def generation_locks(locks):
+  """Holds the locks of several generations, always taken in the same order."""
+  held = []
+  try:
+    for lock in sorted(locks):
+      lockfile = file_lock(
+        "%s/%s.lock" % (LOCKSDIR, lock), settings.GENERATE_LOCK_TIMEOUT
+      )
+      lockfile.__enter__()
+      held.append(lockfile)
+    yield
+  finally:
+    for lockfile in reversed(held):
+      lockfile.__exit__(None, None, None)
+
+def generate_fragments_batch(args):
+  try:
+    query = validate_args(args)
+  except ValidationError as e:
+    return {'error': e.message}
+
+  # This is safe now, as all have been validated
+  repo = args.get("repo", None)
+  shell_size = args.get("shell", None)
+
+  molecules = query.data.get("molecules")
+  if not molecules:
+    return {'error': "Missing list of molecules"}
+
+  # Structure keys are only computed for molecules without an ATB result
+  entries = []
+  results = []
+  for md in molecules:
+    outfile = None
+    if "molid" in md and md["molid"].isdigit():
+      outfile = get_atb_outfile(md["molid"], repo, shell_size)
+    data = json.dumps({'molecule': md})
+    ack = find_stored_fragments(outfile)
+    key, order = None, None
+    if not ack:
+      key, order = get_structure_key(md, repo, shell_size)
+      ack = find_stored_fragments(outfile, key, order, data)
+    entries.append((outfile, key, order, data))
+    results.append(ack)
+  pending = filter(lambda i: not results[i], range(len(entries)))
+  METRICS.inc(
+    "omfraf_stored_fragments_total", len(entries) - len(pending), result="hit"
   )
+  if len(pending) == 0:
+    return {'results': results}
+
+  # Locks are always taken in the same order, so batches cannot deadlock
+  try:
+    with generation_locks(set(entries[i][1] for i in pending)):
+      # Generate every distinct molecule once; duplicates reuse its result
+      todo = []
+      seen = set()
+      for i in pending:
+        results[i] = find_stored_fragments(*entries[i])
+        if not results[i] and not entries[i][1] in seen:
+          seen.add(entries[i][1])
+          todo.append(i)
+      METRICS.inc(
+        "omfraf_stored_fragments_total", len(pending) - len(todo), result="hit"
+      )
+      METRICS.inc("omfraf_stored_fragments_total", len(todo), result="miss")
+
+      if len(todo) > 0:
+        acks = store_batch_fragments(
+          map(lambda i: molecules[i], todo),
+          map(lambda i: entries[i][0], todo),
+          repo, shell_size
+        )
+        for i, ack in zip(todo, acks):
+          results[i] = ack
+          if not ack.get('partial'):
+            save_structure(entries[i][1], entries[i][2], ack['off'])
+
+      for i in pending:
+        if not results[i]:
+          results[i] = find_stored_fragments(*entries[i]) or \
+              {'error': "Fragments of identical molecule not found"}
+  except GeneratorError as e:
+    return {'error': e.message}
+  except LockTimeout as e:
+    return {'error': "Identical request still running (%s)" % e}
+
+  return {'results': results}
+
+def find_stored_fragments(outfile=None, key=None, order=None, query=None):
+  ack = None
+  if outfile and STORE.exists(outfile):
+    try:
+      od = fragment_finder.load_index(outfile, OFF_CACHE)
+      ack = {'off': outfile, 'missing_atoms': od.missing_atoms}
+    except fragment_finder.OFF_ERRORS as e:
+      pass
+
+  if not ack and key:
+    ack = load_structure(key, order, outfile, query)
+  if ack:
+    manifest.touch(ack['off'])
+  return ack
 
-  out, err = p.communicate()
-  if len(err) > 0:
-    raise GeneratorError(err)
 
-  #logger.debug("FG: %s" % out[:-1])
+def get_structure_key(md, repo=None, shell=None):
+  digest, order = canonical.molecule_hash(md)
+  key = sha1("%s/%s/%s/%s" % (
+    digest, repo or DEFAULTREPO, shell or DEFAULTSHELL,
+    fragment_generator.build_id()
+  )).hexdigest()
+  return key, order
+
+def load_structure(key, order, outfile=None, query=None):
+  try:
+    with open(STORE.path("%s.key" % key), 'r') as fp:
+      entry = json.loads(fp.read())
+    STORE.touch("%s.key" % key)
+    index = fragment_finder.load_index(entry["off"], OFF_CACHE)
+  except (IOError, ValueError, KeyError) + fragment_finder.OFF_ERRORS as e:
+    return None
+
+  if entry["atoms"] == order and outfile in (None, entry["off"]):
+    logger.debug("Reusing fragments of identical molecule: %s" % entry["off"])
+    return {'off': entry["off"], 'missing_atoms': index.missing_atoms}
+
+  # Same structure, different atom numbering: translate the stored result
+  mapping = dict(zip(entry["atoms"], order))
+  od = {'molecules': [], 'missing_atoms': []}
+  for molecule in index.off["molecules"]:
+    fragments = []
+    for fragment in molecule["fragments"]:
+      if "pairs" in fragment:
+        fragments.append(dict(fragment, pairs=map(
+          lambda p: dict(p, id1=mapping[p["id1"]]), fragment["pairs"]
+        )))
+    od["molecules"].append(dict(molecule, fragments=fragments))
+  od["missing_atoms"] = map(lambda aid: mapping[aid], index.missing_atoms)
+
+  outfile = outfile or new_name()
+  with STORE.write(outfile) as path:
+    fragment_generator.write_off(od, path, settings.GENERATOR_FORMAT)
+  manifest.copy(entry["off"], outfile, query)
+  logger.debug("Translated fragments of %s to %s" % (entry["off"], outfile))
+  return {'off': outfile, 'missing_atoms': od["missing_atoms"]}
+
+def save_structure(key, order, outfile):
+  with STORE.write("%s.key" % key) as path:
+    with open(path, 'w') as fp:
+      fp.write(json.dumps({'off': outfile, 'atoms': order}))
+
+def store_fragments(query, repo=None, shell_size=None, progress=None,
+    previous=None):
+  logger.debug("Storing fragments for: %s" % query.text)
+
+  md = query.molecule
+  if "molid" in md and md["molid"].isdigit():
+    outfile = get_atb_outfile(md["molid"], repo, shell_size)
+  else:
+    outfile = None
+
   try:
-    ack = json.loads(out)
-  except ValueError as e:
-    logger.info(out)
-    raise GeneratorError("Generator returned invalid data: (%s)" % e)
+    ack = GENERATOR_POOL.submit(
+      fragment_generator.run, data=query, repo=repo, shell=shell_size,
+      outfile=outfile,
+      jobs=settings.GENERATOR_JOBS, off_format=settings.GENERATOR_FORMAT,
+      progress=progress, prefilter=settings.GENERATOR_PREFILTER,
+      previous=previous, **generator_limits()
+    )
+  except (PoolFullError, WorkerCrashError, WorkerTimeoutError) as e:
+    raise GeneratorError("Generator could not run (%s)" % e)
+  record_generator_timings(ack.pop('timings', None), repo)
 
   if not 'off' in ack:
     if 'error' in ack:
@@ -114,43 +391,178 @@ def store_fragments(data, repo=None, shell_size=None):
   return ack
 
 
-def load_fragments(args):
+def store_shell_fragments(query, shells, outfiles, repo=None, progress=None):
+  logger.debug("Storing fragments of shell sizes %s for: %s" %
+      (shells, query.text))
+
+  try:
+    ack = GENERATOR_POOL.submit(
+      fragment_generator.run_shells, data=query, repo=repo,
+      shells=",".join(map(str, shells)), outfiles=outfiles,
+      jobs=settings.GENERATOR_JOBS, off_format=settings.GENERATOR_FORMAT,
+      progress=progress, prefilter=settings.GENERATOR_PREFILTER,
+      **generator_limits()
+    )
+  except (PoolFullError, WorkerCrashError, WorkerTimeoutError) as e:
+    raise GeneratorError("Generator could not run (%s)" % e)
+  record_generator_timings(ack.pop('timings', None), repo)
+
+  if not 'results' in ack:
+    if 'error' in ack:
+      e = ack['error']
+    else:
+      e = "KeyError: 'results'"
+    raise GeneratorError("Generator could not store fragments (%s)" % e)
+
+  return ack['results']
+
+
+def store_batch_fragments(molecules, outfiles, repo=None, shell_size=None):
+  logger.debug("Storing fragments for %s molecules" % len(molecules))
+
   try:
-    validate_args(args)
+    ack = GENERATOR_POOL.submit(
+      fragment_generator.run_batch, molecules=molecules, outfiles=outfiles,
+      repo=repo, shell=shell_size, jobs=settings.GENERATOR_JOBS,
+      off_format=settings.GENERATOR_FORMAT,
+      prefilter=settings.GENERATOR_PREFILTER, **generator_limits()
+    )
+  except (PoolFullError, WorkerCrashError, WorkerTimeoutError) as e:
+    raise GeneratorError("Generator could not run (%s)" % e)
+  record_generator_timings(ack.pop('timings', None), repo)
+
+  if not 'results' in ack:
+    if 'error' in ack:
+      e = ack['error']
+    else:
+      e = "KeyError: 'results'"
+    raise GeneratorError("Generator could not store fragments (%s)" % e)
+
+  return ack['results']
+
+def record_generator_timings(timings, repo=None):
+  """Adds the stage timings reported by a generator run to the metrics."""
+  if not timings:
+    return
+  repo = repo or DEFAULTREPO
+  stages = timings.get('stages', {})
+  counters = timings.get('counters', {})
+  for stage, seconds in stages.items():
+    METRICS.observe("omfraf_stage_duration_seconds", seconds, stage=stage)
+  METRICS.inc(
+    "omfraf_matcher_calls_total", counters.get('matcher_calls', 0), repo=repo
+  )
+  METRICS.inc(
+    "omfraf_matcher_seconds_total",
+    stages.get('spawn', 0) + stages.get('match', 0),
+    repo=repo
+  )
+  METRICS.inc("omfraf_bytes_written_total", counters.get('bytes_written', 0))
+
+  timeouts = counters.get('matcher_timeouts', 0)
+  skipped = counters.get('skipped_molecules', 0)
+  METRICS.inc("omfraf_matcher_timeouts_total", timeouts, repo=repo)
+  METRICS.inc("omfraf_skipped_molecules_total", skipped, repo=repo)
+  if skipped > 0:
+    logger.warning(
+      "Generator skipped %s molecules of %s after %s matcher timeouts" %
+      (skipped, repo, timeouts)
+    )
+
+def generator_limits():
+  """Returns the deadline and per molecule budget of a generator run."""
+  return {
+    'deadline': time() + settings.GENERATE_DEADLINE,
+    'budget': settings.MATCHER_TIMEOUT
+  }
+
+
+def submit_generation(args):
+  try:
+    query = validate_args(args)
   except ValidationError as e:
     return {'error': e.message}
 
-  # This is safe now, as all have been validated
-  data = args.get("data")
+  job_id = JOBS.create()
+  try:
+    JOB_EXECUTOR.submit(run_generation_job, job_id, dict(args, data=query))
+  except QueueFullError as e:
+    JOBS.remove(job_id)
+    return {'error': "Could not queue generation job (%s)" % e}
+
+  return {'job': job_id, 'status': 'queued'}
+
+def run_generation_job(job_id, args):
+  JOBS.update(job_id, status='running', started=time())
+  try:
+    ack = generate_fragments(args, JOBS.progress_path(job_id))
+  except Exception as e:
+    ack = {'error': "Generation failed (%s)" % e}
+  ack.update({'status': 'done', 'finished': time()})
+  JOBS.update(job_id, **ack)
+
+def get_job(job_id):
+  job = JOBS.get(job_id)
+  if job is None:
+    return {'error': "Unknown job: %s" % job_id}
+  return job
+
+
+def load_fragments(args):
+  try:
+    query = validate_args(args)
+  except ValidationError as e:
+    return {'error': e.message}
 
   try:
-    fragments = get_fragments(data)
+    fragments = get_fragments(query)
   except FinderError as e:
     return {'error': e.message}
 
   return fragments
 
 
-def get_fragments(data):
-  logger.debug("Looking for: %s" % data)
+def load_fragments_batch(args):
+  try:
+    query = validate_args(args)
+  except ValidationError as e:
+    return {'error': e.message}
 
-  p = Popen(
-    "%s \'%s\'" % (FRAGMENTFINDER, data),
-    cwd=BINDIR,
-    shell=True,
-    stdout=PIPE,
-    stderr=PIPE
-  )
+  results = fragment_finder.find_fragments_batch(query, OFF_CACHE)
+  if not 'results' in results:
+    if 'error' in results:
+      e = results['error']
+    else:
+      e = "KeyError: 'results'"
+    return {'error': "Fragment Finder could not find fragments (%s)" % e}
+
+  return results
 
-  out, err = p.communicate()
-  if len(err) > 0:
-    raise FinderError(err)
 
-  #logger.debug("FF: %s" % out[:-1])
+def load_charge_stats(args):
   try:
-    fragments = json.loads(out)
-  except ValueError as e:
-    raise FinderError("Fragment Finder returned invalid data: (%s)" % e)
+    query = validate_args(args)
+  except ValidationError as e:
+    return {'error': e.message}
+
+  with METRICS.span("charge_stats"):
+    stats = charge_stats.find_charge_stats(query, OFF_CACHE)
+  if not 'rows' in stats:
+    if 'error' in stats:
+      e = stats['error']
+    else:
+      e = "KeyError: 'rows'"
+    return {'error': "Could not compute charge statistics (%s)" % e}
+
+  return stats
+
+
+def get_fragments(query):
+  logger.debug("Looking for: %s" % query.text)
+
+  with METRICS.span("find"):
+    fragments = fragment_finder.find_fragments(query, OFF_CACHE)
+  logger.debug("OFF cache: %s" % OFF_CACHE.stats())
 
   if not 'fragments' in fragments:
     if 'error' in fragments:
@@ -162,18 +574,80 @@ def get_fragments(data):
   return fragments
 
 
+def get_metrics():
+  off_cache = OFF_CACHE.stats()
+  METRICS.set("omfraf_off_cache_hits_total", off_cache['hits'])
+  METRICS.set("omfraf_off_cache_misses_total", off_cache['misses'])
+  store = STORE.stats()
+  METRICS.set("omfraf_store_entries", store['entries'])
+  METRICS.set("omfraf_store_bytes", store['bytes'])
+  return METRICS.render()
+
+
 def validate_args(args):
+  """Returns the parsed query of the request arguments."""
   data = args.get("data")
 
   if not data:
     raise ValidationError("Missing query data")
 
   try:
-    _ = json.loads(data)
-  except ValueError as e:
-    raise ValidationError("Query data not in JSON format (%s)" % e)
-
-  return True
+    return as_query(data)
+  except QueryError as e:
+    raise ValidationError(e.message)
+
+
+def invalidate_stored_fragments():
+  """
+  Removes the stored .off files that were generated with another matcher
+  build or from a repository whose content changed, and returns their
+  manifest entries. Files without a manifest entry are removed as well.
+  """
+  catalog = fragment_generator.CATALOG
+  digests = dict((repo, catalog.digest(repo)) for repo in catalog.refresh())
+  stale = manifest.stale_entries(digests, fragment_generator.build_id())
+  names = set(map(lambda e: e[0], stale))
+  known = set(map(lambda e: e[0], manifest.entries())) - names
+
+  removed = []
+  for file in list(STORE.names()):
+    _, ext = os.path.splitext(file)
+    if ext == ".off" and not file in known:
+      if not file in names:
+        stale.append((file, None, None, None, None, None, 0))
+      removed.append(file)
+    elif ext == ".key":
+      # Keys whose .off file is gone can never be used again
+      try:
+        with open(STORE.path(file), 'r') as fp:
+          if json.loads(fp.read())["off"] in known:
+            continue
+      except (IOError, ValueError, KeyError) as e:
+        pass
+      removed.append(file)
+    elif ext == charge_stats.EXTENSION:
+      if file[:-len(ext)] in known:
+        continue
+      removed.append(file)
+
+  STORE.remove(removed)
+  manifest.remove(names)
+  OFF_CACHE.invalidate()
+  return stale
+
+def regenerate_stored_fragments(stale, count):
+  """Queues the `count` most requested of the stale entries again."""
+  queued = []
+  for entry in stale:
+    if len(queued) >= count:
+      break
+    name, repo, shell, _, _, query, requests = entry
+    if not query or requests == 0:
+      continue
+    ack = submit_generation({'data': query, 'repo': repo, 'shell': shell})
+    if 'job' in ack:
+      queued.append(entry)
+  return queued
 
 
 def mop_update():
@@ -199,16 +673,15 @@ def mop_update():
   out, _ = p.communicate()
   res += out
 
-  res += "Removing stored fragment files...\n"
-  p = Popen(
-    "rm -vf *.off",
-    cwd=FRAGMENTSDIR,
-    shell=True,
-    stdout=PIPE,
-    stderr=STDOUT
-  )
-  out, _ = p.communicate()
-  res += out
+  res += "Removing outdated fragment files...\n"
+  stale = invalidate_stored_fragments()
+  res += "".join(map(lambda e: "removed '%s'\n" % e[0], stale))
+
+  res += "Regenerating most requested fragment files...\n"
+  res += "".join(map(
+    lambda e: "queued '%s' (%s requests)\n" % (e[0], e[6]),
+    regenerate_stored_fragments(stale, settings.REGENERATE_TOP)
+  ))
 
   res += "Done.\n"
   return "<pre>\n" + res + "</pre>\n"
@@ -1,11 +1,72 @@
 import json as simplejson
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, Http404, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.cache import patch_vary_headers
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_exempt
 from omfraf.main import settings
+from omfraf.main.metrics import METRICS
 from util import get_repositories, generate_fragments, load_fragments, \
-    mop_update
+    mop_update, submit_generation, get_job, generate_fragments_batch, \
+    load_fragments_batch, load_charge_stats, get_metrics
+
+
+COMPACT_TYPE = "application/vnd.omfraf.compact+json"
+
+
+def compact(data):
+  return simplejson.dumps(
+    data, separators=(',', ':'), default=(lambda o: o.__dict__)
+  )
+
+def iter_compact(data, chunk_size):
+  """Encodes `data` compactly in pieces, splitting long lists into chunks."""
+  if isinstance(data, dict) and len(data) > 0:
+    yield "{"
+    for i, (key, value) in enumerate(data.items()):
+      yield "%s%s:" % ("," if i > 0 else "", compact(key))
+      for part in iter_compact(value, chunk_size):
+        yield part
+    yield "}"
+  elif isinstance(data, list) and len(data) > chunk_size:
+    yield "["
+    for i in range(0, len(data), chunk_size):
+      yield ("," if i > 0 else "") + compact(data[i:i + chunk_size])[1:-1]
+    yield "]"
+  else:
+    yield compact(data)
+
+def result_size(data):
+  """Counts the items of the lists in a result, e.g. its fragments."""
+  if isinstance(data, dict):
+    return sum(map(result_size, data.values()))
+  if isinstance(data, list):
+    return len(data)
+  return 0
+
+def json_response(request, data, status=200):
+  """
+  Encodes compactly when asked for with format=compact or the compact media
+  type, and streams results that are too large to buffer (always compact).
+  """
+  if result_size(data) > settings.STREAM_THRESHOLD:
+    return StreamingHttpResponse(
+      iter_compact(data, settings.STREAM_CHUNK_SIZE),
+      mimetype="application/json"
+    )
+
+  with METRICS.span("encode"):
+    if request.REQUEST.get('format') == 'compact' or \
+        COMPACT_TYPE in request.META.get('HTTP_ACCEPT', ''):
+      content = compact(data)
+    else:
+      content = simplejson.dumps(
+        data, indent=2, default=(lambda o: o.__dict__)
+      )
+  response = HttpResponse(content, mimetype="application/json", status=status)
+  # The encoding depends on Accept, so caches must keep both variants apart
+  patch_vary_headers(response, ['Accept'])
+  return response
 
 
 def index(request):
@@ -13,12 +74,11 @@ def index(request):
 
 @csrf_exempt
 def repos(request):
-  repos = get_repositories()
+  details = request.REQUEST.get('details', 'false').lower() in \
+      ('1', 'true', 'yes')
+  repos = get_repositories(details)
   repos.update({'version': settings.VERSION})
-  return HttpResponse(
-    simplejson.dumps(repos, indent=2, default=(lambda o: o.__dict__)),
-    mimetype="application/json"
-  )
+  return json_response(request, repos)
 
 @csrf_exempt
 def generate(request):
@@ -29,12 +89,31 @@ def generate(request):
   if 'csrfmiddlewaretoken' in params:
     params.pop('csrfmiddlewaretoken')
 
-  ack = generate_fragments(params)
+  if params.pop('async', 'false').lower() in ('1', 'true', 'yes'):
+    ack = submit_generation(params)
+  else:
+    ack = generate_fragments(params)
   ack.update({'version': settings.VERSION})
-  return HttpResponse(
-    simplejson.dumps(ack, indent=2, default=(lambda o: o.__dict__)),
-    mimetype="application/json"
-  )
+  return json_response(request, ack)
+
+@csrf_exempt
+def generate_batch(request):
+  if request.method != 'POST':
+    raise Http404
+
+  params = request.POST.dict()
+  if 'csrfmiddlewaretoken' in params:
+    params.pop('csrfmiddlewaretoken')
+
+  acks = generate_fragments_batch(params)
+  acks.update({'version': settings.VERSION})
+  return json_response(request, acks)
+
+@never_cache
+def job(request, job_id):
+  status = get_job(job_id)
+  status.update({'version': settings.VERSION})
+  return json_response(request, status)
 
 @csrf_exempt
 def load(request):
@@ -47,12 +126,39 @@ def load(request):
 
   fragments = load_fragments(params)
   fragments.update({'version': settings.VERSION})
-  return HttpResponse(
-    simplejson.dumps(fragments, indent=2, default=(lambda o: o.__dict__)),
-    mimetype="application/json"
-  )
+  return json_response(request, fragments)
+
+@csrf_exempt
+def load_batch(request):
+  if request.method != 'POST':
+    raise Http404
+
+  params = request.POST.dict()
+  if 'csrfmiddlewaretoken' in params:
+    params.pop('csrfmiddlewaretoken')
+
+  results = load_fragments_batch(params)
+  results.update({'version': settings.VERSION})
+  return json_response(request, results)
+
+@csrf_exempt
+def load_charges(request):
+  if request.method != 'POST':
+    raise Http404
+
+  params = request.POST.dict()
+  if 'csrfmiddlewaretoken' in params:
+    params.pop('csrfmiddlewaretoken')
+
+  stats = load_charge_stats(params)
+  stats.update({'version': settings.VERSION})
+  return json_response(request, stats, 400 if 'error' in stats else 200)
 
 @never_cache
 def update_mop(request):
   out = mop_update()
   return HttpResponse(out)
+
+@never_cache
+def metrics(request):
+  return HttpResponse(get_metrics(), mimetype="text/plain; version=0.0.4")
@@ -1,6 +1,8 @@
 from time import time
 from logging import getLogger
 
+from omfraf.main.metrics import METRICS
+
 # From: https://djangosnippets.org/snippets/1866/
 def sizify(value):
     """
@@ -33,13 +35,25 @@ class LoggingMiddleware(object):
         if not hasattr(request, 'timer'):
             request.timer = time()
 
+        duration = time() - request.timer
+        if getattr(response, 'streaming', False):
+            size = 'streamed'
+        else:
+            size = sizify(len(response.content))
         self.logger.info(
             '%s %s %s %s [%s] (%.0f ms)',
             request.META["SERVER_PROTOCOL"],
             request.method,
             request.get_full_path(),
             response.status_code,
-            sizify(len(response.content)),
-            (time() - request.timer) * 1000.
+            size,
+            duration * 1000.
         )
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match else "unknown"
+        METRICS.inc("omfraf_requests_total", view=view,
+                    status=response.status_code)
+        METRICS.observe("omfraf_request_duration_seconds", duration,
+                        view=view)
         return response
\ No newline at end of file
@@ -17,6 +17,11 @@ urlpatterns = patterns('omfraf.main.views',
     url(r'^$', 'index', name='index'),
     url(r'^repos/$', 'repos', name='repos'),
     url(r'^generate/$', 'generate', name='generate'),
+    url(r'^generate/batch/$', 'generate_batch', name='generate_batch'),
+    url(r'^jobs/(?P<job_id>[0-9a-f]+)/$', 'job', name='job'),
     url(r'^load/$', 'load', name='load'),
+    url(r'^load/batch/$', 'load_batch', name='load_batch'),
+    url(r'^load/charges/$', 'load_charges', name='load_charges'),
     url(r'^update_mop/$', 'update_mop', name='update_mop'),
+    url(r'^metrics/$', 'metrics', name='metrics'),
 )
@@ -23,6 +23,10 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "omfraf.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Load the fragment finder and generator and warm their caches at start-up
+# rather than on the first request
+import omfraf.main.util
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)